@@ -116,6 +116,7 @@ class BulkAnalyzer(object):
     filename_chooser = None
     draw_nodes = False
     print_cmtys = True
+    binary_output = False   # also write results with write_binary
 
     hook_result = [ ]
 
@@ -250,6 +251,8 @@ class BulkAnalyzer(object):
             # Write these communities out
             fname = self.outname + '.result.'+fullname+'.txt'
             result.write_clusters(fname, headers=['Result-Name: %s'%fullname])
+            if self.binary_output:
+                result.write_binary(self.outname+'.result.'+fullname+'.bin')
 
             # Draw pictures
             if self.draw_nodes:
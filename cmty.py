@@ -52,6 +52,14 @@ automatically.  These methods are implemented in the _CommunitiesBase
 object, which groups all methods which take only the requirements
 above (for the most part, this is not quite true yet).
 
+The derived indexes (nodecmtys(), nodecmtys_onetoone(), cmtysizes(),
+nodes_spanned(), cmtyintmap(), nodeintmap()) are cached on the object
+the first time they are computed, so one analysis pass only builds
+each once.  Do not mutate the returned values.  Objects which change
+(cmtys[c] = nodes, del cmtys[c]) invalidate their cache, and so do
+the views (CommunityFilter, CommunityUnion) of them.  clear_cache()
+frees the memory.
+
 cmtys.N: int
     Number of nodes
 cmtys.q: int
@@ -130,6 +138,9 @@ from_networkx(g): new instance
    on nodes.
 from_membershiplist(it): new instance
    Communities from a membership list [c0, c1, c2, ...]
+from_binary(fname): new instance
+   Communities from a binary file written by write_binary.  For
+   CompactCommunities, this memory-maps the file instead of reading it.
 
 to_dict(G): dict
    Convert to dictionary.
@@ -147,6 +158,9 @@ write_gml(g, fname):
 to_networkx_label(g):
 write_clusters(self, fname, ...):
     Write to a clusters file, consisting of one line per community.
+write_binary(self, fname):
+    Write to a binary file (header, node labels, and CSR membership
+    arrays), which can be opened in constant time.
 to_membershiplist(self, nodelist):
     Return a membership list [c0, c1, c2, ...]
 
@@ -169,6 +183,11 @@ Other classes
 Communities:
     This is the main class which uses a dict as community storage.
 
+CompactCommunities:
+    Communities stored in numpy arrays (integer node ids with a table
+    of node labels, and compressed sparse row memberships).  Uses
+    much less memory than Communities for very large partitions.
+
 CommunityFile:
     Iterative access of a one-line-per-community file.
 
@@ -217,7 +236,10 @@ comms.nodecmtys()  # dict node -> set((c1, c2, ...))
 
 """
 
+import array
 import collections
+import copy
+import cPickle as pickle
 import itertools
 import numpy
 import os
@@ -256,9 +278,47 @@ class _CommunitiesBase(object):
     .nodes()
     .cmtynames()
 
+    Derived indexes (nodecmtys(), nodecmtys_onetoone(), cmtysizes(),
+    nodes_spanned(), cmtyintmap(), nodeintmap()) are computed once and
+    cached on the object, so do not mutate what they return.  Anything
+    that changes the communities must call self._invalidate().
+    Subclasses can override the uncached _nodecmtys() etc. instead of
+    the public methods.  Caches are not pickled: list any attributes
+    of subclasses which hold them in _cache_attrs.
     """
+    _cache_attrs = ('_cache', )
     def __repr__(self):
         return '<%s object at %s>'%(self.__class__.__name__, hex(id(self)))
+    # Caching of derived indexes.
+    def _cache_version(self):
+        """Value that changes whenever the communities change.
+
+        Views of other community objects include the versions of
+        those, so that their caches are invalidated along with them."""
+        return self.__dict__.get('_version', 0)
+    def _cached(self, name, func):
+        """Return func(), cached under name until invalidated."""
+        version = self._cache_version()
+        cache = self.__dict__.get('_cache')
+        if cache is None or cache[0] != version:
+            cache = self._cache = (version, { })
+        values = cache[1]
+        if name not in values:
+            values[name] = func()
+        return values[name]
+    def _invalidate(self):
+        """Mark the communities as changed, dropping all cached values."""
+        self._version = self._cache_version() + 1
+        self.__dict__.pop('_cache', None)
+    def clear_cache(self):
+        """Drop cached derived indexes, to free memory."""
+        self.__dict__.pop('_cache', None)
+    def __getstate__(self):
+        """Pickle without the cached derived indexes."""
+        state = self.__dict__.copy()
+        for name in self._cache_attrs:
+            state.pop(name, None)
+        return state
     # Some convenience functions about community structure.
     @property
     def N(self):
@@ -277,6 +337,8 @@ class _CommunitiesBase(object):
         return set(self.iterkeys())
     def cmtysizes(self):
         """Mapping of cmty -> len(cmty_nodes)"""
+        return self._cached('cmtysizes', self._cmtysizes)
+    def _cmtysizes(self):
         return dict((c, len(ns)) for c,ns in self.iteritems())
     def cmty_densities(self, g):
         """Dictionary of all community densities.
@@ -383,6 +445,8 @@ class _CommunitiesBase(object):
 
         Returns a dictionary {n0:set(c00,c01,...), n1:set(c10,c11), ...}
         """
+        return self._cached('nodecmtys', self._nodecmtys)
+    def _nodecmtys(self):
         nodecmtys = { }
         for c, nodes in self.iteritems():
             for n in nodes:
@@ -400,6 +464,8 @@ class _CommunitiesBase(object):
         If there are nodes that are in no community, they will be
         missing from the return value.
         """
+        return self._cached('nodecmtys_onetoone', self._nodecmtys_onetoone)
+    def _nodecmtys_onetoone(self):
         nodecmtys = { }
         for c, nodes in self.iteritems():
             for n in nodes:
@@ -430,6 +496,8 @@ class _CommunitiesBase(object):
         communities span the system.  If the system is not completly
         covered, then this is only the nodes within at least one
         community."""
+        return self._cached('nodes_spanned', self._nodes_spanned)
+    def _nodes_spanned(self):
         nodes = set()
         for ns in self.itervalues():
             nodes.update(ns)
@@ -442,7 +510,7 @@ class _CommunitiesBase(object):
         This might require iterating through all community names
         twice, unless new=True in which case it will only require
         iterating through communities once but always make a new
-        dictionary.
+        dictionary (which is not cached).
 
         consecutive: bool, default true
            if false, do not require integers be consecutive.  This
@@ -451,6 +519,11 @@ class _CommunitiesBase(object):
             If true, always return a new mapping, which might not
             preserve existing names.
         """
+        if new:
+            return self._cmtyintmap(consecutive, new)
+        return self._cached(('cmtyintmap', consecutive),
+                            lambda: self._cmtyintmap(consecutive, new))
+    def _cmtyintmap(self, consecutive, new):
         # Ensure everything is integers:
         if not new \
                and all(isinstance(c, int) for c in self.iterkeys()):
@@ -464,7 +537,15 @@ class _CommunitiesBase(object):
     def nodeintmap(self, consecutive=True, new=False):
         """Map from node names to integers.
 
+        As with cmtyintmap, new=True always makes a new (uncached)
+        mapping.
+
         TODO: if nodes are already integers, do not construct a new mapping"""
+        if new:
+            return self._nodeintmap(consecutive, new)
+        return self._cached(('nodeintmap', consecutive),
+                            lambda: self._nodeintmap(consecutive, new))
+    def _nodeintmap(self, consecutive, new):
 
         # Ensure everything is integers:
         if not new \
@@ -566,12 +647,13 @@ class _CommunitiesBase(object):
         """Network modularity, computed using pcd C functions"""
         if gamma != 1.0: raise NotImplementedError('gamma != 1.0')
         from .old.models import Graph
-        G = Graph.fromNetworkX(g)
+        G = Graph.fromNetworkX(g, sparse=True)
         G.enableModularity(None)
         self.load_pcd(G)
         energy = G.energy(gamma)
-        #print sum(G.rmatrix.diagonal())/g.number_of_edges()
-        print "Q_with_diag=", ( -energy - sum(G.rmatrix.diagonal()/2.) ) / g.number_of_edges()
+        # Self terms k_n**2/2m of the null model, not in the energy.
+        diagonal = numpy.sum(G.nodeWeight**2) * G.srmatrixDefault
+        print "Q_with_diag=", ( -energy - diagonal/2. ) / g.number_of_edges()
         print "Q=", -energy / float(g.number_of_edges())
         return -energy / float(g.number_of_edges())
 
@@ -686,6 +768,24 @@ class _CommunitiesBase(object):
         c = CommunityListIterator(fname, converter=converter)
         return cls.from_iter(c.iteritems(), nodes=nodes)
     @classmethod
+    def from_binary(cls, fname):
+        """Load communities from a binary file (see write_binary).
+
+        For CompactCommunities, the arrays are memory-mapped from the
+        file, so this takes constant time and memory regardless of
+        the size of the file (apart from node labels and community
+        names which are not integers or byte strings).  Other classes
+        are created from that with from_iter."""
+        if issubclass(cls, CompactCommunities):
+            return _read_binary(fname, cls=cls)
+        compact = _read_binary(fname)
+        cmtys = cls.from_iter(compact.iteritems(),
+                              nodes=compact.nodes if compact._universe
+                                    else None)
+        if getattr(compact, 'label', None) is not None:
+            cmtys.label = compact.label
+        return cmtys
+    @classmethod
     def from_pcd(cls, G):
         """Convert a pcd.old.Graph into Communities object.
 
@@ -800,8 +900,27 @@ class _CommunitiesBase(object):
             cmty_map = self.cmtyintmap()
 
         if clear:
-            G.cmtyListClear()
-
+            # Load everything at once, in G.setcmtystate() format.
+            Ncmty = max(cmty_map.itervalues()) + 1 if cmtynodes else 0
+            sizes = numpy.zeros(Ncmty, dtype=numpy.int32)
+            for c, nodes in cmtynodes.iteritems():
+                sizes[cmty_map[c]] = len(nodes)
+            offsets = numpy.zeros(Ncmty+1, dtype=numpy.int32)
+            numpy.cumsum(sizes, out=offsets[1:])
+            members = numpy.zeros(offsets[-1], dtype=numpy.int32)
+            cmty = numpy.empty(G.N, dtype=numpy.int32)
+            cmty.fill(-1)
+            for c, nodes in cmtynodes.iteritems():
+                cid = cmty_map[c]
+                idxs = [ G._nodeIndex[n] for n in nodes ]
+                members[offsets[cid]:offsets[cid+1]] = idxs
+                if non_overlapping:
+                    cmty[idxs] = cid
+            G.setcmtystate(dict(version=1,
+                   oneToOne=int(bool(non_overlapping and self.is_cover())),
+                   hasPrimaryCmty=G.hasPrimaryCmty,
+                   cmty=cmty, cmtyOffsets=offsets, cmtyMembers=members))
+            return G
 
         G.oneToOne = 0
         if non_overlapping and self.is_cover():
@@ -992,6 +1111,22 @@ class _CommunitiesBase(object):
         if write_names == 'separate':
             f_names.close()
 
+    def write_binary(self, fname):
+        """Write to a binary, memory-mappable file.
+
+        The file has a short text header followed by the node label
+        table and the memberships as compressed sparse row arrays.
+        It can be read back with from_binary() or CommunityFile(),
+        without parsing, so this is the format to use for results
+        that are loaded many times.  Compression is not supported,
+        since compressed files can not be memory-mapped."""
+        cmtys = self
+        if not isinstance(cmtys, CompactCommunities):
+            cmtys = CompactCommunities.from_iter(
+                self.iteritems(),
+                nodes=self.nodes if self._has_nodes_universe() else None)
+        _write_binary(fname, cmtys, label=getattr(self, 'label', None))
+
 
     def write_pajek(self, fname, nodelist=None):
         """Write pajek .clu file (one line per node).
@@ -1785,9 +1920,11 @@ class Communities(_CommunitiesBase):
     self.nodecmtys() and it will generate and return this.  This is
     not very efficient, so it is advisable to cache the result.
 
-    This object, as implemented here, is not considered mutable.  You
-    can, however, mutate the _cmtynodes object yourself and changes
-    will be reflected since there is no other internal state.
+    This object, as implemented here, is mostly not considered
+    mutable.  Communities can be set or deleted with cmtys[c] = nodes
+    and del cmtys[c].  You can also mutate the _cmtynodes object
+    yourself, but then you must call self._invalidate() so that cached
+    derived indexes (nodecmtys() and so on) are recomputed.
     """
     _nodes = None
     def __init__(self, cmtynodes, nodes=None):
@@ -1822,6 +1959,14 @@ class Communities(_CommunitiesBase):
         """Mapping emulation: return nodes within community c"""
         return self._cmtynodes[c]
     cmtycontents = __getitem__
+    def __setitem__(self, c, nodes):
+        """Set the nodes of community c."""
+        self._cmtynodes[c] = nodes
+        self._invalidate()
+    def __delitem__(self, c):
+        """Remove community c."""
+        del self._cmtynodes[c]
+        self._invalidate()
     def __iter__(self):
         raise NotImplementedError("Use .iter{keys,values,items} instead")
     def __len__(self):
@@ -1837,9 +1982,9 @@ class Communities(_CommunitiesBase):
         the original's being affected, but all other mutable
         attributes are shared."""
         #return self.__class__(dict(self._cmtynodes))
-        import copy
         new = copy.copy(self)
         new._cmtynodes = dict(self._cmtynodes)
+        new._invalidate()
         return new
     def to_full(self):
         """Return a full, dict-based copy of this object.
@@ -1922,10 +2067,642 @@ CmtyDict = Communities
 
 
 
+def _label_array(labels):
+    """Array of node labels: int64 if all are integers, else object."""
+    if all(isinstance(n, (int, long)) for n in labels):
+        return numpy.asarray(labels, dtype=numpy.int64)
+    a = numpy.empty(len(labels), dtype=object)
+    for i, n in enumerate(labels):
+        a[i] = n
+    return a
 
+class _NodeCmtysView(collections.Mapping):
+    """Read-only mapping node -> communities of a CompactCommunities.
 
+    Values are made when looked up, so this does not hold a set per
+    node.  If onetoone, values are single community names instead of
+    sets."""
+    def __init__(self, cmtys, onetoone=False):
+        self._cmtys = cmtys
+        self._onetoone = onetoone
+        self._indptr, self._cmtyids = cmtys._node_index()
+    def _value(self, i):
+        names = self._cmtys._cmtynames_list()
+        cids = self._cmtyids[self._indptr[i]:self._indptr[i+1]]
+        if self._onetoone:
+            return names[cids[0]]
+        return set(names[c] for c in cids)
+    def __getitem__(self, n):
+        i = self._cmtys._nodeid(n)
+        if i is None or self._indptr[i] == self._indptr[i+1]:
+            raise KeyError(n)
+        return self._value(i)
+    def _ids(self):
+        return numpy.flatnonzero(numpy.diff(self._indptr))
+    def __iter__(self):
+        label = self._cmtys._label
+        return (label(i) for i in self._ids())
+    def __len__(self):
+        return len(self._ids())
+    def iteritems(self):
+        label = self._cmtys._label
+        return ((label(i), self._value(i)) for i in self._ids())
+
+class CompactCommunities(_CommunitiesBase):
+    """Array-based communities storage.
+
+    Nodes are stored as integer ids 0...N-1, with the array
+    self._labels mapping ids to node labels (None if the labels are
+    the ids themselves).  Memberships are stored in compressed sparse
+    row form: the nodes of community i are the ids
+    self._indices[self._indptr[i]:self._indptr[i+1]] (sorted), and its
+    name is self._cmtynames[i] (or i, if _cmtynames is None).  This
+    uses a few bytes per membership, instead of the 100+ of a dict of
+    sets, so partitions of 10^7 nodes fit in memory.
+
+    The interface is the same as Communities.  Community node sets
+    are made only when iterated over or looked up, and nodecmtys()
+    and nodecmtys_onetoone() return read-only mapping views built on
+    a reverse (node -> communities) index.
+
+    This object is not mutable.
+    """
+    _node_indptr = None
+    _node_cmtyids = None
+    _nodeindex = None
+    _cmtyindex = None
+    _nids = None
+    _cache_attrs = _CommunitiesBase._cache_attrs + (
+        '_nodeindex', '_node_indptr', '_node_cmtyids', '_cmtyindex')
+    def __init__(self, indptr, indices, labels=None, cmtynames=None,
+                 universe=False, nids=None):
+        """init
+
+        indptr, indices: compressed sparse row memberships, see above.
+
+        labels: array of node labels, indexed by node id.  If None,
+        node ids are the labels.
+
+        cmtynames: list of community names.  If None, communities are
+        named 0...q-1.
+
+        universe: if true, all nodes in labels are the universe of
+        nodes (.nodes), even if they are in no community.
+
+        nids: if labels is None, the number of node ids (nodes are
+        then 0...nids-1).  Default: the largest id in indices, plus
+        one.
+        """
+        self._indptr = numpy.asanyarray(indptr, dtype=numpy.int64)
+        self._indices = numpy.asanyarray(indices, dtype=numpy.int64)
+        self._labels = labels
+        self._cmtynames = cmtynames
+        self._universe = universe
+        if labels is None and nids is not None:
+            self._nids = nids
+        if cmtynames is not None:
+            assert len(cmtynames) == len(self._indptr) - 1
 
+    def __repr__(self):
+        return '<%s object with q=%d at %s>'%(self.__class__.__name__, self.q,
+                                              hex(id(self)))
 
+    @classmethod
+    def from_iter(cls, cmtynodes, nodes=None):
+        """Create from an iterator over (cname, nodes) pairs.
+
+        nodes: if given, this is the universe of all nodes."""
+        index = { }
+        labels = [ ]
+        if nodes is not None:
+            for n in nodes:
+                if n not in index:
+                    index[n] = len(labels)
+                    labels.append(n)
+        names = [ ]
+        sizes = array.array('l')
+        indices = array.array('l')
+        for c, cnodes in cmtynodes:
+            n_before = len(indices)
+            for n in cnodes:
+                i = index.get(n)
+                if i is None:
+                    i = index[n] = len(labels)
+                    labels.append(n)
+                indices.append(i)
+            names.append(c)
+            sizes.append(len(indices) - n_before)
+        del index
+        indices = numpy.frombuffer(indices, dtype=indices.typecode) \
+                  if indices else numpy.zeros(0, dtype=numpy.int64)
+        sizes = numpy.frombuffer(sizes, dtype=sizes.typecode) \
+                if sizes else numpy.zeros(0, dtype=numpy.int64)
+        # Sort node ids within each community.
+        cmtyids = numpy.repeat(numpy.arange(len(names)), sizes)
+        indices = indices[numpy.lexsort((indices, cmtyids))]
+        indptr = numpy.concatenate(([0], numpy.cumsum(sizes)))
+        return cls(indptr, indices, labels=_label_array(labels),
+                   cmtynames=names, universe=nodes is not None)
+    @classmethod
+    def from_dict(cls, cmtynodes, nodes=None):
+        return cls.from_iter(cmtynodes.iteritems(), nodes=nodes)
+    @classmethod
+    def from_membershiplist(cls, lst, nodelist=None):
+        """Create from a membership list [c0, c1, c2, ...].
+
+        See _CommunitiesBase.from_membershiplist.  This version is
+        vectorized: O(N log N) time, without any per-node python
+        objects."""
+        array_ = numpy.asarray(lst)
+        if array_.dtype.kind in 'iu':
+            names, cmtyids = numpy.unique(array_, return_inverse=True)
+            names = names.tolist()
+        else:
+            # Non-integer names: numpy would coerce them to one type.
+            index = { }
+            cmtyids = numpy.asarray([index.setdefault(c, len(index))
+                                     for c in lst], dtype=numpy.int64)
+            names = sorted(index, key=index.get)
+        indices = numpy.argsort(cmtyids, kind='mergesort')
+        sizes = numpy.bincount(cmtyids, minlength=len(names))
+        indptr = numpy.concatenate(([0], numpy.cumsum(sizes)))
+        labels = None
+        if nodelist is not None:
+            labels = _label_array(list(nodelist))
+        return cls(indptr, indices, labels=labels, cmtynames=names)
+
+    # Internal index helpers.
+    def _cmtynames_list(self):
+        if self._cmtynames is None:
+            return xrange(len(self._indptr) - 1)
+        return self._cmtynames
+    def _cmtyid(self, c):
+        """Index of community named c, or None."""
+        if self._cmtynames is None:
+            if isinstance(c, (int, long)) and 0 <= c < len(self):
+                return c
+            return None
+        if self._cmtyindex is None:
+            self._cmtyindex = dict((c, i) for i, c in
+                                   enumerate(self._cmtynames))
+        return self._cmtyindex.get(c)
+    @property
+    def _N_ids(self):
+        """Number of node ids (including those in no community)."""
+        if self._labels is not None:
+            return len(self._labels)
+        if self._nids is None:
+            self._nids = int(self._indices.max()) + 1 \
+                         if len(self._indices) else 0
+        return self._nids
+    def _label(self, i):
+        if self._labels is None:
+            return int(i)
+        return self._labels[i].item() if self._labels.dtype != object \
+               else self._labels[i]
+    def _labels_of(self, ids):
+        """List of labels of an array of node ids."""
+        if self._labels is None:
+            return ids.tolist()
+        return self._labels[ids].tolist()
+    def _nodeid(self, n):
+        """Node id of label n, or None."""
+        if self._labels is None:
+            if isinstance(n, (int, long)) and 0 <= n < self._N_ids:
+                return n
+            return None
+        if self._nodeindex is None:
+            self._nodeindex = dict((n, i) for i, n in
+                                   enumerate(self._labels.tolist()))
+        return self._nodeindex.get(n)
+    def _node_index(self):
+        """Reverse index: (indptr, cmtyids) in CSR form, by node id."""
+        if self._node_indptr is None:
+            cmtyids = numpy.repeat(numpy.arange(len(self)),
+                                   numpy.diff(self._indptr))
+            order = numpy.argsort(self._indices, kind='mergesort')
+            counts = numpy.bincount(self._indices, minlength=self._N_ids)
+            self._node_indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+            self._node_cmtyids = cmtyids[order]
+        return self._node_indptr, self._node_cmtyids
+    def _spanned_ids(self):
+        return numpy.flatnonzero(numpy.bincount(self._indices,
+                                                minlength=self._N_ids))
+
+    # Mapping type emulation.
+    def iterkeys(self):
+        """Iterator over community names"""
+        return iter(self._cmtynames_list())
+    def itervalues(self):
+        """Iterator over community contents (node sets)"""
+        indptr, indices = self._indptr, self._indices
+        for i in xrange(len(indptr) - 1):
+            yield set(self._labels_of(indices[indptr[i]:indptr[i+1]]))
+    def iteritems(self):
+        """Iterator over community (names, nodes_within) pairs."""
+        return itertools.izip(self._cmtynames_list(), self.itervalues())
+    def iterarrays(self, start=None, stop=None):
+        """Iterate over (cname, nodes) with nodes as arrays.
+
+        If the node ids are the labels, these are slices of the
+        membership array, without any copy.  start, stop: if given,
+        only communities start...stop-1."""
+        indptr, indices, labels = self._indptr, self._indices, self._labels
+        start, stop, _ = slice(start, stop).indices(len(self))
+        names = itertools.islice(self._cmtynames_list(), start, stop)
+        for i, cname in itertools.izip(xrange(start, stop), names):
+            ids = indices[indptr[i]:indptr[i+1]]
+            yield cname, ids if labels is None else labels[ids]
+    def __getitem__(self, c):
+        """Mapping emulation: return nodes within community c"""
+        i = self._cmtyid(c)
+        if i is None:
+            raise KeyError(c)
+        return set(self._labels_of(
+            self._indices[self._indptr[i]:self._indptr[i+1]]))
+    cmtycontents = __getitem__
+    def __iter__(self):
+        raise NotImplementedError("Use .iter{keys,values,items} instead")
+    def __len__(self):
+        """Number of communities"""
+        return len(self._indptr) - 1
+    def __contains__(self, c):
+        return self._cmtyid(c) is not None
+    def copy(self):
+        """Copy of self.  The arrays are immutable, so are shared."""
+        return copy.copy(self)
+    def to_full(self):
+        """Return a dict-based Communities copy of this object."""
+        cmtys = Communities(self.to_dict(),
+                            nodes=self.nodes if self._universe else None)
+        if getattr(self, 'label', None) is not None:
+            cmtys.label = self.label
+        return cmtys
+
+    # Vectorized versions of _CommunitiesBase methods.
+    def _has_nodes_universe(self):
+        return self._universe
+    @property
+    def nodes(self):
+        """Set of all nodes (the universe, if given at creation)."""
+        if self._universe:
+            return set(self._labels_of(numpy.arange(self._N_ids)))
+        return self.nodes_spanned()
+    def _nodes_spanned(self):
+        return set(self._labels_of(self._spanned_ids()))
+    @property
+    def N(self):
+        """Number of nodes."""
+        if self._universe:
+            return self._N_ids
+        return len(self._spanned_ids())
+    def cmtynames(self):
+        """Set of all community names."""
+        return set(self._cmtynames_list())
+    def _cmtysizes(self):
+        return dict(itertools.izip(self._cmtynames_list(),
+                                   numpy.diff(self._indptr).tolist()))
+    def cmtysizes_sum(self):
+        """Total number of nodes in communities, counting overlaps."""
+        return len(self._indices)
+    def overlap(self):
+        """sum(cmty_sizes)/n_nodes."""
+        return len(self._indices) / float(self.N)
+    def is_non_overlapping(self):
+        """Is no node is in more than one community?"""
+        if not len(self._indices):
+            return True
+        return numpy.bincount(self._indices).max() <= 1
+    def _nodecmtys(self):
+        # A read-only mapping, whose sets are made when looked up.
+        return _NodeCmtysView(self)
+    def _nodecmtys_onetoone(self):
+        view = _NodeCmtysView(self, onetoone=True)
+        indptr, cmtyids = view._indptr, view._cmtyids
+        counts = numpy.diff(indptr)
+        if len(counts) and counts.max() > 1:
+            i = numpy.flatnonzero(counts > 1)[0]
+            names = self._cmtynames_list()
+            c1, c2 = cmtyids[indptr[i]:indptr[i]+2]
+            raise OverlapError("Overlapping: node %s in cmtys %s and %s"%
+                               (self._label(i), names[c1], names[c2]))
+        return view
+
+
+
+
+
+
+
+
+_whitespace = numpy.zeros(256, dtype=bool)
+_whitespace[[ord(c) for c in ' \t\r\n\v\f']] = True
+def _parse_int_lines(data):
+    """Parse lines of whitespace-separated integers.
+
+    data is a string of complete lines, without comments.  Returns
+    (values, counts): an int64 array of all integers, and the number
+    of integers on each non-blank line."""
+    b = numpy.frombuffer(data, dtype=numpy.uint8)
+    ws = _whitespace[b]
+    starts = ~ws
+    starts[1:] &= ws[:-1]
+    if not starts.any():
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=int)
+    # Line number of each token start is the number of newlines before it.
+    lineno = numpy.cumsum(b == 10)[starts]
+    counts = numpy.bincount(lineno)
+    counts = counts[counts > 0]
+    # fromstring silently stops at, or truncates, tokens which are not
+    # integers, so check that every token is an optional sign followed
+    # by digits.
+    digit = (b >= 48) & (b <= 57)
+    sign = ((b == 43) | (b == 45)) & starts
+    sign[-1] = False
+    sign[:-1] &= digit[1:]
+    if not numpy.all(ws | digit | sign):
+        raise ValueError("Non-integer node ids in community file")
+    values = numpy.fromstring(data, dtype=numpy.int64, sep=' ')
+    if len(values) != counts.sum():
+        raise ValueError("Non-integer node ids in community file")
+    # Values out of the int64 range are clamped: check the long tokens.
+    ends = ~ws
+    ends[:-1] &= ws[1:]
+    starts, ends = numpy.nonzero(starts)[0], numpy.nonzero(ends)[0]
+    for i in numpy.nonzero(ends - starts >= 18)[0]:
+        if int(data[starts[i]:ends[i]+1]) != values[i]:
+            raise ValueError("Node id out of range in community file")
+    return values, counts
+
+class _CommunityFileIndex(object):
+    """Byte offsets of the community lines of a file.
+
+    This is stored in the sidecar file FNAME.idx: '# key: value' text
+    header lines (format, source file size and mtime, q, N, number of
+    memberships, community names header) ending with '# end', then
+    (at the next multiple of 8 bytes) the offsets and then the lengths
+    of the lines as raw little-endian int64 arrays of q entries each.
+    These are memory-mapped when read, so opening an index does not
+    depend on q.  It is only valid as long as the source file has the
+    same size and mtime.
+
+    N, the number of distinct nodes, is only counted for integer node
+    ids (with the numpy parser, see _parse_int_lines), since a set of
+    all node names would not fit in memory for the files this is made
+    for.  Otherwise it is -1.
+    """
+    format = 'pcd-cmtyindex-2'
+    names = None
+    def __init__(self, offsets, lengths, N, memberships, size, mtime,
+                 names=None):
+        self.offsets = offsets
+        self.lengths = lengths
+        self.q = len(offsets)
+        self.N = N
+        self.memberships = memberships
+        self.size = size
+        self.mtime = mtime
+        self.names = names
+    def valid(self, path):
+        """Does this index still match the file at path?"""
+        st = os.stat(path)
+        return st.st_size == self.size and repr(st.st_mtime) == self.mtime
+    @classmethod
+    def build(cls, path, ints=False, chunksize=2**24):
+        """Index a file, by reading it once.
+
+        If ints is true, node ids are integers and N is counted (in
+        chunks of about chunksize bytes)."""
+        st = os.stat(path)
+        offsets = array.array('l')
+        lengths = array.array('l')
+        # For ints: distinct node ids so far, and the data lines not
+        # parsed yet.
+        nodes = numpy.zeros(0, dtype=numpy.int64)
+        lines = [ ]
+        nbytes = 0
+        memberships = 0
+        names = None
+        offset = 0
+        f = __builtin__.open(path, 'rb')
+        for line in f:
+            length = len(line)
+            stripped = line.strip()
+            if stripped:
+                if stripped[0] == '#':
+                    if names is None \
+                           and stripped.startswith('# community names: '):
+                        names = stripped[19:].strip().split()
+                else:
+                    offsets.append(offset)
+                    lengths.append(len(line.rstrip('\r\n')))
+                    if not ints:
+                        memberships += len(stripped.split())
+                    else:
+                        lines.append(stripped)
+                        nbytes += length
+                        if nbytes >= chunksize:
+                            nodes, n = cls._add_int_nodes(nodes, lines)
+                            memberships += n
+                            lines, nbytes = [ ], 0
+            offset += length
+        f.close()
+        N = -1
+        if ints:
+            nodes, n = cls._add_int_nodes(nodes, lines)
+            memberships += n
+            N = len(nodes)
+        return cls(numpy.asarray(offsets, dtype=numpy.int64),
+                   numpy.asarray(lengths, dtype=numpy.int64),
+                   N=N, memberships=memberships,
+                   size=st.st_size, mtime=repr(st.st_mtime), names=names)
+    @staticmethod
+    def _add_int_nodes(nodes, lines):
+        """Add the integer node ids of lines to the sorted array nodes.
+
+        Returns the new array and the number of ids in lines."""
+        values, counts = _parse_int_lines('\n'.join(lines))
+        return numpy.union1d(nodes, values), len(values)
+    def write(self, fname):
+        f = __builtin__.open(fname, 'wb')
+        print >> f, '# format:', self.format
+        print >> f, '# size:', self.size
+        print >> f, '# mtime:', self.mtime
+        print >> f, '# q:', self.q
+        print >> f, '# N:', self.N
+        print >> f, '# memberships:', self.memberships
+        if self.names is not None:
+            print >> f, '# community names:', ' '.join(self.names)
+        print >> f, '# end'
+        f.write('\0' * (-f.tell() % 8))
+        numpy.asarray(self.offsets, dtype='<i8').tofile(f)
+        numpy.asarray(self.lengths, dtype='<i8').tofile(f)
+        f.close()
+    @classmethod
+    def read(cls, fname):
+        f = __builtin__.open(fname, 'rb')
+        header = { }
+        names = None
+        while True:
+            line = f.readline()
+            if not line.startswith('#'):
+                f.close()
+                raise ValueError("%s is not a community index"%fname)
+            if line.startswith('# community names: '):
+                names = line[19:].split()
+                continue
+            if line == '# end\n':
+                break
+            key, value = line[2:].split(':', 1)
+            header[key] = value.strip()
+        start = f.tell() + (-f.tell() % 8)
+        f.close()
+        if header.get('format') != cls.format:
+            raise ValueError("%s is not a community index"%fname)
+        q = int(header['q'])
+        if q == 0:
+            offsets = lengths = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            data = numpy.memmap(fname, dtype='<i8', mode='r', offset=start,
+                                shape=(2, q))
+            offsets, lengths = data[0], data[1]
+        return cls(offsets, lengths,
+                   N=int(header['N']),
+                   memberships=int(header['memberships']),
+                   size=int(header['size']), mtime=header['mtime'],
+                   names=names)
+
+# Binary community files.
+#
+# The file starts with a text header of '# key: value' lines, ending
+# with '# end', followed by the data sections.  Each section is
+# described by a header line '# section: NAME DTYPE OFFSET COUNT',
+# with OFFSET in bytes from the start of the data (the end of the
+# header, rounded up to a multiple of 8).  Sections are:
+#   indptr   '<i8', q+1 entries: CSR community pointers
+#   indices  '<i8', one per membership: node ids, sorted per community
+#   labels   node labels by id: '<i8', '|S<width>' (byte strings), or
+#            'pickle' (COUNT is then the number of bytes).  Absent if
+#            the node ids are the labels.
+#   names    community names, 'pickle'.  Absent if they are 0...q-1.
+# Array sections can be memory-mapped, so opening a file does not
+# depend on the number of memberships.
+_binary_format = 'pcd-cmtybin-1'
+_binary_magic = '# format: %s\n'%_binary_format
+def _is_binary(path):
+    """Does the file at path start like a binary community file?"""
+    if not os.path.isfile(path):
+        return False
+    f = __builtin__.open(path, 'rb')
+    start = f.read(len(_binary_magic))
+    f.close()
+    return start == _binary_magic
+def _write_binary(fname, cmtys, label=None):
+    """Write a CompactCommunities to the binary file fname."""
+    q = len(cmtys)
+    arrays = [('indptr', numpy.asarray(cmtys._indptr, dtype='<i8')),
+              ('indices', numpy.asarray(cmtys._indices, dtype='<i8'))]
+    labels = cmtys._labels
+    if labels is not None:
+        if labels.dtype.kind in 'iu' \
+               and numpy.array_equal(labels, numpy.arange(len(labels))):
+            # Identity labels: the ids are enough, with N.
+            pass
+        elif labels.dtype.kind in 'iu':
+            arrays.append(('labels', numpy.asarray(labels, dtype='<i8')))
+        else:
+            labels = labels.tolist()
+            if all(type(n) is str and not n.endswith('\x00')
+                   for n in labels):
+                arrays.append(('labels', numpy.asarray(labels, dtype='S')))
+            else:
+                arrays.append(('labels', pickle.dumps(labels, 2)))
+    names = cmtys._cmtynames
+    if names is not None \
+           and not (all(type(c) is int for c in names)
+                    and list(names) == range(q)):
+        arrays.append(('names', pickle.dumps(list(names), 2)))
+    # Header
+    header = [_binary_magic.strip()]
+    header.append('# q: %d'%q)
+    header.append('# N: %d'%cmtys._N_ids)
+    header.append('# memberships: %d'%len(cmtys._indices))
+    header.append('# universe: %d'%bool(cmtys._universe))
+    if label is not None:
+        header.append('# label: %s'%' '.join(str(label).split('\n')))
+    offset = 0
+    for name, data in arrays:
+        if isinstance(data, str):
+            dtype, count, nbytes = 'pickle', len(data), len(data)
+        else:
+            dtype, count, nbytes = data.dtype.str, len(data), data.nbytes
+        header.append('# section: %s %s %d %d'%(name, dtype, offset, count))
+        offset += (nbytes + 7) // 8 * 8
+    header.append('# end')
+    header = '\n'.join(header) + '\n'
+    f = __builtin__.open(fname, 'wb')
+    f.write(header)
+    f.write('\0' * (-len(header) % 8))
+    for name, data in arrays:
+        if isinstance(data, str):
+            f.write(data)
+            nbytes = len(data)
+        else:
+            data.tofile(f)
+            nbytes = data.nbytes
+        f.write('\0' * (-nbytes % 8))
+    f.close()
+def _read_binary(fname, cls=None):
+    """Open a binary community file, as a CompactCommunities.
+
+    The arrays are read-only numpy.memmap objects."""
+    if cls is None:
+        cls = CompactCommunities
+    f = __builtin__.open(fname, 'rb')
+    if f.readline() != _binary_magic:
+        f.close()
+        raise ValueError("%s is not a binary community file"%fname)
+    header = { }
+    sections = { }
+    while True:
+        line = f.readline()
+        if not line.startswith('#'):
+            f.close()
+            raise ValueError("Truncated binary community file %s"%fname)
+        line = line[2:].rstrip('\n')
+        if line == 'end':
+            break
+        key, value = line.split(':', 1)
+        if key == 'section':
+            name, dtype, offset, count = value.split()
+            sections[name] = (dtype, int(offset), int(count))
+        else:
+            header[key] = value.strip()
+    start = f.tell() + (-f.tell() % 8)
+    def section(name):
+        if name not in sections:
+            return None
+        dtype, offset, count = sections[name]
+        if dtype == 'pickle':
+            f.seek(start + offset)
+            return pickle.loads(f.read(count))
+        if count == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(fname, dtype=dtype, mode='r',
+                            offset=start+offset, shape=(count, ))
+    indptr = section('indptr')
+    indices = section('indices')
+    labels = section('labels')
+    names = section('names')
+    f.close()
+    if isinstance(labels, list):
+        labels = _label_array(labels)
+    cmtys = cls(indptr, indices, labels=labels, cmtynames=names,
+                universe=bool(int(header.get('universe', 0))),
+                nids=int(header['N']))
+    if 'label' in header:
+        cmtys.label = header['label']
+    return cmtys
 
 class CommunityFile(_CommunitiesBase):
     """On-line community obejct, from a file.
@@ -1943,27 +2720,58 @@ class CommunityFile(_CommunitiesBase):
     iteration has completed.  Then, q is the true number of
     communities.
 
+    Index: an uncompressed file can have a sidecar index FNAME.idx
+    (see build_index()) with the byte offset of every community line
+    and the total node and community counts.  With it, len(), .N,
+    cmtys[cname] and iteritems(start, stop) do not need to read the
+    whole file, and chunk_ranges() splits the file for parallel
+    iteration.  The index is only used while the file's size and
+    mtime are unchanged.
+
+    Integer nodes: with converter=int, the file is parsed in large
+    chunks with numpy instead of line by line.  iterarrays() yields
+    the nodes of each community as an array, and to_compact() loads
+    everything into a CompactCommunities without any per-node python
+    objects.
+
+    Binary files: a file written by write_binary() is detected when
+    opened, and all access goes through a memory-mapped
+    CompactCommunities (self._binary), so nothing is parsed.  The
+    converter and community names arguments are then not used, since
+    the file stores the original nodes and names.
     """
     # These are all cached properties.
+    _binary = None
     _cmtynames = None
     _cmtynamesfile = None
     _label = None
     _nodes = None
     _N = None
     _q = None
-    def __init__(self, fname, cmtynames=None, converter=str):
+    _index = None
+    _cmtyindex = None
+    _cache_attrs = _CommunitiesBase._cache_attrs + ('_cmtyindex', )
+    def __init__(self, fname, cmtynames=None, converter=str, index=None):
         """
 
         fname: input filename.
 
         converter: each node id in the file is passed through this
         function to convert it to a python object.  For example, to
-        convert the nodes to integers, pass `int`.  Default: str."""
+        convert the nodes to integers, pass `int`.  Default: str.
+
+        index: if None (default), use the index FNAME.idx if it
+        exists and is up to date.  If True, also (re)build it if
+        needed.  If False, never use an index."""
         self.fname = fname
         self.abspath_dir = os.getcwd()
         self.converter = converter
+        self._use_index = index
         if not exists(self.fname):
             raise ValueError("%s is not accessable"%self.fname)
+        if _is_binary(self._path):
+            self._binary = _read_binary(self._path)
+            return
         if cmtynames:
             if isinstance(cmtynames, str):
                 if not exists(cmtynames):
@@ -1983,6 +2791,11 @@ class CommunityFile(_CommunitiesBase):
                 self.__class__.__name__, self.fname, self.q, hex(id(self)))
     def __len__(self):
         """Number of communities, or RuntimeError if not known yet."""
+        if self._binary is not None:
+            return len(self._binary)
+        index = self._get_index()
+        if index is not None:
+            return index.q
         if self._q is None:
             self._q = sum(1 for _ in self.iteritems())
         return self._q
@@ -1990,10 +2803,127 @@ class CommunityFile(_CommunitiesBase):
         raise NotImplementedError("Use .iter{keys,values,items} instead")
     @property
     def N(self):
-        """Calculate number of total nodes.  This runs the iterator fully."""
+        """Calculate number of total nodes.  This runs the iterator fully,
+        unless there is an index which counted them (for converter=int,
+        see _CommunityFileIndex)."""
+        if self._binary is not None:
+            return self._binary.N
+        index = self._get_index()
+        if index is not None and index.N >= 0 and self.converter is int:
+            return index.N
         if self._N is None:
             self._N = len(self.nodes)
         return self._N
+
+    # Sidecar index
+    @property
+    def _path(self):
+        return os.path.join(self.abspath_dir, self.fname)
+    def _indexable(self):
+        path = self._path
+        return os.path.isfile(path) and self._binary is None \
+               and not path.endswith(('.gz', '.bz2'))
+    def build_index(self, write=True):
+        """Build the byte offset index of this file.
+
+        If write is true, save it as FNAME.idx (if possible).  Returns
+        the index object."""
+        if not self._indexable():
+            raise ValueError("Can only index uncompressed text files: %s"%
+                             self.fname)
+        index = _CommunityFileIndex.build(self._path,
+                                          ints=self.converter is int)
+        if write:
+            try:
+                index.write(self._path+'.idx')
+            except (IOError, OSError):
+                pass
+        self._index = index
+        self._cmtyindex = None
+        return index
+    def _get_index(self):
+        """Return the index, or None if there is none (or it is stale)."""
+        if self._use_index is False or not self._indexable():
+            return None
+        path = self._path
+        if self._index is not None and self._index.valid(path):
+            return self._index
+        self._index = self._cmtyindex = None
+        if os.path.exists(path+'.idx'):
+            try:
+                index = _CommunityFileIndex.read(path+'.idx')
+            except (ValueError, KeyError, IOError):
+                index = None
+            if index is not None and index.valid(path):
+                self._index = index
+                return index
+        if self._use_index:
+            return self.build_index()
+        return None
+    def _index_names(self, index):
+        """Community names of the communities of an index, or None."""
+        names = self.cmtynames()
+        if names is None:
+            names = index.names
+        return names
+    def _read_cmtys(self, index, start, stop):
+        """Read communities start...stop-1 using the index."""
+        converter = self.converter
+        names = self._index_names(index)
+        offsets, lengths = index.offsets, index.lengths
+        f = __builtin__.open(self._path, 'rb')
+        try:
+            for i in xrange(start, stop):
+                f.seek(offsets[i])
+                line = f.read(lengths[i])
+                cname = names[i] if names else i
+                yield cname, set(converter(x) for x in line.split())
+        finally:
+            f.close()
+    def chunk_ranges(self, n_chunks):
+        """Split the communities into (start, stop) ranges.
+
+        Each range can be given to iteritems(start, stop), for
+        example in different processes.  Requires an index."""
+        index = self._get_index()
+        if index is None:
+            raise ValueError("chunk_ranges requires an index")
+        bounds = numpy.linspace(0, index.q, n_chunks+1).astype(int)
+        return [ (bounds[i], bounds[i+1]) for i in range(n_chunks)
+                 if bounds[i] < bounds[i+1] ]
+    def __getitem__(self, c):
+        """Nodes of community c.
+
+        With an index, this reads only that line.  Without one, the
+        file is scanned until c is found."""
+        if self._binary is not None:
+            return self._binary[c]
+        index = self._get_index()
+        if index is None:
+            for cname, nodes in self.iteritems():
+                if cname == c:
+                    return nodes
+            raise KeyError(c)
+        names = self._index_names(index)
+        if names:
+            if self._cmtyindex is None:
+                self._cmtyindex = dict((cname, i) for i, cname
+                                       in enumerate(names))
+            i = self._cmtyindex.get(c)
+        else:
+            i = c if isinstance(c, (int, long)) and 0 <= c < index.q \
+                else None
+        if i is None:
+            raise KeyError(c)
+        for cname, nodes in self._read_cmtys(index, i, i+1):
+            return nodes
+    cmtycontents = __getitem__
+    def __contains__(self, c):
+        try:
+            self[c]
+        except KeyError:
+            return False
+        return True
     def _find_label(self):
         # At first, I was going to have the finding replace
         # self.__dict__['label'], but even when I do that it still
@@ -2002,6 +2932,10 @@ class CommunityFile(_CommunitiesBase):
         # use the internal _label.
         if self._label is not None:
             return self._label
+        if self._binary is not None:
+            label = self._label = getattr(self._binary, 'label', None) \
+                                  or os.path.basename(self.fname)
+            return label
         # Search for label in the file
         data = open(self.fname).read(512)
         m = re.search(r'^# label: ([^\n]+)$', data, re.M|re.I)
@@ -2029,6 +2963,8 @@ class CommunityFile(_CommunitiesBase):
 
         Note: if no names can be found, return None, and user should
         use integer indexes."""
+        if self._binary is not None:
+            return self._binary._cmtynames
         # Cached copy, explicit list
         if self._cmtynames is not None:
             return self._cmtynames
@@ -2059,7 +2995,16 @@ class CommunityFile(_CommunitiesBase):
 
         If nodes is given, use this as the node universe.  Be careful,
         if your file is large, this will use up much memory.
+
+        If cls is CompactCommunities and the converter is int, the
+        arrays are built directly with the fast parser (to_compact).
         """
+        if issubclass(cls, CompactCommunities) and nodes is None \
+               and (self.converter is int or self._binary is not None):
+            return self.to_compact(cls=cls)
+        if self._binary is not None and nodes is None \
+               and self._binary._universe:
+            nodes = self._binary.nodes
         cmtys = cls(self.cmtynodes(), nodes=nodes)
         if self.label is not None:
             cmtys.label = self.label
@@ -2082,7 +3027,7 @@ class CommunityFile(_CommunitiesBase):
         This is simply a wrapper around self.iteritems()."""
         return (nodes for c,nodes in self.iteritems())
 
-    def iteritems(self):
+    def iteritems(self, start=None, stop=None):
         """Iterate (cmty_name, cmty_nodes_list) pairs.
 
         This is the central iterator of the file.  Iterates through
@@ -2092,8 +3037,155 @@ class CommunityFile(_CommunitiesBase):
         community namess, and these will be returned as community
         names `c`.
 
+        start, stop: if given, only iterate over communities
+        start...stop-1.  This seeks directly to them if there is an
+        index.
+
         After the iterator exits, this will save the total number of
         communities found as `self.q`"""
+        if self._binary is not None:
+            if start is None and stop is None:
+                return self._binary.iteritems()
+            return ((cname, set(nodes.tolist())) for cname, nodes
+                    in self._binary.iterarrays(start, stop))
+        if start is not None or stop is not None:
+            index = self._get_index()
+            start = start or 0
+            if index is not None:
+                stop = index.q if stop is None else min(stop, index.q)
+                return self._read_cmtys(index, start, stop)
+            return itertools.islice(self.iteritems(), start, stop)
+        return self._iteritems()
+    # Fast parsing of integer node ids.
+    def _iterblocks(self, chunksize=2**24):
+        """Iterate over (names, values, counts) of chunks of the file.
+
+        The file is read in chunks of about chunksize bytes, and each
+        is parsed with _parse_int_lines.  Comment lines are handled
+        like in iteritems.  names is the list of community names (or
+        None) known at that point."""
+        names = self.cmtynames()
+        f = open(self._path, 'rb')
+        rest = ''
+        while True:
+            data = f.read(chunksize)
+            if data:
+                data = rest + data
+                end = data.rfind('\n') + 1
+                if end == 0:
+                    rest = data
+                    continue
+                data, rest = data[:end], data[end:]
+            else:
+                data, rest = rest, ''
+                if not data:
+                    break
+            if '#' in data:
+                lines = [ ]
+                for line in data.split('\n'):
+                    stripped = line.strip()
+                    if stripped.startswith('#'):
+                        if names is None \
+                               and stripped.startswith('# community names: '):
+                            names = self._cmtynames = \
+                                    stripped[19:].strip().split()
+                        continue
+                    lines.append(line)
+                data = '\n'.join(lines)
+            values, counts = _parse_int_lines(data)
+            yield names, values, counts
+        f.close()
+    def iterarrays(self, chunksize=2**24):
+        """Iterate over (cname, nodes) with nodes as int arrays.
+
+        This is a fast streaming parser for files of integer node ids:
+        the file is read in large chunks, which are tokenized with
+        numpy, and no python object is made per node.  The arrays are
+        in file order and not de-duplicated.  For binary files, they
+        are sorted and come from the memory-mapped arrays."""
+        if self._binary is not None:
+            for item in self._binary.iterarrays():
+                yield item
+            return
+        cmty_id = 0
+        for names, values, counts in self._iterblocks(chunksize):
+            ends = numpy.cumsum(counts)
+            for end, count in itertools.izip(ends, counts):
+                cname = names[cmty_id] if names else cmty_id
+                yield cname, values[end-count:end]
+                cmty_id += 1
+    def to_compact(self, cls=None, chunksize=2**24):
+        """Load into a CompactCommunities, using the fast parser.
+
+        Node ids must be integers.  This never makes python objects
+        per node, so files of 10^7+ memberships can be loaded.  Binary
+        files are not loaded at all: their memory-mapped arrays are
+        used."""
+        if cls is None:
+            cls = CompactCommunities
+        if self._binary is not None:
+            b = self._binary
+            if type(b) is cls:
+                return b
+            cmtys = cls(b._indptr, b._indices, labels=b._labels,
+                        cmtynames=b._cmtynames, universe=b._universe)
+            cmtys.label = self.label
+            return cmtys
+        all_values, all_counts = [ ], [ ]
+        names = None
+        for names, values, counts in self._iterblocks(chunksize):
+            all_values.append(values)
+            all_counts.append(counts)
+        values = numpy.concatenate(all_values) if all_values \
+                 else numpy.zeros(0, dtype=numpy.int64)
+        counts = numpy.concatenate(all_counts) if all_counts \
+                 else numpy.zeros(0, dtype=int)
+        del all_values, all_counts
+        q = len(counts)
+        # Map node ids to 0...N-1.  Dense non-negative ids can be
+        # mapped with a bincount instead of a sort.
+        labels = None
+        if len(values) and values.min() >= 0 \
+               and values.max() < 2*len(values):
+            present = numpy.bincount(values) > 0
+            if not present.all():
+                labels = numpy.flatnonzero(present)
+                newid = numpy.cumsum(present) - 1
+                values = newid[values]
+        elif len(values):
+            labels, values = numpy.unique(values, return_inverse=True)
+        # Sort within communities and remove duplicates, unless every
+        # line is already strictly increasing.
+        indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        increasing = numpy.diff(values) > 0
+        increasing[indptr[1:-1]-1] = True   # community boundaries
+        if not increasing.all():
+            cmtyids = numpy.repeat(numpy.arange(q), counts)
+            order = numpy.lexsort((values, cmtyids))
+            values, cmtyids = values[order], cmtyids[order]
+            keep = numpy.ones(len(values), dtype=bool)
+            keep[1:] = (values[1:] != values[:-1]) \
+                       | (cmtyids[1:] != cmtyids[:-1])
+            values, cmtyids = values[keep], cmtyids[keep]
+            indptr = numpy.concatenate(([0], numpy.cumsum(
+                numpy.bincount(cmtyids, minlength=q))))
+        cmtys = cls(indptr, values, labels=labels,
+                    cmtynames=list(names[:q]) if names else None)
+        cmtys.label = self.label
+        return cmtys
+
+    def _iteritems(self):
+        if self.converter is int:
+            return self._iteritems_int()
+        return self._iteritems_lines()
+    def _iteritems_int(self):
+        # Fast path: parse integers with numpy.
+        number_of_cmty = 0
+        for cname, nodes in self.iterarrays():
+            number_of_cmty += 1
+            yield cname, set(nodes.tolist())
+        self.__dict__['q'] = number_of_cmty
+    def _iteritems_lines(self):
         number_of_cmty = 0
         converter = self.converter
         names = self.cmtynames()
@@ -2129,6 +3221,12 @@ class CommunityFile(_CommunitiesBase):
         self.__dict__['q'] = number_of_cmty
 CommunityListIterator = CommunityFile
 
+def _cache_version(cmtys):
+    """Cache version of a community object (None for plain dicts)."""
+    if isinstance(cmtys, _CommunitiesBase):
+        return cmtys._cache_version()
+    return None
+
 class CommunityFilter(_CommunitiesBase):
     def __init__(self, cmtys, filter):
         self._cmtys = cmtys
@@ -2139,7 +3237,12 @@ class CommunityFilter(_CommunitiesBase):
         return '<%s object with at %s>'%(self.__class__.__name__,
                                          hex(id(self)))
     def copy(self):
-        return copy.copy(self)
+        new = copy.copy(self)
+        new.clear_cache()
+        return new
+    def _cache_version(self):
+        return (self.__dict__.get('_version', 0),
+                _cache_version(self._cmtys))
     def cmtynodes(self):
         """Create the full dictionary of community structure."""
         return self.to_dict()
@@ -2207,6 +3310,9 @@ class CommunityUnion(_CommunitiesBase):
     def __init__(self, cmtys, dup_ok=False):
         self._cmtys = cmtys
         self._dup_ok = dup_ok
+    def _cache_version(self):
+        return (self.__dict__.get('_version', 0),
+                tuple(_cache_version(c) for c in self._cmtys))
     def __len__(self):
         if self._dup_ok:
             return sum(len(c) for c in self._cmtys)
@@ -177,7 +177,9 @@ _log_bin_width = log_bin_width
 def cache_get(cache, name, func):
     """Simple dictionary based.
 
-    Returns func(), or cache of the results.
+    Returns func(), or cache of the results.  Community objects now
+    cache their own derived indexes (see pcd.cmty), so this is only
+    needed for other values.
 
     cache: dictionary or mappable.
         The cache.  If cache is None, then do not do any caching and
@@ -765,7 +767,7 @@ class CmtyEmbeddednessWorst(Statter):
     ylabel = 'community worst embeddedness'
     legend_loc = 'lower right'
     def calc(self, g, cmtys, cache=None):
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         adj = g.adj
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
@@ -943,7 +945,7 @@ class CmtyOverlap(Statter):
     ylabel = "number of overlaps"
     log_y = True
     def calc(self, g, cmtys, cache=None):
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
             if n_cmty < self.minsize:
@@ -958,7 +960,7 @@ class CmtyAvgNodeOverlap(Statter):
     ylabel = "avg memberships per node"
     log_y = True
     def calc(self, g, cmtys, cache=None):
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
             if n_cmty < self.minsize:
@@ -974,7 +976,7 @@ class CmtyNodeOverlap(Statter):
     ylabel = "memberships per node"
     log_y = True
     def calc(self, g, cmtys, cache=None):
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
             if n_cmty < self.minsize:
@@ -989,7 +991,7 @@ class NodeOverlapByDeg(Statter):
     xlabel = "node degree"
     log_y = True
     def calc(self, g, cmtys, cache=None):
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
             if n_cmty < self.minsize:
@@ -1151,7 +1153,7 @@ class CmtyLinkComm(Statter):
     _which_comp = 0
     def calc(self, g, cmtys, cache=None):
         adj = g.adj
-        nodecmtys = cache_get(cache, 'nodecmtys', lambda: cmtys.nodecmtys())
+        nodecmtys = cmtys.nodecmtys()
         for cname, cnodes in cmtys.iteritems():
             n_cmty = len(cnodes)
             if n_cmty < self.minsize:
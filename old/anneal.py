@@ -5,6 +5,7 @@ import ctypes
 import itertools
 import math
 from math import exp, log, floor, ceil
+import multiprocessing
 import numpy
 import random
 
@@ -124,6 +125,120 @@ class _GraphAnneal(object):
         return (nRounds, totChanges)
 
 
+    def anneal_pt(self, gamma, replicas=8, Escale=None, betaratio=100.,
+                  betas=None, attempts=1, maxrounds=1000,
+                  stop_best_E_changes=100, processes=None,
+                  new_cmty_prob=.01, p_binary=.05, p_collective=.05,
+                  const_q_SA=False, constqEcoupling=1.,
+                  min_n_SA=False, minnEcoupling=.1):
+        """Replica-exchange (parallel tempering) annealing.
+
+        `replicas` copies of the system are annealed at fixed betas,
+        each round being one ._anneal() sweep of self.N*attempts moves
+        per replica.  After each round, replicas at adjacent betas
+        (alternating even and odd pairs) are swapped with the
+        Metropolis probability min(1, exp(dbeta*dE)).  At the end, the
+        lowest energy state seen by any replica is loaded.
+
+        Escale: energy scale of the hottest replica (default as in
+        .anneal()).  The betas are geometrically spaced from 1/Escale
+        up to betaratio/Escale, unless `betas` is given explicitly.
+
+        maxrounds, stop_best_E_changes: stop after this many rounds,
+        or when the lowest energy has not decreased for this many
+        rounds.
+
+        processes: if given, the replicas are divided among this many
+        worker processes, which keep their replicas for the whole run.
+        The interaction arrays are moved to shared memory first, and
+        only betas, energies and statistics are passed each round.
+
+        Afterwards, self.move_info[t] is the sum of the ._anneal()
+        move_info arrays (attempts, accepted, sum of deltaE for each
+        move type) of all sweeps made at betas[t], self.swap_info[t]
+        is (attempts, accepted) for swaps between betas[t] and
+        betas[t+1], and self.betas are the betas used.
+
+        Returns (nRounds, totChanges), like .anneal().
+        """
+        if betas is None:
+            if Escale is None:
+                beta0 = .1/self._find_average_E(gamma)
+            else:
+                beta0 = 1./Escale
+            betas = beta0 * betaratio**numpy.linspace(0, 1, replicas)
+        betas = numpy.asarray(betas, dtype=float)
+        K = len(betas)
+        kwargs = dict(steps=self.N*attempts,
+                      new_cmty_prob=new_cmty_prob, p_binary=p_binary,
+                      p_collective=p_collective,
+                      const_q_SA=const_q_SA, constqEcoupling=constqEcoupling,
+                      min_n_SA=min_n_SA, minnEcoupling=minnEcoupling)
+        # temp[r] is the index of the beta replica r is running at.
+        temp = numpy.arange(K)
+        move_info = numpy.zeros((K, 12))
+        swap_info = numpy.zeros((max(K-1, 0), 2))
+        totChanges = 0
+        best_E = float('inf')
+        best_E_round = -1
+
+        if processes:
+            runner = _PTProcesses(self, K, processes, gamma, kwargs)
+        else:
+            runner = _PTReplicas(self, K, gamma, kwargs)
+        try:
+            for nRounds in itertools.count():
+                results = runner.sweep(betas[temp])
+                Es = numpy.asarray([E for E, _ in results])
+                for r, (E, info) in enumerate(results):
+                    move_info[temp[r]] += info
+                    totChanges += sum(info[1::3])
+                if Es.min() < best_E:
+                    best_E = Es.min()
+                    best_E_round = nRounds
+                # Replica exchange between adjacent betas.
+                at = numpy.argsort(temp)
+                for t in range(nRounds%2, K-1, 2):
+                    r1, r2 = at[t], at[t+1]
+                    swap_info[t, 0] += 1
+                    x = (betas[t]-betas[t+1]) * (Es[r1]-Es[r2])
+                    if x >= 0 or random.random() < exp(x):
+                        temp[r1], temp[r2] = t+1, t
+                        swap_info[t, 1] += 1
+                if self.verbosity >= 2 and nRounds%10 == 0:
+                    print "  (pt%5d) %7.2fE %7.2fbestE"%(
+                        nRounds, Es[at[-1]], best_E), \
+                        " ".join("%4.2f"%(s[1]/max(s[0], 1)) for s in swap_info)
+
+                if maxrounds and nRounds >= maxrounds:
+                    if self.verbosity > 0:
+                        print "Done: maximum rounds: %d"%nRounds
+                    break
+                if stop_best_E_changes and \
+                       nRounds - best_E_round > stop_best_E_changes:
+                    if self.verbosity > 0:
+                        print "Done: energy not decreased for %d rounds"%(
+                            nRounds - best_E_round)
+                    break
+            best_E, best_state = runner.best_state()
+        finally:
+            runner.close()
+        self.setcmtystate(best_state)
+        self.move_info = move_info
+        self.swap_info = swap_info
+        self.betas = betas
+        if self.verbosity > 0:
+            for t in range(K):
+                info = move_info[t]
+                print "  (pt b=%9.3e) accepted:"%betas[t], \
+                      " ".join("%6.4f"%(info[i*3+1]/max(info[i*3], 1))
+                               for i in range(4)),
+                if t < K-1:
+                    print " swaps %6.4f"%(swap_info[t, 1]
+                                          / max(swap_info[t, 0], 1)),
+                print
+        return (nRounds, totChanges)
+
     def _anneal(self, gamma, beta, steps=None, deltabeta=0,
                 new_cmty_prob=.01, p_binary=.05, p_collective=.05,
                 const_q_SA=False, constqEcoupling=1.,
@@ -154,3 +269,89 @@ class _GraphAnneal(object):
         #return numpy.mean(Es)
         #print Es
         return max(abs(x) for x in Es)
+
+
+
+class _PTReplicas(object):
+    """Replicas for anneal_pt, run in this process."""
+    def __init__(self, G, n, gamma, kwargs):
+        self.Gs = [ G.copy() for i in range(n) ]
+        self.gamma = gamma
+        self.kwargs = kwargs
+        self.best = [ (float('inf'), None) ] * n
+    def sweep(self, betas):
+        """Run one anneal sweep of each replica at the given betas.
+
+        Returns a list of (energy, move_info) per replica."""
+        results = [ ]
+        for i, (G, beta) in enumerate(zip(self.Gs, betas)):
+            move_info = G._anneal(self.gamma, beta=beta, **self.kwargs)
+            G.remap()
+            E = G.energy(self.gamma)
+            if E < self.best[i][0]:
+                self.best[i] = (E, G.getcmtystate())
+            results.append((E, move_info))
+        return results
+    def best_state(self):
+        """Return (energy, cmtystate) of the best state seen."""
+        return min(self.best, key=lambda x: x[0])
+    def close(self):
+        pass
+
+def _pt_worker(conn, G, n, gamma, kwargs, seed):
+    """Worker process main loop for _PTProcesses."""
+    cmodels.C.init_gen_rand(seed)
+    random.seed(seed)
+    numpy.random.seed(seed)
+    replicas = _PTReplicas(G, n, gamma, kwargs)
+    while True:
+        command, arg = conn.recv()
+        if command == 'sweep':
+            conn.send(replicas.sweep(arg))
+        elif command == 'best':
+            conn.send(replicas.best_state())
+        else:
+            break
+    conn.close()
+
+class _PTProcesses(object):
+    """Replicas for anneal_pt, divided among worker processes.
+
+    Has the same interface as _PTReplicas."""
+    def __init__(self, G, n, processes, gamma, kwargs):
+        G._shareArrays(G._readonly_arrays)
+        self.ids = [ ids for ids in
+                     numpy.array_split(numpy.arange(n), min(processes, n)) ]
+        self.conns = [ ]
+        self.procs = [ ]
+        for ids in self.ids:
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_pt_worker,
+                                        args=(child_conn, G, len(ids), gamma,
+                                              kwargs,
+                                              random.randrange(2**31-1)))
+            p.daemon = True
+            p.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(p)
+    def sweep(self, betas):
+        for conn, ids in zip(self.conns, self.ids):
+            conn.send(('sweep', betas[ids]))
+        results = [ ]
+        for conn in self.conns:
+            results.extend(conn.recv())
+        return results
+    def best_state(self):
+        for conn in self.conns:
+            conn.send(('best', None))
+        return min((conn.recv() for conn in self.conns), key=lambda x: x[0])
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('stop', None))
+            except (IOError, EOFError):
+                pass
+            conn.close()
+        for p in self.procs:
+            p.join()
@@ -2,8 +2,7 @@
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
-
-#include <glib.h>
+#include <string.h>
 
 #include "cmodels.h"
 #include "SFMT.h"
@@ -51,24 +50,52 @@ int test(Graph_t G) {
   return (0);
 }
 
-void gThreadInit() {
-  //assert(g_thread_supported());
-  //assert(!g_thread_get_initialized());
-  g_thread_init(NULL);
-  //assert(g_thread_get_initialized());
+static inline void cmtyBitsSet(Graph_t G, int c, int n) {
+  if (G->cmtyBits == NULL)
+    return;
+  if (G->cmtyBits[c] == NULL)
+    G->cmtyBits[c] = (unsigned char *) calloc((G->N+7)/8, 1);
+  G->cmtyBits[c][n>>3] |= (unsigned char) (1 << (n&7));
+}
+static inline void cmtyBitsUnset(Graph_t G, int c, int n) {
+  if (G->cmtyBits == NULL  ||  G->cmtyBits[c] == NULL)
+    return;
+  G->cmtyBits[c][n>>3] &= (unsigned char) ~(1 << (n&7));
+}
+void cmtyBitsDestroy(Graph_t G) {
+  /* Free the overlap membership bitmaps, if any.
+   */
+  int c;
+  if (G->cmtyBits == NULL)
+    return;
+  for (c=0 ; c<G->N ; c++)
+    free(G->cmtyBits[c]);
+  free(G->cmtyBits);
+  G->cmtyBits = NULL;
+}
+void cmtyBitsInit(Graph_t G) {
+  /* Build the overlap membership bitmaps from the member lists.  Once
+   * built, they are kept up to date by the add/remove functions until
+   * the lists are next cleared.
+   */
+  int c, i;
+  cmtyBitsDestroy(G);
+  G->cmtyBits = (unsigned char **) calloc(G->N, sizeof(unsigned char *));
+  for (c=0 ; c<G->Ncmty ; c++) {
+    for (i=0 ; i<G->cmtyN[c] ; i++)
+      cmtyBitsSet(G, c, G->cmtyl[c][i]);
+  }
 }
 
 int isInCmty(Graph_t G, int c, int n) {
-  /* assert(G->oneToOne); */
-  /* return (G->cmty[n] == c); */
   if (G->oneToOne)
     return (G->cmty[n] == c);
   else {
-    int in_cmty1 = g_hash_table_lookup_extended(G->cmtyListHash[c],
-    					       GINT_TO_POINTER(n),
-    					       //&n,
-    					       NULL, NULL);
-    return(in_cmty1);
+    if (G->cmtyBits == NULL)
+      cmtyBitsInit(G);
+    if (G->cmtyBits[c] == NULL)
+      return (0);
+    return ((G->cmtyBits[c][n>>3] >> (n&7)) & 1);
   }
 }
 
@@ -80,6 +107,22 @@ int isInCmty(Graph_t G, int c, int n) {
  * - G->cmtyN[c]
  * - G->Ncmty
  */
+static inline int cmtylInPool(Graph_t G, int *list) {
+  return (list >= G->cmtylPool  &&  list < G->cmtylPool+G->cmtylPoolSize);
+}
+void cmtylResize(Graph_t G, int c, int cap) {
+  /* Change the capacity of the member list of c.  Lists in the pool
+   * can't be reallocated, so they are moved out of it.
+   */
+  if (G->cmtyl[c] != NULL  &&  cmtylInPool(G, G->cmtyl[c])) {
+    int *list = (int *) malloc(cap*sizeof(int));
+    memcpy(list, G->cmtyl[c], G->cmtyN[c]*sizeof(int));
+    G->cmtyl[c] = list;
+  }
+  else
+    G->cmtyl[c] = (int *) realloc(G->cmtyl[c], cap*sizeof(int));
+  G->cmtylCap[c] = cap;
+}
 inline void cmtyListAddOverlap(Graph_t G, int c, int n) {
   /* Add particle n to community c
    *
@@ -89,10 +132,16 @@ inline void cmtyListAddOverlap(Graph_t G, int c, int n) {
    * G->cmty[n] is set to the proper community.)
    */
   if (DEBUG) assert(!isInCmty(G, c, n));
-  G->cmtyN[c]++;
   if (DEBUGLISTS)
     printf("cLAO: %2d %2d %2d\n", c, n, G->cmty[n]);
-  g_hash_table_insert(G->cmtyListHash[c], GINT_TO_POINTER(n), NULL);
+  if (G->cmtyN[c] == G->cmtylCap[c])
+    cmtylResize(G, c, G->cmtylCap[c] ? 2*G->cmtylCap[c] : 4);
+  G->cmtylPos[n] = G->cmtyN[c];
+  G->cmtyl[c][G->cmtyN[c]] = n;
+  G->cmtyN[c]++;
+  if (G->nodeWeight != NULL)
+    G->cmtyWeight[c] += G->nodeWeight[n];
+  cmtyBitsSet(G, c, n);
   /*G->cmty[n] = c;*/
   if (c >= G->Ncmty)
     G->Ncmty = c+1;
@@ -105,39 +154,57 @@ inline void cmtyListAdd(Graph_t G, int c, int n) {
   // up to date
   G->cmty[n] = c;
 }
-inline void _cmtyListRemoveOverlap(Graph_t G, int c, int n);
-inline void cmtyListRemoveOverlap(Graph_t G, int c, int n) {
-  /* Remove particle n from community c
-   *
-   * Adapted for systems that have overlaps
+inline void _cmtyListRemoveIdx(Graph_t G, int c, int i) {
+  /* Remove the i-th member of community c, by moving the last member
+   * into its place.
    */
-  if (DEBUG) assert (isInCmty(G, c, n));
-  if (DEBUG) {
-    int found = g_hash_table_lookup_extended(G->cmtyListHash[c],
-					     GINT_TO_POINTER(n),
-					     NULL, NULL);
-    assert(found);
-  }
-  _cmtyListRemoveOverlap(G, c, n);
-}
-inline void _cmtyListRemoveOverlap(Graph_t G, int c, int n) {
+  int *members = G->cmtyl[c];
+  int n = members[i];
   if (DEBUGLISTS)
     printf("cLRO: %2d %2d %2d\n", c, n, G->cmty[n]);
 
-  g_hash_table_remove(G->cmtyListHash[c], GINT_TO_POINTER(n));
   G->cmtyN[c]-- ;
+  members[i] = members[G->cmtyN[c]];
+  G->cmtylPos[members[i]] = i;
+  if (G->nodeWeight != NULL) {
+    G->cmtyWeight[c] -= G->nodeWeight[n];
+    if (G->cmtyN[c] == 0)
+      G->cmtyWeight[c] = 0;  // no accumulated roundoff
+  }
+  cmtyBitsUnset(G, c, n);
   // If we just removed the greatest-numbered community
   if (c == G->Ncmty-1  &&  G->cmtyN[c] == 0 ) {
     // Altar Ncmty too if we just removed the greatest-numbered community
-    int i;
-    for (i=G->Ncmty-1 ; i>=0 ; i--) {
-      if (G->cmtyN[i] == 0)
+    int j;
+    for (j=G->Ncmty-1 ; j>=0 ; j--) {
+      if (G->cmtyN[j] == 0)
 	G->Ncmty--;
       else
 	break;
     }
   }
 }
+inline void _cmtyListRemoveOverlap(Graph_t G, int c, int n) {
+  int i = G->cmtylPos[n];
+  // cmtylPos[n] is always right for oneToOne systems.  With overlaps
+  // it may point into another community's list, so search.
+  if (i >= G->cmtyN[c]  ||  G->cmtyl[c][i] != n) {
+    for (i=G->cmtyN[c]-1 ; i>=0 ; i--) {
+      if (G->cmtyl[c][i] == n)
+	break;
+    }
+    assert(i >= 0);
+  }
+  _cmtyListRemoveIdx(G, c, i);
+}
+inline void cmtyListRemoveOverlap(Graph_t G, int c, int n) {
+  /* Remove particle n from community c
+   *
+   * Adapted for systems that have overlaps
+   */
+  if (DEBUG) assert (isInCmty(G, c, n));
+  _cmtyListRemoveOverlap(G, c, n);
+}
 inline void cmtyListRemove(Graph_t G, int c, int n) {
   /* Remove particle n from community c
    */
@@ -174,15 +241,11 @@ inline void cmtyMoveSafe(Graph_t G, int n, int cOld, int cNew) {
 inline void cmtyMoveAll(Graph_t G, int cOld, int cNew) {
   /* Move all nodes in cOld to cNew.
    */
-  GHashTableIter hashIter;
-  void *n_p;
-  g_hash_table_iter_init(&hashIter, G->cmtyListHash[cOld]);
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  while (G->cmtyN[cOld] > 0) {
+    int n = G->cmtyl[cOld][G->cmtyN[cOld]-1];
     if (DEBUG) assert (G->cmty[n] == cOld);
     if (DEBUG) assert (!isInCmty(G, cNew, n));
-    g_hash_table_iter_remove(&hashIter);
-    _cmtyListRemoveOverlap(G, cOld, n);
+    _cmtyListRemoveIdx(G, cOld, G->cmtyN[cOld]-1);
 
     cmtyListAddOverlap(G, cNew, n);
     G->cmty[n] = cNew;
@@ -191,13 +254,9 @@ inline void cmtyMoveAll(Graph_t G, int cOld, int cNew) {
 inline void cmtyMoveAllOverlap(Graph_t G, int cOld, int cNew) {
   /* Move all nodes in cOld to cNew.
    */
-  GHashTableIter hashIter;
-  void *n_p;
-  g_hash_table_iter_init(&hashIter, G->cmtyListHash[cOld]);
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
-    g_hash_table_iter_remove(&hashIter);
-    _cmtyListRemoveOverlap(G, cOld, n);
+  while (G->cmtyN[cOld] > 0) {
+    int n = G->cmtyl[cOld][G->cmtyN[cOld]-1];
+    _cmtyListRemoveIdx(G, cOld, G->cmtyN[cOld]-1);
 
     if (! isInCmty(G, cNew, n))
       cmtyListAddOverlap(G, cNew, n);
@@ -206,6 +265,87 @@ inline void cmtyMoveAllOverlap(Graph_t G, int cOld, int cNew) {
   }
 }
 
+void cmtyListCreate(Graph_t G) {
+  /* Allocate the (empty) community member lists.
+   */
+  G->cmtyl    = (int **) calloc(G->N, sizeof(int *));
+  G->cmtylCap = (int *)  calloc(G->N, sizeof(int));
+  G->cmtylPos = (int *)  calloc(G->N, sizeof(int));
+  G->cmtyBits = NULL;
+  G->cmtylPool = NULL;
+  G->cmtylPoolSize = 0;
+}
+static void cmtylFreeAll(Graph_t G) {
+  /* Free the storage of all member lists. */
+  int c;
+  for (c=0 ; c<G->N ; c++) {
+    if (G->cmtyl[c] != NULL  &&  !cmtylInPool(G, G->cmtyl[c]))
+      free(G->cmtyl[c]);
+    G->cmtyl[c] = NULL;
+    G->cmtylCap[c] = 0;
+  }
+  free(G->cmtylPool);
+  G->cmtylPool = NULL;
+  G->cmtylPoolSize = 0;
+}
+void cmtyListDestroy(Graph_t G) {
+  cmtyBitsDestroy(G);
+  cmtylFreeAll(G);
+  free(G->cmtyl);
+  free(G->cmtylCap);
+  free(G->cmtylPos);
+  G->cmtyl = NULL;
+  G->cmtylCap = NULL;
+  G->cmtylPos = NULL;
+}
+void cmtyListClear(Graph_t G) {
+  /* Remove all nodes from all community lists.  G->cmty[n] is not
+   * touched.  List storage is kept for reuse.
+   */
+  int c;
+  for (c=0 ; c<G->N ; c++)
+    G->cmtyN[c] = 0;
+  if (G->nodeWeight != NULL)
+    for (c=0 ; c<G->N ; c++)
+      G->cmtyWeight[c] = 0;
+  G->Ncmty = 0;
+  cmtyBitsDestroy(G);
+}
+void cmtyListCopy(Graph_t G, Graph_t src) {
+  /* Make the communities of G a copy of those of src, which must
+   * have the same number of nodes.  All lists are copied into one
+   * newly allocated block (G->cmtylPool), so this is a few memcpys
+   * and a single malloc.
+   */
+  int c;
+  int size, total=0;
+  int *list;
+  assert(G->N == src->N);
+  cmtyBitsDestroy(G);
+  cmtylFreeAll(G);
+  for (c=0 ; c<src->Ncmty ; c++)
+    total += src->cmtyN[c];
+  G->cmtylPool = (int *) malloc((total+1)*sizeof(int));
+  G->cmtylPoolSize = total;
+  memcpy(G->cmty,     src->cmty,     G->N*sizeof(int));
+  memcpy(G->cmtyN,    src->cmtyN,    G->N*sizeof(int));
+  memcpy(G->cmtylPos, src->cmtylPos, G->N*sizeof(int));
+  if (G->nodeWeight != NULL)
+    memcpy(G->cmtyWeight, src->cmtyWeight, G->N*sizeof(double));
+  list = G->cmtylPool;
+  for (c=0 ; c<src->Ncmty ; c++) {
+    size = src->cmtyN[c];
+    if (size == 0)
+      continue;
+    memcpy(list, src->cmtyl[c], size*sizeof(int));
+    G->cmtyl[c] = list;
+    G->cmtylCap[c] = size;
+    list += size;
+  }
+  G->Ncmty = src->Ncmty;
+  G->oneToOne = src->oneToOne;
+  G->hasPrimaryCmty = src->hasPrimaryCmty;
+}
 inline void cmtyListInit(Graph_t G) {
   /* Initialize the community lists.
    *
@@ -215,16 +355,14 @@ inline void cmtyListInit(Graph_t G) {
   // This method is always going to initialize to a oneToOne mapping
   // by definition.
   G->oneToOne = 1;
-  // Set all lists lengths to zero
-  for (c=0 ; c<G->N ; c++) {
-    g_hash_table_remove_all(G->cmtyListHash[c]);
-    G->cmtyN[c] = 0;
-  }
-  // Set Ncmty to zero. cmtyListAdd automatically increments this as needed.
-  G->Ncmty = 0;
+  // Set all lists lengths to zero, and Ncmty to zero. cmtyListAdd
+  // automatically increments this as needed.
+  cmtyListClear(G);
   // Iterate through particles adding them to community lists
   for (n=0 ; n<G->N ; n++) {
     int c = G->cmty[n];
+    if (c == NO_CMTY)
+      continue;
     G->cmty[n] = NO_CMTY; // Without this line, cmtyListAdd fails errorcheck
     cmtyListAdd(G, c, n);
     if (G->cmty[n] >= G->Ncmty)
@@ -238,7 +376,6 @@ inline void cmtyListInit(Graph_t G) {
       break;
     }
   }
-  //hashInit(G);
 }
 int cmtyListCheck(Graph_t G) {
   /* Check the community lists for consistency.
@@ -249,8 +386,7 @@ int cmtyListCheck(Graph_t G) {
    * Returns the numbers of errors found.
    */
   int errors=0;
-  /* int i, j, n, m; */
-  int cmty;
+  int cmty, i;
   // Check Ncmty is indeed the maximum number of communities.
   for (cmty=0; cmty < G->N; cmty++) {
     if ( G->cmtyN[cmty] > 0   &&  cmty >= G->Ncmty ) {
@@ -260,71 +396,47 @@ int cmtyListCheck(Graph_t G) {
     }
   }
   for (cmty=0; cmty < G->Ncmty; cmty++) {
-    if ((int) g_hash_table_size(G->cmtyListHash[cmty]) != G->cmtyN[cmty]) {
+    if (G->cmtyN[cmty] > G->cmtylCap[cmty]) {
       printf("cmty %d size mismatch: %d %d\n", cmty,
-	     g_hash_table_size(G->cmtyListHash[cmty]), G->cmtyN[cmty]);
+	     G->cmtylCap[cmty], G->cmtyN[cmty]);
       errors++;
+      continue;
+    }
+    for (i=0 ; i<G->cmtyN[cmty] ; i++) {
+      int n = G->cmtyl[cmty][i];
+      if (n < 0  ||  n >= G->N) {
+	printf("cmty %d has invalid node %d\n", cmty, n);
+	errors++;
+      }
+      else if (G->oneToOne  &&
+	       (G->cmty[n] != cmty  ||  G->cmtylPos[n] != i)) {
+	printf("cmty %d list has node %d (cmty %d, pos %d != %d)\n", cmty,
+	       n, G->cmty[n], G->cmtylPos[n], i);
+	errors++;
+      }
+    }
+    if (G->nodeWeight != NULL) {
+      double weight=0;
+      for (i=0 ; i<G->cmtyN[cmty] ; i++)
+	weight += G->nodeWeight[G->cmtyl[cmty][i]];
+      if (fabs(weight - G->cmtyWeight[cmty]) > 1e-6*(1+fabs(weight))) {
+	printf("cmty %d weight mismatch: %f %f\n", cmty,
+	       G->cmtyWeight[cmty], weight);
+	errors++;
+      }
     }
   }
   return (errors);
 }
 
-void hashCreate(Graph_t G) {
-  assert(G->cmtyListHash[0] == NULL  &&  G->cmtyListHash[1] == NULL);
-  int c;
-  for (c=0 ; c<G->N ; c++) {
-    if (DEBUG) assert(G->cmtyListHash[c] == NULL);
-    G->cmtyListHash[c] = g_hash_table_new(g_direct_hash,
-					  g_direct_equal
-					  );
-  }
-}
-void hashClear(Graph_t G) {
-  /* Remove all contents from all hashes */
-  int c;
-  for (c=0 ; c<G->N ; c++) {
-    g_hash_table_remove_all(G->cmtyListHash[c]);
-  }
-}
-void hashInit(Graph_t G) {
-  /* Initialize hashes from community lists */
-  hashClear(G);
-  int n;
-  for (n=0 ; n<G->N ; n++) {
-    int c = G->cmty[n];
-    g_hash_table_insert(G->cmtyListHash[c], GINT_TO_POINTER(n), NULL);
-  }
-}
-void hashDestroy(Graph_t G) {
-  int c;
-  for (c=0 ; c<G->N ; c++) {
-    if (DEBUG) assert(G->cmtyListHash[c] != NULL);
-    g_hash_table_destroy(G->cmtyListHash[c]);
-    G->cmtyListHash[c] = NULL;
-  }
-  //free(G->cmtyListHash);
-}
-void hashPrintKeys(GHashTable *HT) {
-  void printkey(void *key, void *value, void *data) {
-    value=value;  // Unused argument, this supresses GCC warning
-    data=data;    // Unused argument, this supresses GCC warning
-    printf("%d ", GPOINTER_TO_INT(key));
-  }
-  g_hash_table_foreach(HT, printkey, NULL);
-  printf("\n");
-}
-void hashInfo(Graph_t G) {
+void cmtyListInfo(Graph_t G) {
   int (c);
+  int i;
   for (c=0 ; c<G->Ncmty ; c++ ) {
     if (G->cmtyN[c] == 0) continue;
     printf("cmty %2d: ", c);
-    GHashTableIter hashIter;
-    g_hash_table_iter_init(&hashIter, G->cmtyListHash[c]);
-    void *n_p;
-    while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-      int n = GPOINTER_TO_INT(n_p);
-      printf("%d ", n);
-    }
+    for (i=0 ; i<G->cmtyN[c] ; i++)
+      printf("%d ", G->cmtyl[c][i]);
     printf("\n");
   }
 }
@@ -340,13 +452,11 @@ int cmtyIntersect(Graph_t G0, int c0, Graph_t G1, int c1) {
     int     ctmp = c0;  c0 = c1 ; c1 = ctmp;
   }
 
-  GHashTableIter hashIter;
   int n_intersect = 0;
-  void *n_p;
+  int i;
 
-  g_hash_table_iter_init(&hashIter, G0->cmtyListHash[c0]);
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  for (i=0 ; i<G0->cmtyN[c0] ; i++) {
+    int n = G0->cmtyl[c0][i];
     if (isInCmty(G1, c1, n))
       n_intersect += 1;
     }
@@ -361,13 +471,11 @@ int cmtyUnion(Graph_t G0, int c0, Graph_t G1, int c1) {
     int     ctmp = c0;  c0 = c1 ; c1 = ctmp;
   }
 
-  GHashTableIter hashIter;
   int n_union = G1->cmtyN[c1];
-  void *n_p;
+  int i;
 
-  g_hash_table_iter_init(&hashIter, G0->cmtyListHash[c0]);
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  for (i=0 ; i<G0->cmtyN[c0] ; i++) {
+    int n = G0->cmtyl[c0][i];
     if (!isInCmty(G1, c1, n))
       n_union += 1;
     }
@@ -377,36 +485,56 @@ int cmtyUnion(Graph_t G0, int c0, Graph_t G1, int c1) {
 int cmtyIsSubset(Graph_t G, int csmall, int cbig) {
   /* is csmall a subset of cbig?  This also allows csmall to be equal
    * to cbig (not a strict superset).  */
-  GHashTableIter hashIter;
-  GHashTable *hashSmall = G->cmtyListHash[csmall];
-  GHashTable *hashBig   = G->cmtyListHash[cbig];
-  g_hash_table_iter_init(&hashIter, hashSmall);
-  void *n_p;
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    //int n = GPOINTER_TO_INT(n_p);
-    int found = g_hash_table_lookup_extended(hashBig,
-					     &n_p,
-					     NULL, NULL);
-    if (!found)
-      return(FALSE);
-  }
-  return (TRUE);
+  int i;
+  for (i=0 ; i<G->cmtyN[csmall] ; i++) {
+    if (!isInCmty(G, cbig, G->cmtyl[csmall][i]))
+      return (0);
+  }
+  return (1);
 }
 int cmtyGetContents(Graph_t G, int c, int *tmp, int *cN) {
-  GHashTableIter hashIter;
-  void *n_p;
-
-  g_hash_table_iter_init(&hashIter, G->cmtyListHash[c]);
-  int i = 0;
-  while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  int i;
+  for (i=0 ; i<G->cmtyN[c] ; i++) {
     //printf("cGC: %d %d %d\n", c, n, i);
-    tmp[i] = n;
-    i++;
+    tmp[i] = G->cmtyl[c][i];
   }
   *cN = G->cmtyN[c];
   return(1);
 }
+int cmtyGetContentsAll(Graph_t G, int *members) {
+  /* Write the contents of all communities c=0...Ncmty-1, one after
+   * the other, to `members` (which must have room for the sum of
+   * G->cmtyN[c]).  Returns the number of entries written.
+   */
+  int c, i=0;
+  for (c=0 ; c<G->Ncmty ; c++) {
+    memcpy(members+i, G->cmtyl[c], G->cmtyN[c]*sizeof(int));
+    i += G->cmtyN[c];
+  }
+  return(i);
+}
+int cmtySetContentsAll(Graph_t G, int Ncmty, int *offsets, int *members) {
+  /* Replace all community lists.  Community c gets nodes
+   * members[offsets[c]] ... members[offsets[c+1]-1], for
+   * c=0...Ncmty-1.  G->cmty is not modified.
+   *
+   * Returns 1 if no node is in more than one community, 0 otherwise.
+   */
+  int c, i;
+  int oneToOne = 1;
+  cmtyListClear(G);
+  SetClear(G->seenList);
+  for (c=0 ; c<Ncmty ; c++) {
+    for (i=offsets[c] ; i<offsets[c+1] ; i++) {
+      int n = members[i];
+      if (SetContains(G->seenList, n))
+	oneToOne = 0;
+      SetAdd(G->seenList, n);
+      cmtyListAddOverlap(G, c, n);
+    }
+  }
+  return(oneToOne);
+}
 
 
 int find_empty_cmty(Graph_t G) {
@@ -463,13 +591,11 @@ int split_community(Graph_t G, int c, double prob, int n) {
   int counter = 0;
   int cNewCount = 0;
   int *tmp = G->tmp;
-  GHashTableIter hashIter;
-  void *node_p;
+  int *node_p;
   int cOldCount = G->cmtyN[c];
-  g_hash_table_iter_init(&hashIter, G->cmtyListHash[c]);
-  while (g_hash_table_iter_next(&hashIter, &node_p, NULL)) {
+  for (node_p=G->cmtyl[c] ; node_p<G->cmtyl[c]+G->cmtyN[c] ; node_p++) {
     // Iterate through all nodes in the community...
-    int node = GPOINTER_TO_INT(node_p);
+    int node = *node_p;
     if (n && n == cNewCount)
       break;
     if (n) {
@@ -558,7 +684,7 @@ double H2(Graph_t GX, Graph_t GY, int cX, int cY) {
   //int *cXm = GX->cmtyl[cX];
   //int *cYm = GY->cmtyl[cY];
   int  cX_n = GX->cmtyN[cX];
-  int  cY_n = GX->cmtyN[cY];
+  int  cY_n = GY->cmtyN[cY];
 
   //printf("  c %d %d\n", n_intersect_nodes(cXm, cYm, cX_n, cY_n),
   //                 n_union_nodes(cXm, cYm, cX_n, cY_n));
@@ -689,17 +815,15 @@ double energy(Graph_t G, double gamma) {
   int c;
   double E=0;
 
-  GHashTableIter hashIterOuter;
   /* GHashTableIter hashIterInner; */
 
   for (c=0 ; c<G->Ncmty ; c++) {
     if (G->cmtyN[c] == 0)
       continue;
     // for communities c
-    void *n_p;
-    g_hash_table_iter_init(&hashIterOuter, G->cmtyListHash[c]);
-    while (g_hash_table_iter_next(&hashIterOuter, &n_p, NULL)) {
-      int n = GPOINTER_TO_INT(n_p);
+    int *n_p;
+    for (n_p=G->cmtyl[c] ; n_p<G->cmtyl[c]+G->cmtyN[c] ; n_p++) {
+      int n = *n_p;
       // Do symmetric: both directions.
       E += energy_cmty_n(G, gamma, c, n);
     }
@@ -716,17 +840,15 @@ double energy_sparse(Graph_t G, double gamma) {
   assert(G->hasSparse);
   double E=0;
 
-  GHashTableIter hashIter;
 
 
   int c;
   for (c=0 ; c<G->Ncmty ; c++) {
     // for communities c
-    void *n_p;
-    g_hash_table_iter_init(&hashIter, G->cmtyListHash[c]);
-    // For each particle in the community
-    while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-      int n = GPOINTER_TO_INT(n_p);
+    int *n_p;
+        // For each particle in the community
+    for (n_p=G->cmtyl[c] ; n_p<G->cmtyl[c]+G->cmtyN[c] ; n_p++) {
+      int n = *n_p;
       // Add up energy of that particle to the community.
       E += energy_cmty_n_sparse(G, gamma, c, n);
     }
@@ -740,18 +862,16 @@ double energy_sparse(Graph_t G, double gamma) {
 double energy_cmty(Graph_t G, double gamma, int c) {
   /* Calculate the energy of only one community `c`.
    *
-   * This function is symmetric.
+   * This function is symmetric.  Works on both the full and sparse
+   * interactions, since energy_cmty_n dispatches.
    */
-  assert(G->hasFull);
   double E=0;
 
-  GHashTableIter hashIterOuter;
   //GHashTableIter hashIterInner;
 
-  void *n_p;
-  g_hash_table_iter_init(&hashIterOuter, G->cmtyListHash[c]);
-  while (g_hash_table_iter_next(&hashIterOuter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  int *n_p;
+  for (n_p=G->cmtyl[c] ; n_p<G->cmtyl[c]+G->cmtyN[c] ; n_p++) {
+    int n = *n_p;
     E += energy_cmty_n(G, gamma, c, n);
   }
   return(.5 * E);
@@ -763,7 +883,7 @@ double energy_cmty_n(Graph_t G, double gamma, int c, int n) {
    *
    * This function is unidirectional (node n -> cmty c)
    */
-  assert(G->hasFull);
+  if (!G->hasFull) return energy_cmty_n_sparse(G, gamma, c, n);
   imatrix_t attractions=0;
   imatrix_t repulsions =0;
   imatrix_t *imatrix_row = G->imatrix + n*G->N;
@@ -772,13 +892,11 @@ double energy_cmty_n(Graph_t G, double gamma, int c, int n) {
     rmatrix_row = G->rmatrix + n*G->N;
   }
 
-  GHashTableIter hashIterInner;
 
   // for community c
-  void *m_p;
-  g_hash_table_iter_init(&hashIterInner, G->cmtyListHash[c]);
-  while (g_hash_table_iter_next(&hashIterInner, &m_p, NULL)) {
-    int m = GPOINTER_TO_INT(m_p);
+  int *m_p;
+  for (m_p=G->cmtyl[c] ; m_p<G->cmtyl[c]+G->cmtyN[c] ; m_p++) {
+    int m = *m_p;
     if (m == n)
       continue;
     if (rmatrix_row == NULL) {
@@ -800,6 +918,50 @@ double energy_cmty_n(Graph_t G, double gamma, int c, int n) {
 }
 
 
+inline double sparse_nUnDefined(Graph_t G, int c, int n, int nDefined,
+				int nInCmty) {
+  /* Number of pairs between node n and the other members of
+   * community c which get the default interactions.  nDefined is the
+   * number of stored interactions among them, and nInCmty is 1 if n
+   * itself is in c.
+   */
+  if (G->nodeWeight == NULL)
+    return (G->cmtyN[c] - nDefined - nInCmty);
+  return (G->nodeWeight[n] * (G->cmtyWeight[c] - nInCmty*G->nodeWeight[n]));
+}
+inline double energy_sparse_from_sums(Graph_t G, double gamma,
+				     double attractions,
+				     double repulsions,
+				     double nDefinedI, double nUnDefinedI) {
+  /* Finish a sparse energy calculation.
+   *
+   * attractions and repulsions are the sums over the nDefinedI
+   * explicitly stored interactions, nUnDefinedI is the number of
+   * other pairs, which get the default interactions.  (The counts
+   * are doubles so that sums over whole communities can't overflow.)
+   */
+  double nUnDefinedR = nUnDefinedI;
+  if (G->srmatrix == NULL) {
+    attractions += nUnDefinedI * G->simatrixDefault;
+    repulsions  += nUnDefinedR * G->srmatrixDefault;
+
+    /* imatrix_t interaction = G->srmatrixDefault; */
+    /* if (interaction > 0) */
+    /*   repulsions  += nUnDefinedI * G->srmatrixDefault; */
+    /* else */
+    /*   attractions += nUnDefinedI * G->simatrixDefault; */
+  }
+  else if (G->srmatrixDefaultOnlyDefined != 0) {
+    attractions += nUnDefinedI * G->simatrixDefault;
+    repulsions  += nUnDefinedR * G->srmatrixDefault;
+    repulsions  += nDefinedI * G->srmatrixDefaultOnlyDefined;
+  }
+  else {
+    attractions += nUnDefinedI * G->simatrixDefault;
+    repulsions  += nUnDefinedR * G->srmatrixDefault;
+  }
+  return (attractions + gamma*repulsions);
+}
 double energy_cmty_n_sparse(Graph_t G, double gamma, int c, int n) {
   /* Calculate the energy of only one community `c`, if it had node n
    * in it.  Node n does not have to actually be in that community.
@@ -813,10 +975,11 @@ double energy_cmty_n_sparse(Graph_t G, double gamma, int c, int n) {
   int j;
   int nDefinedI = 0;
   //int nDefinedR = 0;
+  // Row n of the sparse arrays starts at simatrixIdx[n].
+  int row = G->simatrixIdx[n];
   // For each adjoining particle in the list:
   for (j=0 ; j<G->simatrixN[n] ; j++) {
-    //int m = G->simatrixId[n*G->simatrixLen + j];
-    int m = G->simatrixIdl[n][j];
+    int m = G->simatrixId[row + j];
     if (m == n)
       continue;
     if (! isInCmty(G, c, m))
@@ -824,53 +987,29 @@ double energy_cmty_n_sparse(Graph_t G, double gamma, int c, int n) {
 
     nDefinedI++;
     if (G->srmatrix == NULL) {
-      imatrix_t interaction = G->simatrix[n*G->simatrixLen + j];
+      imatrix_t interaction = G->simatrix[row + j];
       if (interaction > 0)
 	repulsions  += interaction;
       else
 	attractions += interaction;
     }
     else {
-      attractions += G->simatrix[n*G->simatrixLen + j];
-      repulsions += G->srmatrix[n*G->simatrixLen + j];
+      attractions += G->simatrix[row + j];
+      repulsions += G->srmatrix[row + j];
     }
   }
-  int nUnDefinedI = G->cmtyN[c] - nDefinedI;
-  int nUnDefinedR = nUnDefinedI;
-
-  // -1 comes from self interaction not being counted as undefined.
-  if (isInCmty(G, c, n)) {
-    nUnDefinedI -= 1;
-    nUnDefinedR -= 1;
-  }
-
-  if (G->srmatrix == NULL) {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
-
-    /* imatrix_t interaction = G->srmatrixDefault; */
-    /* if (interaction > 0) */
-    /*   repulsions  += nUnDefinedI * G->srmatrixDefault; */
-    /* else */
-    /*   attractions += nUnDefinedI * G->simatrixDefault; */
-  }
-  else if (G->srmatrixDefaultOnlyDefined != 0) {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
-    repulsions  += nDefinedI * G->srmatrixDefaultOnlyDefined;
-  }
-  else {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
-  }
+  // The self interaction is not counted as undefined.
+  double nUnDefinedI = sparse_nUnDefined(G, c, n, nDefinedI,
+					 isInCmty(G, c, n));
 
-  double E = (attractions + gamma*repulsions);
+  double E = energy_sparse_from_sums(G, gamma, attractions, repulsions,
+				     nDefinedI, nUnDefinedI);
   /* printf(" e_c_n_s %d %d(%d,%d)\n", c, n, G->cmtyN[c], nUnDefined); */
   //if (DEBUG && E != energy_cmty_n(G, gamma, c, n)) {
   if (DEBUG && G->hasFull) {
     double E2 = energy_cmty_n(G, gamma, c, n);
     if ( fabs(E-E2)>.01  && fabs(E-E2)/E > .0001) {
-      printf(" e_c_n_s %d %d(%d,%d) (%d) %f %f\n", c, n, G->cmtyN[c],
+      printf(" e_c_n_s %d %d(%d,%g) (%d) %f %f\n", c, n, G->cmtyN[c],
 	     nUnDefinedI,
 	     isInCmty(G, c, n),
 	     E, E2);
@@ -892,14 +1031,12 @@ double energy_cmty_cmty(Graph_t G, double gamma, int c1, int c2) {
    *
    * This function is asymmetric, c1 -> c2
    */
-  assert(G->hasFull);
+  if (!G->hasFull) return energy_cmty_cmty_sparse(G, gamma, c1, c2);
   double E=0;
-  GHashTableIter hashIterOuter;
-  void *n_p;
+  int *n_p;
 
-  g_hash_table_iter_init(&hashIterOuter, G->cmtyListHash[c1]);
-  while (g_hash_table_iter_next(&hashIterOuter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  for (n_p=G->cmtyl[c1] ; n_p<G->cmtyl[c1]+G->cmtyN[c1] ; n_p++) {
+    int n = *n_p;
     E += energy_cmty_n(G, gamma, c2, n);
     /* printf("ecc %d %d %d %f\n", c1, c2, n, E); */
   }
@@ -912,12 +1049,10 @@ double energy_cmty_cmty_sparse(Graph_t G, double gamma, int c1, int c2) {
    */
   assert(G->hasSparse);
   double E=0;
-  GHashTableIter hashIterOuter;
-  void *n_p;
+  int *n_p;
 
-  g_hash_table_iter_init(&hashIterOuter, G->cmtyListHash[c1]);
-  while (g_hash_table_iter_next(&hashIterOuter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  for (n_p=G->cmtyl[c1] ; n_p<G->cmtyl[c1]+G->cmtyN[c1] ; n_p++) {
+    int n = *n_p;
     E += energy_cmty_n_sparse(G, gamma, c2, n);
     /* printf("eccs %d %d %f\n", c2, n, E); */
   }
@@ -928,7 +1063,6 @@ double energy_n(Graph_t G, double gamma, int n) {
    *
    * This function is asymmetric, n -> its community.
    */
-  assert(G->hasFull);
   assert(G->oneToOne);
   int c = G->cmty[n];
   return energy_cmty_n(G, gamma, c, n);
@@ -948,18 +1082,16 @@ double energy_cmty_cmty_xor_sparse(Graph_t G, double gamma, int c1, int c2) {
   int n2only = (cmtyN(G, c2) - n_intersect);
   int nDefinedI = 0;
 
-  GHashTableIter hashIter1;
-  void *n1_p;
+  int *n1_p;
 
-  g_hash_table_iter_init(&hashIter1, G->cmtyListHash[c1]);
-  while (g_hash_table_iter_next(&hashIter1, &n1_p, NULL)) {
-    int n1 = GPOINTER_TO_INT(n1_p);
+  for (n1_p=G->cmtyl[c1] ; n1_p<G->cmtyl[c1]+G->cmtyN[c1] ; n1_p++) {
+    int n1 = *n1_p;
     if (isInCmty(G, c2, n1))
       continue;
 
     int i;
     for (i=0 ; i<G->simatrixN[n1] ; i++) {
-      int n2 = G->simatrixId[i];
+      int n2 = G->simatrixId[G->simatrixIdx[n1] + i];
       if (n2 == n1)
 	continue;
       if (isInCmty(G, c1, n2))
@@ -971,47 +1103,39 @@ double energy_cmty_cmty_xor_sparse(Graph_t G, double gamma, int c1, int c2) {
 
       nDefinedI += 1;
       if (G->srmatrix == NULL) {
-        imatrix_t interaction = G->simatrix[n1*G->simatrixLen + i];
+        imatrix_t interaction = G->simatrix[G->simatrixIdx[n1] + i];
         if (interaction > 0)
       	repulsions  += interaction;
         else
       	attractions += interaction;
       }
       else {
-        attractions += G->simatrix[n1*G->simatrixLen + i];
-        repulsions += G->srmatrix[n1*G->simatrixLen + i];
+        attractions += G->simatrix[G->simatrixIdx[n1] + i];
+        repulsions += G->srmatrix[G->simatrixIdx[n1] + i];
       }
 
       //assert(0); // Needs to be upgraded to handle srmatrix.
     }
   }
-  int nShouldBeDefined = n1only * n2only;
-  int nUnDefinedI = nShouldBeDefined - nDefinedI;
-  int nUnDefinedR = nUnDefinedI;
-
-  if (G->srmatrix == NULL) {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
-
-    /* imatrix_t interaction = G->srmatrixDefault; */
-    /* if (interaction > 0) */
-    /*   repulsions  += nUnDefinedI * G->srmatrixDefault; */
-    /* else */
-    /*   attractions += nUnDefinedI * G->simatrixDefault; */
-  }
-  else if (G->srmatrixDefaultOnlyDefined != 0) {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
-    repulsions  += nDefinedI * G->srmatrixDefaultOnlyDefined;
+  double nUnDefinedI;
+  if (G->nodeWeight == NULL) {
+    nUnDefinedI = (double)n1only * n2only - nDefinedI;
   }
   else {
-    attractions += nUnDefinedI * G->simatrixDefault;
-    repulsions  += nUnDefinedR * G->srmatrixDefault;
+    // Weighted nodes: every pair gets the default interaction times
+    // the product of the node weights, as in sparse_nUnDefined.
+    double w1only = 0, w2only = 0;
+    int *n_p;
+    for (n_p=G->cmtyl[c1] ; n_p<G->cmtyl[c1]+G->cmtyN[c1] ; n_p++)
+      if (!isInCmty(G, c2, *n_p))
+	w1only += G->nodeWeight[*n_p];
+    for (n_p=G->cmtyl[c2] ; n_p<G->cmtyl[c2]+G->cmtyN[c2] ; n_p++)
+      if (!isInCmty(G, c1, *n_p))
+	w2only += G->nodeWeight[*n_p];
+    nUnDefinedI = w1only * w2only;
   }
-
-  double E = (attractions + gamma*repulsions);
-  return(E);
-
+  return energy_sparse_from_sums(G, gamma, attractions, repulsions,
+				 nDefinedI, nUnDefinedI);
 }
 
 
@@ -1022,17 +1146,25 @@ int edgecount_cmty_n(Graph_t G, int c, int n) {
    * This function is asymmetric (node n -> cmty c).  Does not count
    * self-edges.
    */
-  assert(G->hasFull);
-  //assert(G->rmatrix == NULL);
   int count=0;
+  if (!G->hasFull) {
+    int j;
+    int row = G->simatrixIdx[n];
+    assert(G->hasSparse);
+    for (j=0 ; j<G->simatrixN[n] ; j++) {
+      int m = G->simatrixId[row + j];
+      if (m != n  &&  G->simatrix[row + j] < 0.0  &&  isInCmty(G, c, m))
+	count += 1;
+    }
+    return(count);
+  }
+  //assert(G->rmatrix == NULL);
 
-  GHashTableIter hashIterInner;
 
   // for community c
-  void *m_p;
-  g_hash_table_iter_init(&hashIterInner, G->cmtyListHash[c]);
-  while (g_hash_table_iter_next(&hashIterInner, &m_p, NULL)) {
-    int m = GPOINTER_TO_INT(m_p);
+  int *m_p;
+  for (m_p=G->cmtyl[c] ; m_p<G->cmtyl[c]+G->cmtyN[c] ; m_p++) {
+    int m = *m_p;
     if (m == n) {
       continue;
     }
@@ -1048,14 +1180,11 @@ int edgecount_cmty_cmty(Graph_t G, int c1, int c2) {
    *
    * This function is asymmetric, c1 -> c2
    */
-  assert(G->hasFull);
   int edgecount=0;
-  GHashTableIter hashIterOuter;
-  void *n_p;
+  int *n_p;
 
-  g_hash_table_iter_init(&hashIterOuter, G->cmtyListHash[c1]);
-  while (g_hash_table_iter_next(&hashIterOuter, &n_p, NULL)) {
-    int n = GPOINTER_TO_INT(n_p);
+  for (n_p=G->cmtyl[c1] ; n_p<G->cmtyl[c1]+G->cmtyN[c1] ; n_p++) {
+    int n = *n_p;
     edgecount += edgecount_cmty_n(G, c2, n);
   }
   return (edgecount);
@@ -1232,12 +1361,26 @@ int greedy_sparse(Graph_t G, double gamma) {
   /* Core minimization routine.  Do one sweep, moving each particle
    * (in order of G->randomOrder into the community that most lowers the
    * energy.
+   *
+   * For each particle we make one pass over its sparse row, summing
+   * its interactions with each neighboring community.  The energy
+   * with every candidate community then follows in O(1) from these
+   * sums and G->cmtyN (for the default interactions), so a sweep is
+   * O(N+E) instead of calling energy_cmty_n_sparse for every
+   * candidate.  The sums are kept in arrays indexed by community and
+   * reset after each particle using the list of touched communities.
    */
   assert(G->hasSparse);
   assert(G->hasPrimaryCmty);
   int changes=0;
   int nindex, n;
 
+  imatrix_t *cmtyAttractions = calloc(G->N, sizeof(imatrix_t));
+  imatrix_t *cmtyRepulsions  = calloc(G->N, sizeof(imatrix_t));
+  int *cmtyNDefined   = calloc(G->N, sizeof(int));
+  char *cmtyCandidate = calloc(G->N, sizeof(char));
+  int *touched = G->tmp;
+
   /* double E_avg = energy(G, gamma) / G->N; */
 
   // Loop over particles
@@ -1257,37 +1400,78 @@ int greedy_sparse(Graph_t G, double gamma) {
     // moving, since that would change number of communities.
     if (G->const_q && G->cmtyN[bestcmty]<=1)
       continue;
+    int oldcmty  = G->cmty[n];
+
+    // Sum interactions of n with each community it has neighbors in.
+    // Only communities with an attractive interaction are candidates
+    // for moving into.
+    int nTouched = 0;
+    int row = G->simatrixIdx[n];
+    int j;
+    for(j=0 ; j<G->simatrixN[n] ; j++) {
+      int m = G->simatrixId[row + j];
+      if (m == n)
+	continue;
+      int c = G->cmty[m];
+      if (cmtyNDefined[c] == 0)
+	touched[nTouched++] = c;
+      cmtyNDefined[c]++;
+      if (G->srmatrix == NULL) {
+	imatrix_t interaction = G->simatrix[row + j];
+	if (interaction > 0)
+	  cmtyRepulsions[c]  += interaction;
+	else
+	  cmtyAttractions[c] += interaction;
+      }
+      else {
+	cmtyAttractions[c] += G->simatrix[row + j];
+	cmtyRepulsions[c]  += G->srmatrix[row + j];
+      }
+      if (G->simatrix[row + j] < 0)
+	cmtyCandidate[c] = 1;
+    }
 
     // Store our old community and energy change when we remove a
     // particle from the old community.  We see if (energy from
     // removing from old community + energy from adding to new
     // community) is less than deltaEbest to see where we should move.
-    int oldcmty  = G->cmty[n];
-    double deltaEoldCmty = - energy_cmty_n_sparse(G, gamma, oldcmty, n);
+    // (In overlapping mode G->cmty[m] is only the primary community,
+    // so the sums can't be used and we fall back to the full
+    // calculation.)
+    double deltaEoldCmty;
+    if (G->oneToOne)
+      deltaEoldCmty = - energy_sparse_from_sums(G, gamma,
+				     cmtyAttractions[oldcmty],
+				     cmtyRepulsions[oldcmty],
+				     cmtyNDefined[oldcmty],
+				     sparse_nUnDefined(G, oldcmty, n,
+						       cmtyNDefined[oldcmty], 1));
+    else
+      deltaEoldCmty = - energy_cmty_n_sparse(G, gamma, oldcmty, n);
 
     // Try particle in each new cmty.  Accept the new community
     // that has the lowest new energy.
-    // There are various ways of doing this inner loop:
-
-    SetClear(G->seenList);
-    int j;
-    for(j=0 ; j<G->simatrixN[n] ; j++) {
-      if (G->simatrix[G->simatrixLen*n + j] >= 0)
-      	continue;
-      int m = G->simatrixId[G->simatrixLen*n + j];
-      int newcmty = G->cmty[m];
-
-
+    int i;
+    for (i=0 ; i<nTouched ; i++) {
+      int newcmty = touched[i];
+      if (!cmtyCandidate[newcmty])
+	continue;
       if (newcmty == oldcmty)
 	continue;
       if (G->cmtyN[newcmty] == 0) {
 	continue;
       }
-      if (SetContains(G->seenList, newcmty))
-      	continue;
-      SetAdd(G->seenList, newcmty);
 
-      double deltaEnewCmty = energy_cmty_n_sparse(G, gamma, newcmty, n);
+      double deltaEnewCmty;
+      if (G->oneToOne)
+	deltaEnewCmty = energy_sparse_from_sums(G, gamma,
+				     cmtyAttractions[newcmty],
+				     cmtyRepulsions[newcmty],
+				     cmtyNDefined[newcmty],
+				     sparse_nUnDefined(G, newcmty, n,
+						       cmtyNDefined[newcmty], 0));
+      else
+	deltaEnewCmty = energy_cmty_n_sparse(G, gamma, newcmty, n);
 
       // Our conditional on if we want to move to this new place.  If
       // we do, update our bestcmty and deltaEbest to say so.
@@ -1296,6 +1480,14 @@ int greedy_sparse(Graph_t G, double gamma) {
 	deltaEbest = deltaEoldCmty + deltaEnewCmty;
       }
     }
+    // Reset the sums for the next particle.
+    for (i=0 ; i<nTouched ; i++) {
+      int c = touched[i];
+      cmtyAttractions[c] = 0;
+      cmtyRepulsions[c]  = 0;
+      cmtyNDefined[c]    = 0;
+      cmtyCandidate[c]   = 0;
+    }
     // Is it better to move a particle into an _empty_ community?
     if (deltaEoldCmty < deltaEbest && !G->const_q) {
       bestcmty = find_empty_cmty(G);
@@ -1307,6 +1499,10 @@ int greedy_sparse(Graph_t G, double gamma) {
       changes += 1;
     }
   }
+  free(cmtyAttractions);
+  free(cmtyRepulsions);
+  free(cmtyNDefined);
+  free(cmtyCandidate);
   return (changes);
 }
 
@@ -1572,10 +1768,10 @@ int overlapAdd(Graph_t G, double gamma) {
     // for every neighboring particle of n of particles m
     int nindex;
     for (nindex=0 ; nindex<G->simatrixN[m] ; nindex++) {
-      if (G->simatrix[m*G->simatrixLen + nindex] >= 0)
+      if (G->simatrix[G->simatrixIdx[m] + nindex] >= 0)
 	continue;
       int n;
-      n = G->simatrixIdl[m][nindex];
+      n = G->simatrixId[G->simatrixIdx[m] + nindex];
       if (SetContains(G->seenList, n))
       	continue;
       SetAdd(G->seenList, c);
@@ -1666,19 +1862,17 @@ int overlapRemove2(Graph_t G, double gamma) {
     if (G->cmtyN[c] == 0)
       continue;
 
-    // Loop over particles within that community
-    GHashTableIter hashIter;
-    void *n_p;
-    g_hash_table_iter_init(&hashIter, G->cmtyListHash[c]);
-    while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-      int n = GPOINTER_TO_INT(n_p);
+    // Loop over particles within that community.  Go backwards,
+    // since removal moves the last member into the removed slot.
+    int i;
+    for (i=G->cmtyN[c]-1 ; i>=0 ; i--) {
+      int n = G->cmtyl[c][i];
 
       // Should this be removed from the community?
       double deltaE = energy_cmty_n_which(G, gamma, c, n);
       if (deltaE > 0) {
 	if (DEBUGLISTS) printf("    Removing in ovRemove2 %d %d\n", c, n);
-	g_hash_table_iter_remove(&hashIter);
-	_cmtyListRemoveOverlap(G, c, n);
+	_cmtyListRemoveIdx(G, c, i);
 	G->cmty[n] = NO_CMTY;
 	changes++;
       }
@@ -1877,7 +2071,7 @@ int anneal(Graph_t G, double gamma, double beta,
 	    // accept - null op
 	    Gq += +1;
 	    changes += 1;
-	  move_info[2*3+2] += 1;
+	  move_info[2*3+1] += 1;
 	  }
 	  else { // reject - move all nodes from c2 back to c1.
 	    cmtyMoveAll(G, c2, c1);
@@ -1965,162 +2159,406 @@ int anneal_split_community(Graph_t G, int c, double prob, double beta) {
 
 
 
-int combine(Graph_t G, double gamma) {
-  /* Attempt to merge communities to get a lower energy assignment.
-   * Pairwise attempt to merge all.
-   */
-  if (G->hasSparse) return(combine_sparse(G, gamma));
-  assert(G->oneToOne);
-  assert(G->hasFull);
-  assert(!G->const_q);
-  int changes = 0;
-  // Move particles from c2 into c1
-  int i1, i2, c1, c2;
-  //printf("gamma: %f\n", gamma);
-  /* for (c1=0 ; c1<G->Ncmty-1 ; c1++) { */
-  /*   if (G->cmtyN[c1] == 0) */
-  /*     continue; */
-  /*   int bestcmty = c1; */
-  /*   double deltaEbest = 0; */
-  /*   for (c2=c1+1 ; c2<G->Ncmty ; c2++) { */
-  /*     if (G->cmtyN[c2] == 0) */
-  /* 	continue; */
-  for (i1=0 ; i1<G->N ; i1++) {
-    c1 = G->randomOrder[i1];
-    if (G->cmtyN[c1] == 0)
-      continue;
-
-    int bestcmty = c1;
-    double deltaEbest = 0;
-
-    for (i2=0 ; i2<G->N ; i2++) {
-      c2 = G->randomOrder2[i2];
-      if (c1 <= c2)
-  	continue;
-      if (G->cmtyN[c2] == 0)
-  	continue;
-      /* //double Eold = energy(G, gamma); */
-      /* double Eold = energy_cmty(G, gamma, c1) + energy_cmty(G, gamma, c2);*/
+/*
+ * Community merging.
+ *
+ * combine_neighbors() considers only pairs of communities which are
+ * linked by an interaction (or, with overlaps, share a node).  These
+ * pairs are kept in a community adjacency structure, and merges are
+ * done best-first from a heap of energy changes.  After each merge
+ * the adjacency lists of the two communities are joined, and the
+ * pairs involving the merged community are re-evaluated.
+ */
+#define COMBINE_SUMS    0  /* sparse, oneToOne: deltaE from summed interactions */
+#define COMBINE_DIRECT  1  /* deltaE from energy_cmty_cmty */
+#define COMBINE_OVERLAP 2  /* deltaE from energy_cmty_cmty_xor_sparse */
 
+typedef struct CmtyAdjEntry {
+  int c;
+  double attractions;  // Sums over both directions of all defined
+  double repulsions;   // interactions between the two communities
+  double nDefined;     // (only used for COMBINE_SUMS).
+} CmtyAdjEntry;
+typedef struct CmtyAdj {
+  int n;
+  int cap;
+  CmtyAdjEntry *e;
+} CmtyAdj;
+typedef struct MergeHeapItem {
+  double deltaE;
+  int c1, c2;
+  int v1, v2;  // versions of c1 and c2 when this was pushed.
+} MergeHeapItem;
+typedef struct MergeHeap {
+  int n;
+  int cap;
+  MergeHeapItem *items;
+} MergeHeap;
+
+static CmtyAdjEntry *cmtyAdjAppend(CmtyAdj *adj, int c) {
+  /* Append a new (zeroed) entry for community c to list adj. */
+  if (adj->n == adj->cap) {
+    adj->cap = adj->cap ? 2*adj->cap : 4;
+    adj->e = (CmtyAdjEntry *) realloc(adj->e, adj->cap*sizeof(CmtyAdjEntry));
+  }
+  CmtyAdjEntry *e = &adj->e[adj->n++];
+  e->c = c;
+  e->attractions = e->repulsions = e->nDefined = 0;
+  return (e);
+}
+static int cmtyAdjEntryCompare(const void *a, const void *b) {
+  return (((CmtyAdjEntry *)a)->c - ((CmtyAdjEntry *)b)->c);
+}
+static CmtyAdjEntry *cmtyAdjFind(CmtyAdj *adj, int c) {
+  /* Find community c in a sorted list. */
+  CmtyAdjEntry key;
+  key.c = c;
+  return (CmtyAdjEntry *) bsearch(&key, adj->e, adj->n, sizeof(CmtyAdjEntry),
+				  cmtyAdjEntryCompare);
+}
+
+static void mergeHeapPush(MergeHeap *H, double deltaE, int c1, int c2,
+			  int *version) {
+  if (H->n == H->cap) {
+    H->cap = H->cap ? 2*H->cap : 64;
+    H->items = (MergeHeapItem *) realloc(H->items,
+					 H->cap*sizeof(MergeHeapItem));
+  }
+  int i = H->n++;
+  MergeHeapItem item = {deltaE, c1, c2, version[c1], version[c2]};
+  while (i > 0) {
+    int parent = (i-1) / 2;
+    if (H->items[parent].deltaE <= deltaE)
+      break;
+    H->items[i] = H->items[parent];
+    i = parent;
+  }
+  H->items[i] = item;
+}
+static MergeHeapItem mergeHeapPop(MergeHeap *H) {
+  MergeHeapItem top = H->items[0];
+  MergeHeapItem last = H->items[--H->n];
+  int i = 0;
+  while (1) {
+    int child = 2*i + 1;
+    if (child >= H->n)
+      break;
+    if (child+1 < H->n && H->items[child+1].deltaE < H->items[child].deltaE)
+      child++;
+    if (last.deltaE <= H->items[child].deltaE)
+      break;
+    H->items[i] = H->items[child];
+    i = child;
+  }
+  if (H->n > 0)
+    H->items[i] = last;
+  return (top);
+}
+
+static double combine_deltaE(Graph_t G, double gamma, int mode,
+			     int c1, CmtyAdjEntry *e) {
+  /* Energy change of merging c1 and e->c. */
+  int c2 = e->c;
+  if (mode == COMBINE_SUMS) {
+    double nUnDefined;
+    if (G->nodeWeight == NULL)
+      nUnDefined = 2. * G->cmtyN[c1] * G->cmtyN[c2] - e->nDefined;
+    else
+      nUnDefined = 2. * G->cmtyWeight[c1] * G->cmtyWeight[c2];
+    return energy_sparse_from_sums(G, gamma, e->attractions, e->repulsions,
+				   e->nDefined, nUnDefined);
+  }
+  if (mode == COMBINE_OVERLAP)
+    return (energy_cmty_cmty_xor_sparse(G, gamma, c1, c2)
+	    + energy_cmty_cmty_xor_sparse(G, gamma, c2, c1));
+  return (energy_cmty_cmty(G, gamma, c1, c2)
+	  + energy_cmty_cmty(G, gamma, c2, c1));
+}
+
+static void cmtyAdjBuild(Graph_t G, int mode, CmtyAdj *adj, int *idx) {
+  /* Fill adj[c] with the communities linked to c.  idx must be a
+   * length-N array of -1, and is left that way.
+   */
+  int c, i, j, k;
+  int *nodeCmtyIdx = NULL;
+  int *nodeCmtys = NULL;
+  if (mode == COMBINE_OVERLAP) {
+    // Node -> communities lookup, in CSR form.
+    nodeCmtyIdx = (int *) calloc(G->N+1, sizeof(int));
+    for (c=0 ; c<G->Ncmty ; c++)
+      for (i=0 ; i<G->cmtyN[c] ; i++)
+	nodeCmtyIdx[G->cmtyl[c][i]+1]++;
+    for (i=0 ; i<G->N ; i++)
+      nodeCmtyIdx[i+1] += nodeCmtyIdx[i];
+    nodeCmtys = (int *) malloc(nodeCmtyIdx[G->N]*sizeof(int) + 1);
+    int *fill = G->tmp;
+    for (i=0 ; i<G->N ; i++)
+      fill[i] = nodeCmtyIdx[i];
+    for (c=0 ; c<G->Ncmty ; c++)
+      for (i=0 ; i<G->cmtyN[c] ; i++)
+	nodeCmtys[fill[G->cmtyl[c][i]]++] = c;
+  }
+
+  // Each community collects the interactions from its own nodes
+  // (direction c -> other).
+  for (c=0 ; c<G->Ncmty ; c++) {
+    CmtyAdj *a = &adj[c];
+    for (i=0 ; i<G->cmtyN[c] ; i++) {
+      int n = G->cmtyl[c][i];
+      if (mode == COMBINE_DIRECT) {
+	imatrix_t *row = G->imatrix + n*G->N;
+	for (j=0 ; j<G->N ; j++) {
+	  int c2 = G->cmty[j];
+	  if (row[j] >= 0 || c2 == c || c2 == NO_CMTY)
+	    continue;
+	  if (idx[c2] < 0) {
+	    idx[c2] = a->n;
+	    cmtyAdjAppend(a, c2);
+	  }
+	}
+	continue;
+      }
+      if (mode == COMBINE_OVERLAP) {
+	// Communities sharing node n.
+	for (k=nodeCmtyIdx[n] ; k<nodeCmtyIdx[n+1] ; k++) {
+	  int c2 = nodeCmtys[k];
+	  if (c2 != c && idx[c2] < 0) {
+	    idx[c2] = a->n;
+	    cmtyAdjAppend(a, c2);
+	  }
+	}
+      }
+      int row = G->simatrixIdx[n];
+      for (j=0 ; j<G->simatrixN[n] ; j++) {
+	int m = G->simatrixId[row + j];
+	if (m == n)
+	  continue;
+	if (mode == COMBINE_OVERLAP) {
+	  if (G->simatrix[row + j] >= 0)
+	    continue;
+	  for (k=nodeCmtyIdx[m] ; k<nodeCmtyIdx[m+1] ; k++) {
+	    int c2 = nodeCmtys[k];
+	    if (c2 != c && idx[c2] < 0) {
+	      idx[c2] = a->n;
+	      cmtyAdjAppend(a, c2);
+	    }
+	  }
+	  continue;
+	}
+	// COMBINE_SUMS
+	int c2 = G->cmty[m];
+	if (c2 == c)
+	  continue;
+	if (idx[c2] < 0) {
+	  idx[c2] = a->n;
+	  cmtyAdjAppend(a, c2);
+	}
+	CmtyAdjEntry *e = &a->e[idx[c2]];
+	e->nDefined += 1;
+	if (G->srmatrix == NULL) {
+	  imatrix_t interaction = G->simatrix[row + j];
+	  if (interaction > 0)
+	    e->repulsions  += interaction;
+	  else
+	    e->attractions += interaction;
+	}
+	else {
+	  e->attractions += G->simatrix[row + j];
+	  e->repulsions  += G->srmatrix[row + j];
+	}
+      }
+    }
+    for (i=0 ; i<a->n ; i++)
+      idx[a->e[i].c] = -1;
+    qsort(a->e, a->n, sizeof(CmtyAdjEntry), cmtyAdjEntryCompare);
+  }
+  free(nodeCmtyIdx);
+  free(nodeCmtys);
+
+  // Add the opposite directions together, so that both adj[c1] and
+  // adj[c2] hold the c1 <-> c2 totals.  Links only present in one
+  // direction are added to the other list afterwards.
+  int nMissing = 0, capMissing = 0;
+  CmtyAdjEntry *missing = NULL;  // .c is the list to add to.
+  int *missingFrom = NULL;
+  for (c=0 ; c<G->Ncmty ; c++) {
+    for (i=0 ; i<adj[c].n ; i++) {
+      CmtyAdjEntry *e = &adj[c].e[i];
+      CmtyAdjEntry *f = cmtyAdjFind(&adj[e->c], c);
+      if (f == NULL) {
+	if (nMissing == capMissing) {
+	  capMissing = capMissing ? 2*capMissing : 16;
+	  missing = (CmtyAdjEntry *) realloc(missing,
+					capMissing*sizeof(CmtyAdjEntry));
+	  missingFrom = (int *) realloc(missingFrom, capMissing*sizeof(int));
+	}
+	missing[nMissing] = *e;
+	missingFrom[nMissing] = c;
+	nMissing++;
+      }
+      else if (e->c > c) {
+	e->attractions += f->attractions;
+	e->repulsions  += f->repulsions;
+	e->nDefined    += f->nDefined;
+	*f = *e;
+	f->c = c;
+      }
+    }
+  }
+  for (i=0 ; i<nMissing ; i++) {
+    CmtyAdjEntry *f = cmtyAdjAppend(&adj[missing[i].c], missingFrom[i]);
+    f->attractions = missing[i].attractions;
+    f->repulsions  = missing[i].repulsions;
+    f->nDefined    = missing[i].nDefined;
+  }
+  free(missing);
+  free(missingFrom);
+}
 
-      // Calculate change of energy if we moved c1 into c2
-      double deltaE = 0;
-      deltaE += energy_cmty_cmty(G, gamma, c1, c2);
-      deltaE += energy_cmty_cmty(G, gamma, c2, c1);
+static void cmtyAdjMerge(CmtyAdj *adj, int c1, int c2, int *idx) {
+  /* Join the adjacency of c2 into that of c1 (c2 is being merged
+   * into c1).  idx must be a length-N array of -1, and is left that
+   * way.
+   */
+  int i, j;
+  CmtyAdj *a1 = &adj[c1];
+  CmtyAdj *a2 = &adj[c2];
+  for (i=0 ; i<a1->n ; i++)
+    idx[a1->e[i].c] = i;
+  for (i=0 ; i<a2->n ; i++) {
+    CmtyAdjEntry e = a2->e[i];
+    int x = e.c;
+    if (x == c1)
+      continue;
+    if (idx[x] >= 0) {
+      CmtyAdjEntry *f = &a1->e[idx[x]];
+      f->attractions += e.attractions;
+      f->repulsions  += e.repulsions;
+      f->nDefined    += e.nDefined;
+    }
+    else {
+      idx[x] = a1->n;
+      CmtyAdjEntry *f = cmtyAdjAppend(a1, x);
+      *f = e;
+    }
+    // In the list of x, the entry for c2 becomes (or is added to)
+    // the one for c1.
+    CmtyAdj *ax = &adj[x];
+    int i1=-1, i2=-1;
+    for (j=0 ; j<ax->n ; j++) {
+      if (ax->e[j].c == c1) i1 = j;
+      if (ax->e[j].c == c2) i2 = j;
+    }
+    if (i1 >= 0) {
+      ax->e[i1].attractions += ax->e[i2].attractions;
+      ax->e[i1].repulsions  += ax->e[i2].repulsions;
+      ax->e[i1].nDefined    += ax->e[i2].nDefined;
+      ax->e[i2] = ax->e[--ax->n];
+    }
+    else
+      ax->e[i2].c = c1;
+  }
+  // Remove c2 from the list of c1.
+  if (idx[c2] >= 0) {
+    a1->e[idx[c2]] = a1->e[--a1->n];
+  }
+  for (i=0 ; i<a1->n ; i++)
+    idx[a1->e[i].c] = -1;
+  idx[c2] = -1;
+  free(a2->e);
+  a2->e = NULL;
+  a2->n = a2->cap = 0;
+}
 
-      // Do we accept this change?
-      if (deltaE < deltaEbest) {
-	bestcmty = c2;
-	deltaEbest = deltaE;
-      }
+int combine_neighbors(Graph_t G, double gamma, int mode) {
+  /* Merge communities, best pair first, until no merge of two linked
+   * communities lowers the energy.  Returns the number of merges.
+   */
+  int changes = 0;
+  int c, i;
+  CmtyAdj *adj = (CmtyAdj *) calloc(G->N, sizeof(CmtyAdj));
+  int *version = (int *) calloc(G->N, sizeof(int));
+  int *idx = (int *) malloc(G->N * sizeof(int));
+  for (c=0 ; c<G->N ; c++)
+    idx[c] = -1;
+  MergeHeap H = {0, 0, NULL};
+
+  cmtyAdjBuild(G, mode, adj, idx);
+  for (c=0 ; c<G->Ncmty ; c++) {
+    for (i=0 ; i<adj[c].n ; i++) {
+      CmtyAdjEntry *e = &adj[c].e[i];
+      if (e->c < c)
+	continue;
+      double deltaE = combine_deltaE(G, gamma, mode, c, e);
+      if (deltaE < 0)
+	mergeHeapPush(&H, deltaE, c, e->c, version);
     }
-    // No change
-    if (c1 == bestcmty)
+  }
+
+  while (H.n > 0) {
+    MergeHeapItem item = mergeHeapPop(&H);
+    int c1 = item.c1;
+    int c2 = item.c2;
+    // Skip entries made stale by earlier merges.
+    if (item.v1 != version[c1] || item.v2 != version[c2])
       continue;
-    //Move all from bestcmty into c1
-    cmtyMoveAll(G, bestcmty, c1);
+    // Keep the larger community, fewer nodes to move.
+    if (G->cmtyN[c1] < G->cmtyN[c2]) {
+      int ctmp = c1;  c1 = c2 ; c2 = ctmp;
+    }
+    if (mode == COMBINE_OVERLAP)
+      cmtyMoveAllOverlap(G, c2, c1);
+    else
+      cmtyMoveAll(G, c2, c1);
+    cmtyAdjMerge(adj, c1, c2, idx);
+    version[c1]++;
+    version[c2]++;
     changes += 1;
+    // The size of c1 changed, so all of its pairs need updating.
+    for (i=0 ; i<adj[c1].n ; i++) {
+      CmtyAdjEntry *e = &adj[c1].e[i];
+      double deltaE = combine_deltaE(G, gamma, mode, c1, e);
+      if (deltaE < 0)
+	mergeHeapPush(&H, deltaE, c1, e->c, version);
+    }
   }
+
+  for (c=0 ; c<G->N ; c++)
+    free(adj[c].e);
+  free(adj);
+  free(version);
+  free(idx);
+  free(H.items);
   return (changes);
 }
 
+int combine(Graph_t G, double gamma) {
+  /* Attempt to merge communities to get a lower energy assignment.
+   * Only pairs linked by an attractive interaction are considered.
+   */
+  if (G->hasSparse) return(combine_sparse(G, gamma));
+  assert(G->oneToOne);
+  assert(G->hasFull);
+  assert(!G->const_q);
+  return (combine_neighbors(G, gamma, COMBINE_DIRECT));
+}
 
 int combine_sparse(Graph_t G, double gamma) {
   /* Attempt to merge communities to get a lower energy assignment.
-   * Pairwise attempt to merge all.
+   * Only pairs linked by a defined interaction are considered.
    */
   assert(G->oneToOne);
   assert(G->hasSparse);
   assert(G->hasPrimaryCmty);
   assert(!G->const_q);
-  int changes = 0;
-  // Move particles from c2 into c1
-  //int i1, i2, c1, c2;
-  int c1;
-  //printf("gamma: %f\n", gamma);
-  for (c1=0 ; c1<G->Ncmty-1 ; c1++) {
-    if (G->cmtyN[c1] == 0)
-      continue;
-    int bestcmty = c1;
-    double deltaEbest = 0;
-
-
-  /* for (i1=0 ; i1<G->N ; i1++) { */
-  /*   c1 = G->randomOrder[i1]; */
-  /*   if (G->cmtyN[c1] == 0) */
-  /*     continue; */
-
-  /*   int bestcmty = c1; */
-  /*   double deltaEbest = 0; */
-
-  /*   for (i2=0 ; i2<G->N ; i2++) { */
-  /*     c2 = G->randomOrder2[i2]; */
-  /*     if (c1 <= c2) */
-  /*   	continue; */
-  /*     if (G->cmtyN[c2] == 0) */
-  /*   	continue; */
-      /* //double Eold = energy(G, gamma); */
-      /* double Eold = energy_cmty(G, gamma, c1) + energy_cmty(G, gamma, c2);*/
-
-
-    /* for (c2=c1+1 ; c2<G->Ncmty ; c2++) { */
-    /*   if (G->cmtyN[c2] == 0) */
-    /* 	continue; */
-
-
-    SetClear(G->seenList);
-    GHashTableIter hashIter;
-    void *n_p;
-    g_hash_table_iter_init(&hashIter, G->cmtyListHash[c1]);
-    while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-      int n = GPOINTER_TO_INT(n_p);
-      //printf("n %d %d %d\n", c1, ii, n);
-    int j;
-    for(j=0 ; j<G->simatrixN[n] ; j++) {
-      if (G->simatrix[G->simatrixLen*n + j] >= 0)
-      	continue;
-      int m = G->simatrixId[G->simatrixLen*n + j];
-      int c2 = G->cmty[m];
-      //printf("  m %d %d %d %d\n", c1, j, m, c2);
-      if (c1==c2 || SetContains(G->seenList, c2)) {
-    	//printf("already in: %d\n", c2);
-      	continue;
-      }
-      SetAdd(G->seenList, c2);
-      //printf("adding: %d\n", c2);
-
-
-      // Calculate change of energy if we moved c1 into c2
-      double deltaE = 0;
-      deltaE += energy_cmty_cmty_sparse(G, gamma, c1, c2);
-      deltaE += energy_cmty_cmty_sparse(G, gamma, c2, c1);
-
-      //printf("  e %d %d %f %d %f\n", c1, c2, deltaE, bestcmty, deltaEbest);
-      // Do we accept this change?
-      if (deltaE < deltaEbest) {
-	//printf("better one\n");
-	bestcmty = c2;
-	deltaEbest = deltaE;
-      }
-    } // extra brace
-    }
-    //printf("loop done\n");
-
-    // No change
-    if (c1 == bestcmty)
-      continue;
-    //printf("  c %d %d combining\n", c1, c2);
-    //Move all from bestcmty into c1
-    cmtyMoveAll(G, bestcmty, c1);
-    changes += 1;
-  }
-  return (changes);
+  return (combine_neighbors(G, gamma, COMBINE_SUMS));
 }
 
 
 int combine_sparse_overlap(Graph_t G, double gamma) {
   /* Attempt to merge communities to get a lower energy assignment.
-   * Pairwise attempt to merge all.
+   * Only pairs sharing a node or linked by an attractive interaction
+   * are considered.
    *
    * This version allows the communties to be overlapping.
    */
@@ -2128,70 +2566,7 @@ int combine_sparse_overlap(Graph_t G, double gamma) {
   assert(G->hasSparse);
   assert(!G->const_q);
   //assert(G->hasPrimaryCmty);
-  int changes = 0;
-  // Move particles from c2 into c1
-  //int i1, i2, c1, c2;
-  int c1;
-  //printf("gamma: %f\n", gamma);
-  // For communities c1
-  for (c1=0 ; c1<G->Ncmty-1 ; c1++) {
-    if (G->cmtyN[c1] == 0)
-      continue;
-    int bestcmty = c1;
-    double deltaEbest = 0;
-
-    int c2;
-    for (c2=c1+1 ; c2<G->Ncmty ; c2++) {
-
-    /* SetClear(G->seenList); */
-    /* int ii; */
-    /* // For every neighboring particle n */
-    /* for (ii=0 ; ii<G->cmtyN[c1] ; ii++ ) { */
-    /*   int n = G->cmtyl[c1][ii]; */
-    /*   //printf("n %d %d %d\n", c1, ii, n); */
-    /* int j; */
-    /* // For every interacting particle m of neighboring particles n */
-    /* for(j=0 ; j<G->simatrixN[n] ; j++) { */
-    /*   if (G->simatrix[G->simatrixLen*n + j] >= 0) */
-    /*   	continue; */
-    /*   int m = G->simatrixId[G->simatrixLen*n + j]; */
-    /*   int c2 = G->cmty[m]; */
-    /*   //printf("  m %d %d %d %d\n", c1, j, m, c2); */
-    /*   if (c1==c2 || SetContains(G->seenList, c2)) { */
-    /* 	//printf("already in: %d\n", c2); */
-    /*   	continue; */
-    /*   } */
-    /*   SetAdd(G->seenList, c2); */
-    /*   //printf("adding: %d\n", c2); */
-
-
-
-      // Calculate change of energy if we moved c1 into c2
-      double deltaE = 0;
-      deltaE += energy_cmty_cmty_xor_sparse(G, gamma, c1, c2);
-      deltaE += energy_cmty_cmty_xor_sparse(G, gamma, c2, c1);
-
-      //printf("  e %d %d %f %d %f\n", c1, c2, deltaE, bestcmty, deltaEbest);
-      // Do we accept this change?
-      if (deltaE < deltaEbest) {
-	//printf("better one\n");
-	bestcmty = c2;
-	deltaEbest = deltaE;
-      }
-    /* } // extra brace */
-    }
-    //printf("loop done\n");
-
-    // No change
-    if (c1 == bestcmty)
-      continue;
-    //printf("  c %d %d combining\n", c1, c2);
-
-
-    cmtyMoveAllOverlap(G, bestcmty, c1);
-    changes += 1;
-  }
-  return (changes);
+  return (combine_neighbors(G, gamma, COMBINE_OVERLAP));
 }
 
 
@@ -2241,12 +2616,11 @@ int combine_singletons(Graph_t G, int minsize) {
       continue;
     //assert(0);
     //printf("Singleton: %d\n", oldcmty);
-    GHashTableIter hashIter;
-    void *n_p;
-    g_hash_table_iter_init(&hashIter, G->cmtyListHash[oldcmty]);
-    while (g_hash_table_iter_next(&hashIter, &n_p, NULL)) {
-      // Iterate through all nodes in the community...
-      int n = GPOINTER_TO_INT(n_p);
+    int i;
+    for (i=G->cmtyN[oldcmty]-1 ; i>=0 ; i--) {
+      // Iterate through all nodes in the community (backwards, since
+      // moved nodes are swap-removed)...
+      int n = G->cmtyl[oldcmty][i];
       int bestCmty = oldcmty;
       double bestDensity=0.0;
       //printf("n: %d\n", n);
@@ -2270,8 +2644,7 @@ int combine_singletons(Graph_t G, int minsize) {
       if (bestCmty != oldcmty) {
 	//printf("moving: %d %d %d\n", n, oldcmty, bestCmty);
 	//cmtyMove(G, n, oldcmty, bestcmty);
-	g_hash_table_iter_remove(&hashIter);
-	_cmtyListRemoveOverlap(G, oldcmty, n);
+	_cmtyListRemoveIdx(G, oldcmty, i);
 	//G->cmtyN[oldcmty]--;
 	//G->cmty[n] = bestCmty;
 	cmtyListAdd(G, bestCmty, n);
@@ -1,7 +1,5 @@
 /* Richard Darst, July 2011 */
 
-#include <glib.h>
-
 #include "imatrix_t.h"
 
 typedef IMATRIX_T imatrix_t;
@@ -28,14 +26,18 @@ typedef struct Graph {
   int *linklist_idx;
   int *linklistN;
 
-  /* For sparse implementation */
+  /* For sparse implementation.  Interactions of node n are stored
+   * in compressed sparse row form: entries simatrixIdx[n] ...
+   * simatrixIdx[n]+simatrixN[n]-1 of simatrix/srmatrix/simatrixId.
+   * simatrixLen is the fixed row width if the arrays are padded, or
+   * zero for packed CSR arrays. */
   int hasSparse;
   int hasFull;
   imatrix_t *simatrix;
   int simatrixLen;
   int *simatrixN;
   int *simatrixId;
-  int **simatrixIdl;
+  int *simatrixIdx;
   imatrix_t simatrixDefault;
   imatrix_t *srmatrix;
   /* int srmatrixLen; */
@@ -45,26 +47,47 @@ typedef struct Graph {
   imatrix_t srmatrixDefault;
   imatrix_t srmatrixDefaultOnlyDefined;
 
-  //int **cmtyl;
-  //int  *cmtyll;
   int *cmtyN;
   int *randomOrder;
   int *randomOrder2;
   int *tmp;
 
-  //LList_t seenList;
-  GHashTable *seenList;
-  GHashTable **cmtyListHash;
+  struct Set *seenList;
+  /* Community member lists: cmtyl[c][0] ... cmtyl[c][cmtyN[c]-1] are
+   * the nodes of community c, in no particular order, and cmtylCap[c]
+   * is the allocated length of cmtyl[c].  cmtylPos[n] is the index of
+   * node n in the list it was last added to.  In the oneToOne case
+   * that is its only community, so removal is an O(1) swap with the
+   * last member.  cmtyBits[c] are membership bitmaps for the
+   * overlapping case, built on demand by isInCmty (NULL otherwise).
+   * Lists made by cmtyListCopy all live in the single block
+   * cmtylPool (of cmtylPoolSize ints) until they need to grow. */
+  int **cmtyl;
+  int *cmtylCap;
+  int *cmtylPos;
+  unsigned char **cmtyBits;
+  int *cmtylPool;
+  int cmtylPoolSize;
+
+  /* Optional node weights for the sparse default interactions (NULL
+   * if unused).  If set, the default interaction between nodes n and
+   * m is counted nodeWeight[n]*nodeWeight[m] times, and the stored
+   * sparse interactions must already have the default subtracted
+   * (and srmatrixDefaultOnlyDefined must be 0).  cmtyWeight[c] is the
+   * sum of nodeWeight over community c, kept up to date by the
+   * community list functions. */
+  double *nodeWeight;
+  double *cmtyWeight;
 
   } *Graph_t;
 
-void hashInit(Graph_t G);
-inline int cmtyListIsInCmty(Graph_t G, int c, int n);
+int isInCmty(Graph_t G, int c, int n);
 
 double energy(Graph_t G, double gamma);
 double energy_cmty(Graph_t G, double gamma, int c);
 double energy_cmty_n(Graph_t G, double gamma, int c, int n);
 double energy_cmty_n_sparse(Graph_t G, double gamma, int c, int n);
+double energy_cmty_cmty_sparse(Graph_t G, double gamma, int c1, int c2);
 
 double energy_sparse(Graph_t G, double gamma);
 int greedy_sparse(Graph_t G, double gamma);
@@ -73,44 +96,38 @@ int combine_sparse(Graph_t G, double gamma);
 
 
 
-/* inline void SetAdd(LList_t lst, int value) { */
-/*   if (lst->count >= lst->maxcount) { */
-/*     return ; // We are already full, silently ignore adding it. */
-/*   } */
-/*   lst->data[lst->count] = value ; */
-/*   lst->count ++; */
-/* } */
-/* inline int SetContains(LList_t lst, int value) { */
-/*   int i = lst->count; */
-/*   //printf("Doing LlistLookup: n:%d\n", llist->n); */
-/*   while (i--) { */
-/*     //printf(" ..LlistLookup: %d %d\n", llist->n, i); */
-/*     if (lst->data[i] == value) */
-/*       return 1; */
-/*   } */
-/*   return 0; */
-/* } */
-/* void SetClear(LList_t lst) { */
-/*   lst->count = 0; */
-/* } */
-inline void SetAdd(GHashTable *HT, int value) {
-  g_hash_table_insert(HT,
-		      GINT_TO_POINTER(value),
-		      NULL
-		      );
-}
-inline int SetContains(GHashTable *HT, int value) {
+/* Set of small non-negative integers (node or community indexes).
+ * An entry is in the set if its stamp equals the current generation,
+ * so clearing is O(1). */
+typedef struct Set {
+  int size;
+  int generation;
+  int *stamps;
+} *Set_t;
 
-  int found = g_hash_table_lookup_extended(HT, GINT_TO_POINTER(value),
-					   NULL, NULL);
-  return(found);
+inline void SetAdd(Set_t S, int value) {
+  S->stamps[value] = S->generation;
+}
+inline int SetContains(Set_t S, int value) {
+  return (S->stamps[value] == S->generation);
 }
-void SetClear(GHashTable *HT) {
-  g_hash_table_remove_all(HT);
+void SetClear(Set_t S) {
+  S->generation++;
+  if (S->generation == 0x7fffffff) {
+    int i;
+    for (i=0 ; i<S->size ; i++)
+      S->stamps[i] = 0;
+    S->generation = 1;
+  }
 }
-GHashTable *SetInit() {
-  return (g_hash_table_new(g_direct_hash, g_direct_equal));
+Set_t SetInit(int size) {
+  Set_t S = (Set_t) malloc(sizeof(struct Set));
+  S->size = size;
+  S->generation = 1;
+  S->stamps = (int *) calloc(size, sizeof(int));
+  return (S);
 }
-void SetDestroy(GHashTable *HT) {
-  g_hash_table_destroy(HT);
+void SetDestroy(Set_t S) {
+  free(S->stamps);
+  free(S);
 }
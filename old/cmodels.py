@@ -1,6 +1,7 @@
 # Richard Darst, July 2011
 
 import ctypes
+import mmap
 import numpy
 from numpy.ctypeslib import ndpointer
 import os
@@ -58,6 +59,29 @@ class _cobj(object):
                     ctypes.POINTER(getattr(self._struct, name)._type_,)
                     ))
         #setattr(self._struct, name, array.ctypes.data)
+    def _shareArrays(self, names):
+        """Move arrays into shared memory.
+
+        Each array self.`name` (which must already exist) is copied
+        into an anonymous shared mmap and re-pointed there.  Child
+        processes forked afterwards see the same physical memory, so
+        large read-only arrays are not duplicated per process.  Arrays
+        that are already shared are left alone.
+        """
+        for name in names:
+            array = self.__dict__.get(name)
+            if array is None or array.nbytes == 0:
+                continue
+            base = array
+            while isinstance(base, numpy.ndarray):
+                base = base.base
+            if isinstance(base, mmap.mmap):
+                continue
+            buf = mmap.mmap(-1, array.nbytes)
+            shared = numpy.frombuffer(buf, dtype=array.dtype)
+            shared = shared.reshape(array.shape)
+            shared[...] = array
+            self._allocArray(name, array=shared)
     def _allocArrayPointers(self, pointerarray, array):
         for i, row in enumerate(array):
             pointerarray[i] = row.ctypes.data
@@ -126,7 +150,7 @@ cGraph._fields_ = [
     ('simatrixLen',  c_int),
     ('simatrixN',    c_int_p),
     ('simatrixId',   c_int_p),
-    ('simatrixIdl',  ctypes.POINTER(c_int_p)),
+    ('simatrixIdx',  c_int_p),
     ("simatrixDefault", imatrix_t),
     ("srmatrix",     imatrix_t_p),
     #('srmatrixLen',  c_int),
@@ -145,7 +169,16 @@ cGraph._fields_ = [
 
     #("seenList",     LList_p),
     ("seenList",     c_void_p),
-    ("cmtyListHash", c_void_p),
+    # Community member lists, allocated and owned by C (cmtyListCreate).
+    ("cmtyl",        c_void_p),
+    ("cmtylCap",     c_void_p),
+    ("cmtylPos",     c_void_p),
+    ("cmtyBits",     c_void_p),
+    ("cmtylPool",    c_void_p),
+    ("cmtylPoolSize",c_int),
+
+    ("nodeWeight",   c_double_p),
+    ("cmtyWeight",   c_double_p),
 
     #("callback", Callback),   # callback to let us get python shell from C
     #("S", ctypes.py_object),  # Pointer for function above
@@ -158,14 +191,13 @@ for name, t in cGraph._fields_:
 
 cfuncs = (
     ("test",             c_int,     (cGraph_p, )),
-    ("gThreadInit",      None,      ( )),
 
-    ("hashInit",         None,      (cGraph_p, )),
-    ("hashClear",        None,      (cGraph_p, )),
-    ("hashDestroy",      None,      (cGraph_p, )),
-    ("hashCreate",       c_int,     (cGraph_p, )),
+    ("cmtyListCreate",   None,      (cGraph_p, )),
+    ("cmtyListDestroy",  None,      (cGraph_p, )),
+    ("cmtyListClear",    None,      (cGraph_p, )),
+    ("cmtyListCopy",     None,      (cGraph_p, cGraph_p)),
 
-    ("SetInit",          c_void_p, ( )),
+    ("SetInit",          c_void_p, (c_int, )),
     ("SetDestroy",       None,     (c_void_p, )),
 
     ("cmtyListInit",     None,      (cGraph_p, )),
@@ -183,6 +215,10 @@ cfuncs = (
     ("cmtyUnion",        c_int,     (cGraph_p, c_int, cGraph_p, c_int)),
     ("cmtyIsSubset",     c_int,     (cGraph_p, c_int, c_int)), # csmall, cbig
     ("cmtyGetContents",  c_int,     (cGraph_p,c_int,c_int_p,c_int_p)),#c,tmp,cN
+    ("cmtyGetContentsAll",
+                         c_int,     (cGraph_p, c_int_p)), # members
+    ("cmtySetContentsAll",
+                         c_int,     (cGraph_p, c_int, c_int_p, c_int_p)),
 
 
 
@@ -208,6 +244,8 @@ cfuncs = (
     ("energy_cmty_cmty", c_double, (cGraph_p, c_double, c_int, c_int)),
     ("energy_cmty_cmty_sparse",
                       c_double, (cGraph_p, c_double, c_int, c_int)),
+    ("energy_cmty_cmty_xor_sparse",
+                      c_double, (cGraph_p, c_double, c_int, c_int)),
     ("energy_n",      c_double, (cGraph_p, c_double, c_int)),
 
     ("edgecount_cmty_n", c_int, (cGraph_p, c_int, c_int)),
@@ -253,8 +291,3 @@ for name, restype, argtypes in cfuncs:
 
 C.init_gen_rand.restype = None
 C.init_gen_rand(random.randrange(2**32-1))
-
-
-
-
-C.gThreadInit()
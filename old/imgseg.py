@@ -3,15 +3,21 @@
 
 import collections
 import colorsys
+import copy
+import itertools
 import math
+import multiprocessing
 import numpy
 #import numpy.fft
+import random
 import scipy.misc
 import scipy.ndimage
 import sys
 import time
 
-from pcd import Graph, MultiResolution
+from pcd.old import cmodels
+from pcd.old.models import Graph
+from pcd.old.multiresolution import MultiResolution
 import pcd.util
 
 vrgb_to_hsv = numpy.vectorize(colorsys.rgb_to_hsv)
@@ -63,6 +69,13 @@ def replace_channels(R, G, B, channels):
             V = numpy.clip(V,a_min=V[1],a_max=V[2])
         #V = numpy.clip(channels['V'],a_min=.9,a_max=.9)
     return vhsv_to_rgb(H,S,V)
+def _blockmean(a):
+    """Mean over the last two (block) axes of a."""
+    return a.reshape(a.shape[:-2]+(-1,)).mean(axis=-1)
+def _blocksum(a):
+    """Sum over the last two (block) axes of a."""
+    return a.reshape(a.shape[:-2]+(-1,)).sum(axis=-1)
+
 def dict_to_array(d, shape=None, keys=None):
     yLow = min(k[0] for k in d.keys())
     xLow = min(k[1] for k in d.keys())
@@ -196,12 +209,18 @@ class Image(object):
 
 
     def getCmtyMap(self, G, I, map_=None, overlay_img=True):
+        """Image with hue by community.
 
+        Communities come from G, or if G is None, from map_: either a
+        dict (y,x) -> cmty or an array of communities with the shape
+        of the image (as returned by ImgSeg.segment_tiled)."""
         # Make and print community map.
         cmtys = I._newarr(dtype=int)
         if G is not None:
             for node in I.iterCoords():
                 cmtys[node] = G.cmty[G._nodeIndex[node]]
+        elif isinstance(map_, numpy.ndarray):
+            cmtys[:] = map_
         elif map_ is not None:
             for k, v in map_.iteritems():
                 cmtys[k] = v
@@ -266,7 +285,7 @@ class ImgSeg(object):
         self.corrlength = corrlength
         #self.cutoff = cutoff
         #self.Vbar = Vbar
-        if options.exp_beta is not None:
+        if exp_beta is not None:
             self.exp_beta = exp_beta
         else:
             self.exp_beta = 1
@@ -361,6 +380,8 @@ class ImgSeg(object):
         return 1.
 
     # All of these outer-functions should have lower = more attractive.
+    # They reduce over the last two axes, so they can be applied to
+    # whole arrays of blocks at once (see arrayweights).
 
     # Method 'intensity-cutoff': intensity, cutoff.  Set width=0 or
     # else it will use a mean.
@@ -368,12 +389,12 @@ class ImgSeg(object):
         return a
     def outer_intensitycutoff(self, a1, a2):
         """-1 if mean of differences is < self.cutoff, else 0"""
-        return -(numpy.mean(numpy.abs(a1-a2)) < self.cutoff).astype(numpy.int_)
+        return -(_blockmean(numpy.abs(a1-a2)) < self.cutoff).astype(numpy.int_)
     # Method 'intensity': Intensity, continuous.  Set width=0 or else it will
     # use a mean of the local block.
     def outer_intensityavg(self, a1, a2):
         """Mean of absolute values of differences."""
-        return numpy.mean(numpy.abs(a1-a2)) - 1
+        return _blockmean(numpy.abs(a1-a2)) - 1
 
     ## Method 2: average intensity differences between blocks
     #@staticmethod
@@ -448,11 +469,11 @@ class ImgSeg(object):
     @staticmethod
     def outer_FFT_conj_sum(a1, a2):
         """This is the method in the paper."""
-        return - numpy.sum(numpy.abs((a1.conj() * a2).flat))
+        return - _blocksum(numpy.abs(a1.conj() * a2))
     @staticmethod
     def outer_FFT_conj_mean(a1, a2):
         """This is my mis-implementation of the method in the paper."""
-        return - numpy.mean(numpy.abs((a1.conj() * a2).flat))
+        return - _blockmean(numpy.abs(a1.conj() * a2))
     # Method 3b: frequency domain
     @staticmethod
     def inner_FFT_paper(a):
@@ -461,7 +482,7 @@ class ImgSeg(object):
     @staticmethod
     def outer_FFT_absdiff(a1, a2):
         """FFT - difference of absolute values"""
-        return numpy.mean(numpy.abs(numpy.abs(a1)-numpy.abs(a2)))
+        return _blockmean(numpy.abs(numpy.abs(a1)-numpy.abs(a2)))
 
 
     #@staticmethod
@@ -595,7 +616,7 @@ class ImgSeg(object):
 
     @property
     def N(self):
-        return (self.Ly-width*2) * (self.Lx-width*2)
+        return (self.Ly-self.width*2) * (self.Lx-self.width*2)
     def iterCoords(self):
         for y in range(self.width, self.Ly-self.width):
             for x in range(self.width, self.Lx-self.width):
@@ -668,6 +689,73 @@ class ImgSeg(object):
         #    print k, numpy.mean(v), numpy.std(v)
         print
 
+    def offsets(self):
+        """Neighbor offsets (dy, dx) and their distance weights.
+
+        The distance weight only depends on the offset, so it is
+        computed here once instead of once per pixel pair.  Returns
+        a list of (dy, dx, dist_weight) in the order of iterAdjCoords.
+        """
+        corrlength = self.corrlength
+        offsets = [ ]
+        for dy in range(-corrlength, corrlength+1):
+            for dx in range(-corrlength, corrlength+1):
+                if dy == 0 and dx == 0:
+                    continue
+                d = math.sqrt(dy*dy + dx*dx)
+                offsets.append((dy, dx, self.dist_func(d)))
+        return offsets
+
+    def arrayweights(self):
+        """Vectorized version of iterweights.
+
+        Returns (rows, cols, weights, rweights) arrays suitable for
+        Graph.from_pairs, with node indexes in iterCoords order
+        (rweights is None unless self.rweights).  For each neighbor
+        offset, outer_func is applied to the whole array of blocks and
+        the array of blocks shifted by that offset, so there is no
+        per-pair python loop.
+        """
+        blocks = self.blocks()
+        outer_func = self.outer_func
+        width = self.width
+        Ly, Lx = self.Ly, self.Lx
+        ny, nx = Ly-2*width, Lx-2*width
+        index = numpy.arange(ny*nx).reshape(ny, nx)
+        rows, cols, weights, rweights = [ ], [ ], [ ], [ ]
+        for dy, dx, dist_weight in self.offsets():
+            # Same neighbor bounds as iterAdjCoords: the neighbor
+            # must lie in [width, L-width-1).
+            y0, y1 = max(width, width-dy), min(Ly-width, Ly-width-1-dy)
+            x0, x1 = max(width, width-dx), min(Lx-width, Lx-width-1-dx)
+            if y1 <= y0 or x1 <= x0:
+                continue
+            a1 = blocks[y0:y1, x0:x1]
+            a2 = blocks[y0+dy:y1+dy, x0+dx:x1+dx]
+            fweight = numpy.asarray(outer_func(a1, a2), dtype=numpy.float64)
+            weights.append((fweight * dist_weight).ravel())
+            rows.append(index[y0-width:y1-width, x0-width:x1-width].ravel())
+            cols.append(index[y0+dy-width:y1+dy-width,
+                              x0+dx-width:x1+dx-width].ravel())
+            if self.rweights:
+                rweights.append(numpy.repeat(dist_weight**self.exp_beta,
+                                             rows[-1].size))
+        if rows:
+            rows = numpy.concatenate(rows)
+            cols = numpy.concatenate(cols)
+            weights = numpy.concatenate(weights)
+        else:
+            rows = cols = numpy.zeros(0, dtype=int)
+            weights = numpy.zeros(0)
+        rweights = numpy.concatenate(rweights) if self.rweights else None
+
+        counts = numpy.bincount(rows, minlength=ny*nx)
+        sums = numpy.bincount(rows, weights=weights, minlength=ny*nx)
+        self.mean_conn = mean_conn = self._newarr()
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean_conn[self.mask] = (sums / counts).reshape(ny, nx)
+        return rows, cols, weights, rweights
+
     #def mean_weight(self):
     #    numpy.mean([numpy.mean(connections.values())
     #                for connections in self.weights.values()])
@@ -682,16 +770,15 @@ class ImgSeg(object):
     def G(self):
         if hasattr(self, "_G"):
             return self._G
-        maxconn = (2*self.corrlength +1)**2
-        kwargs = { }
-        if self.rweights:
-            kwargs['rmatrix'] = True
-        self._G = Graph.from_sparseiter(nodes=self.iterCoords(),
-                                        weights=self.iterweights(),
-                                        default=self.defaultweight,
-                                        maxconn=maxconn,
-                                        **kwargs
-                                        )
+        rows, cols, weights, rweights = self.arrayweights()
+        self._G = Graph.from_pairs(self.N, rows, cols, weights,
+                                   default=self.defaultweight,
+                                   rweights=rweights)
+        self._G._nodeIndex = nodeIndex = { }
+        self._G._nodeLabel = nodeLabel = { }
+        for i, coords in enumerate(self.iterCoords()):
+            nodeIndex[coords] = i
+            nodeLabel[i] = coords
         if self._realVTmode is not None:
             self._G.enableVT(self._realVTmode)
         if self.shift:
@@ -827,6 +914,138 @@ class ImgSeg(object):
         print "Plotting cmtys."
         fullimg.plotCmtys(fname, G, self, self.overlay)
 
+    def tiles(self, tilesize, overlap):
+        """Split the active region into tiles.
+
+        Returns a list of (core, region) tuples in raster order, each
+        a (y0, y1, x0, x1) bound in image coordinates.  The cores
+        partition the active region (self.mask), and each region is
+        its core extended by `overlap` pixels on all sides (clipped to
+        the active region)."""
+        width = self.width
+        Ly, Lx = self.Ly, self.Lx
+        tiles = [ ]
+        for y0 in range(width, Ly-width, tilesize):
+            y1 = min(y0+tilesize, Ly-width)
+            for x0 in range(width, Lx-width, tilesize):
+                x1 = min(x0+tilesize, Lx-width)
+                region = (max(y0-overlap, width), min(y1+overlap, Ly-width),
+                          max(x0-overlap, width), min(x1+overlap, Lx-width))
+                tiles.append(((y0, y1, x0, x1), region))
+        return tiles
+
+    def subimage(self, region):
+        """ImgSeg of the same configuration on part of the image.
+
+        region is (y0, y1, x0, x1) of the active pixels wanted.  The
+        width margin around it is included, so the blocks of these
+        pixels are the same as in self."""
+        y0, y1, x0, x1 = region
+        width = self.width
+        I = copy.copy(self)
+        for name in ('_blocks', '_G', 'mean_blocks', 'mean_conn'):
+            I.__dict__.pop(name, None)
+        I.img = self.img[y0-width:y1+width, x0-width:x1+width]
+        I.Ly, I.Lx = I.img.shape
+        I.setup()
+        return I
+
+    def segment_tiled(self, gamma, tilesize=256, overlap=None, trials=5,
+                      processes=None, **kwargs):
+        """Segment the image in overlapping tiles.
+
+        The Graph of each tile (core plus `overlap` pixels, default
+        2*corrlength, on each side, see tiles()) is built and minimized
+        independently with G.trials(gamma, trials, **kwargs), in
+        `processes` worker processes if given.  Only one tile Graph per
+        process exists at a time, so peak memory is set by tilesize,
+        not by the image size.  Each tile is minimized with its own
+        random seed, so the result does not depend on `processes`.
+
+        Tiles are stitched in raster order.  Each community of a tile
+        is matched to the already-labeled community it overlaps the
+        most in the overlap band (if that covers at least half of its
+        band pixels; each label is matched at most once), or else gets
+        a new label.  Each tile then labels its own core.
+
+        Returns an int array of the image shape with the community of
+        each active pixel, suitable for getCmtyMap(None, I, map_=...).
+        """
+        global _tiled_imgseg
+        if overlap is None:
+            overlap = 2*self.corrlength
+        kwargs.setdefault('minimizer', 'greedy2')
+        kwargs.setdefault('maxrounds', 25)
+        tiles = self.tiles(tilesize, overlap)
+        args = [(region, gamma, trials, kwargs, random.randrange(2**31-1))
+                for core, region in tiles]
+        labels = self._newarr(dtype=int)
+        labels[:] = -1
+        _tiled_imgseg = self
+        if processes:
+            pool = multiprocessing.Pool(processes=processes)
+            results = pool.imap(_tiled_worker, args)
+        else:
+            pool = None
+            results = itertools.imap(_tiled_worker, args)
+        try:
+            n_labels = 0
+            for (core, region), tlabels in itertools.izip(tiles, results):
+                n_labels = self._stitch(labels, core, region, tlabels,
+                                        n_labels)
+        finally:
+            _tiled_imgseg = None
+            if pool is not None:
+                pool.close()
+                pool.join()
+        labels[labels < 0] = 0
+        return labels
+
+    @staticmethod
+    def _stitch(labels, core, region, tlabels, n_labels):
+        """Merge the tile communities tlabels into labels (in place).
+
+        Returns the new number of labels used."""
+        y0, y1, x0, x1 = region
+        old = labels[y0:y1, x0:x1]
+        band = old >= 0
+        tlabels = numpy.unique(tlabels, return_inverse=True)[1]\
+                  .reshape(tlabels.shape)
+        nt = tlabels.max() + 1
+        mapping = numpy.empty(nt, dtype=int)
+        mapping[:] = -1
+        if band.any():
+            # Contingency of (tile cmty, existing label) in the band.
+            t, o = tlabels[band], old[band]
+            pairs, counts = numpy.unique(t*n_labels + o, return_counts=True)
+            band_sizes = numpy.bincount(t, minlength=nt)
+            used = set()
+            for i in numpy.argsort(-counts, kind='mergesort'):
+                c, l = divmod(pairs[i], n_labels)
+                if mapping[c] >= 0 or l in used:
+                    continue
+                if 2*counts[i] >= band_sizes[c]:
+                    mapping[c] = l
+                    used.add(l)
+        new = mapping < 0
+        mapping[new] = numpy.arange(n_labels, n_labels+new.sum())
+        n_labels += new.sum()
+        cy0, cy1, cx0, cx1 = core
+        labels[cy0:cy1, cx0:cx1] = mapping[tlabels[cy0-y0:cy1-y0,
+                                                   cx0-x0:cx1-x0]]
+        return n_labels
+
+    def do_tiled(self, fname, gamma, tilesize=256, overlap=None,
+                 processes=None):
+        print "Doing tiled minimization"
+        labels = self.segment_tiled(gamma, tilesize=tilesize,
+                                    overlap=overlap, processes=processes)
+        print "Plotting cmtys."
+        cmtyimg = fullimg.getCmtyMap(None, self, map_=labels)
+        if self.overlay:
+            cmtyimg.compose(self.overlay)
+        cmtyimg.save(fname)
+
     def do(self, basename, gammas=None, replicas=3, trials=2,
            threads=6):
         """Do a full MR."""
@@ -865,6 +1084,26 @@ class ImgSeg(object):
         MR.plot(basename+'-MR.png')
         MR.write(basename+'-MR.txt')
 
+# Set by ImgSeg.segment_tiled in the parent process and inherited by
+# forked workers.
+_tiled_imgseg = None
+def _tiled_worker(args):
+    """Segment one tile, returning its communities as an array."""
+    region, gamma, trials, kwargs, seed = args
+    cmodels.C.init_gen_rand(seed)
+    random.seed(seed)
+    numpy.random.seed(seed)
+    I = _tiled_imgseg.subimage(region)
+    G = I.G()
+    G.verbosity = -1
+    G.trials(gamma, trials, **kwargs)
+    y0, y1, x0, x1 = region
+    tlabels = numpy.empty((y1-y0, x1-x0), dtype=int)
+    width = I.width
+    for node, i in G._nodeIndex.iteritems():
+        tlabels[node[0]-width, node[1]-width] = G.cmty[i]
+    return tlabels
+
 def img_to_pixbuf(img):
     import gtk
 
@@ -1414,6 +1653,8 @@ if __name__ == "__main__":
     parser.add_option("--exp_beta", type=float, help="beta<1 biases towards closer.")
     parser.add_option("--blur", type=float, default=0, help="guassian blur block matrix.")
     parser.add_option("--overlap", action="store_true", help="Allow community overlaps.")
+    parser.add_option("--tile", type=int, help="Segment in tiles of this size (single gamma only).")
+    parser.add_option("--tile-overlap", type=int, help="Overlap between tiles (default 2*corrlength).")
     options, args = parser.parse_args()
 
 
@@ -1472,10 +1713,11 @@ if __name__ == "__main__":
 
     #I.blocks()
 
-    G = I.G()
-    #from fitz import interactnow
+    if not options.tile:
+        G = I.G()
+        #from fitz import interactnow
 
-    I.do_stats(basename=basename)
+        I.do_stats(basename=basename)
 
     #if options.VT:
     #    print "Enabling variable topology..."
@@ -1508,7 +1750,11 @@ if __name__ == "__main__":
         print "Aborting, --dry-run enabled"
         sys.exit(0)
 
-    if isinstance(gammas, (float, int)):
+    if options.tile and isinstance(gammas, (float, int)):
+        I.do_tiled(basename+'_gamma%09.5f.png'%gammas, gammas,
+                   tilesize=options.tile, overlap=options.tile_overlap,
+                   processes=options.threads)
+    elif isinstance(gammas, (float, int)):
         I.do_gamma(basename+'_gamma%09.5f.png'%gammas, gammas)
     else:
         I.do(basename=basename, gammas=gammas, trials=options.trials,
@@ -1,11 +1,13 @@
 # Richard Darst, July 2011
 
+import array
 import collections
 import copy
 import ctypes
 import itertools
 import math
 from math import exp, log, floor, ceil
+import multiprocessing
 import numpy
 import operator
 import cPickle as pickle
@@ -45,6 +47,14 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
     """
     verbosity = 2
     _use_overlap = False
+    # Interaction arrays.  These are never modified by minimization,
+    # so copies (and worker processes) share them.
+    _readonly_arrays = ('imatrix', 'rmatrix',
+                        'simatrix', 'srmatrix',
+                        'simatrixN', 'simatrixId', 'simatrixIdx',
+                        'nodeWeight')
+    # Arrays which cmtyListCopy fills in.
+    _cmtylist_arrays = ('cmty', 'cmtyN', 'cmtyWeight')
 
     def __init__(self, N, randomize=True, rmatrix=False, overlap=False,
                  sparse=False):
@@ -83,11 +93,11 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         #seenList = cmodels.LList(N)
         #self.seenList = ctypes.pointer(seenList)
         #self.__dict__['seenList'] = seenList
-        self._struct.seenList = cmodels.C.SetInit()
-        cmodels.C.hashCreate(self._struct_p)
+        self._struct.seenList = cmodels.C.SetInit(N)
+        cmodels.C.cmtyListCreate(self._struct_p)
         self.cmtyCreate(randomize=randomize)
     def __del__(self):
-        cmodels.C.hashDestroy(self._struct_p)
+        cmodels.C.cmtyListDestroy(self._struct_p)
         cmodels.C.SetDestroy(self._struct.seenList)
     def _fillStruct(self, N=None, sparse=False):
         """Fill C structure."""
@@ -105,8 +115,6 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         self.randomOrder2[:] = numpy.arange(N)
         if not sparse:
             self._allocArray("imatrix", shape=(N, N))
-        self._allocArray('cmtyListHash', shape=N, dtype=cmodels.c_void_p,
-                        dtype2=cmodels.c_void_p)
     @classmethod
     def from_param(cls, instance):
         """Argument conversion classmethod for ctypes"""
@@ -123,7 +131,6 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         state = self.__dict__.copy()
         del state['_struct']
         del state['_struct_p']
-        del state['cmtyListHash']
         state['__extra_attrs'] = { }
         for name, type_ in self._struct._fields_:
             val = getattr(self, name)
@@ -156,75 +163,104 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         del state['__extra_attrs']
         cmtystate = state.pop('cmtystate')
         self.__dict__.update(state)
-        self._allocArray('cmtyListHash', shape=self.N, dtype=cmodels.c_void_p,
-                        dtype2=cmodels.c_void_p)
-        cmodels.C.hashCreate(self._struct_p)
-        cmodels.C.hashInit(self._struct_p)
-        self._struct.seenList = cmodels.C.SetInit()
         self.setcmtystate(cmtystate)
     def copy(self):
-        """Return a copy of the object (not sharing data arrays).
+        """Return a copy of the object.
+
+        The interaction arrays (_readonly_arrays) are shared with the
+        copy, other struct arrays are copied, and the community lists
+        are duplicated in C by cmtyListCopy.  Other attributes are
+        shallow copies, so if you change mutable objects it will
+        change on all objects!
         """
-        # Right now we turn this into a string and back, in order to
-        # make actual deep copies of all the arrays.  FIXME.
+        # Old way, through pickling (slow, re-creates everything):
         #new = pickle.loads(pickle.dumps(self, -1))
-        # Better way, sharing some data structures.  This means we
-        # just have a shallow copy, so if you change mutable objects
-        # it will change on all objects!
         new = self.__new__(self.__class__)
-        state = self.__getstate__()
+        new.__dict__.update(self.__dict__)
+        new._struct = cmodels.cGraph.from_buffer_copy(self._struct)
+        new._struct_p = ctypes.pointer(new._struct)
         for name, type_ in self._struct._fields_:
-            if name in state and isinstance(state[name], numpy.ndarray) \
-                   and name not in ('imatrix', 'rmatrix',
-                                    'simatrix', 'srmatrix',
-                                    'simatrixN', 'simatrixId', 'simatrixIdl'):
-                state[name] = state[name].copy()
-        new.__setstate__(state)
-
-
+            array = self.__dict__.get(name)
+            if not isinstance(array, numpy.ndarray) \
+                   or name in self._readonly_arrays:
+                continue
+            if name in self._cmtylist_arrays:
+                # Filled in by cmtyListCopy below.
+                new._allocArray(name, array=numpy.empty_like(array))
+            else:
+                new._allocArray(name, array=array.copy())
+        new._struct.seenList = cmodels.C.SetInit(self.N)
+        cmodels.C.cmtyListCreate(new._struct_p)
+        cmodels.C.cmtyListCopy(new._struct_p, self._struct_p)
         return new
     def getcmtystate(self):
         """Return an object representing the communities.
 
         This can be pickeled and re-loaded into this object later.
 
+        The state is a dict with numpy arrays: 'cmty' is a copy of
+        self.cmty, and for overlapping (not oneToOne) states
+        'cmtyOffsets'/'cmtyMembers' hold the contents of every
+        community in compressed form (community c has nodes
+        cmtyMembers[cmtyOffsets[c]:cmtyOffsets[c+1]]).
+
         See also .cmtyDict().
         """
         state = { }
-        state['version'] = 0
+        state['version'] = 1
         state['oneToOne'] = self.oneToOne
         state['hasPrimaryCmty'] = self.hasPrimaryCmty
-        state['cmtyContents'] = { }
-        for c in self.cmtys():
-            state['cmtyContents'][c] = tuple(self.cmtyContents(c))
-        state['cmtyList'] = tuple(self.cmty)
+        state['cmty'] = self.cmty.copy()
+        if not self.oneToOne:
+            offsets = numpy.zeros(self.Ncmty+1, dtype=ctypes.c_int)
+            numpy.cumsum(self.cmtyN[:self.Ncmty], out=offsets[1:])
+            members = numpy.zeros(offsets[-1], dtype=ctypes.c_int)
+            cmodels.cmtyGetContentsAll(self._struct_p,
+                                   members.ctypes.data_as(cmodels.c_int_p))
+            state['cmtyOffsets'] = offsets
+            state['cmtyMembers'] = members
         return state
     def setcmtystate(self, state):
         """Re-load state of communities from state dict.
+
+        Both the current format and the older (version 0,
+        dict-of-tuples) format are accepted.
         """
-        self.cmtyListClear()
         if state['version'] == 0:
-            seenNodes = set()
-            actuallyOneToOne = True
-            for c, nodes in sorted(state['cmtyContents'].items()):
-                for n in nodes:
-                    #print "clAO:", c, n, self.cmtyN[c]
-                    self.cmtyListAddOverlap(c, n)
-                # Detect if we have a repeat of any nodes.  If so, we
-                # can not be one to one.
-                if actuallyOneToOne and (seenNodes & set(nodes)):
-                    actuallyOneToOne = False
-                seenNodes |= set(nodes)
+            contents = state['cmtyContents']
+            Ncmty = max(contents) + 1 if contents else 0
+            offsets = numpy.zeros(Ncmty+1, dtype=ctypes.c_int)
+            for c, nodes in contents.iteritems():
+                offsets[c+1] = len(nodes)
+            numpy.cumsum(offsets, out=offsets)
+            members = numpy.zeros(offsets[-1], dtype=ctypes.c_int)
+            for c, nodes in contents.iteritems():
+                members[offsets[c]:offsets[c+1]] = nodes
+            cmty = state['cmtyList']
+        elif state['version'] == 1:
+            offsets = state.get('cmtyOffsets')
+            members = state.get('cmtyMembers')
+            cmty = state['cmty']
+        else:
+            raise Exception("Unknown version of state to load communities.")
+        if offsets is None:
+            # oneToOne: the lists are built directly from self.cmty.
+            self.cmty[:] = cmty
+            self.cmtyListInit()
+        else:
+            offsets = numpy.asarray(offsets, dtype=ctypes.c_int)
+            members = numpy.asarray(members, dtype=ctypes.c_int)
+            actuallyOneToOne = cmodels.cmtySetContentsAll(
+                self._struct_p, len(offsets)-1,
+                offsets.ctypes.data_as(cmodels.c_int_p),
+                members.ctypes.data_as(cmodels.c_int_p))
             # If stored state shows we should be oneToOne, and
             # detected state shows we are not, there is a problem.
             if state['oneToOne'] and not actuallyOneToOne:
                 raise Exception("oneToOne value does not match.")
-            self.oneToOne = state['oneToOne']
-            self.hasPrimaryCmty = state['hasPrimaryCmty']
-            self.cmty[:] = state['cmtyList']
-        else:
-            raise Exception("Unknown version of state to load communities.")
-        #self.hashInit() #cmtyListAddOverlap keeps hashes properly working now.
+            self.cmty[:] = cmty
+        self.oneToOne = state['oneToOne']
+        self.hasPrimaryCmty = state['hasPrimaryCmty']
         #self.check() # can't check non-oneToOne (yet)
     def hash(self):
         """Hash of state of self.
@@ -347,49 +383,49 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
                            coords=None, randomize=True,
                            selfweight=None,
                            weightmultiplier=-1):
-        """Creates sparse-only Graph from NetworkX."""
+        """Creates sparse-only Graph from NetworkX.
+
+        Interactions are stored in compressed sparse row form (see
+        _alloc_csr), so memory use is O(N+E): no N*N imatrix is
+        allocated and rows are not padded to the maximum degree.  All
+        pairs of nodes without an edge interact with the uniform
+        default weight noedgeweight*weightmultiplier.
+        """
+        if selfweight is not None:
+            raise ValueError("selfweight not implemented yet.")
         G = cls(N=len(graph), randomize=randomize, sparse=True)
         G._graph = graph
         G.coords = coords
 
-        G._nodeIndex = nodeIndex= { }
-        G._nodeLabel = nodeLabel = { }
-
         # Set up node indexes (since NetworkX graph object nodes are
         # not always going to be integeras in range(0, self.N)).
-        for i, name in enumerate(sorted(graph.nodes())):
-            G._nodeIndex[name] = i
-            G._nodeLabel[i] = name
+        G._makeNodeMap(graph.nodes())
+        nodeIndex = G._nodeIndex
+        nodeLabel = G._nodeLabel
+        for name, i in nodeIndex.iteritems():
             graph.node[name]['index'] = i
 
-        maxconn = max(len(graph[n]) for n in graph.node)
-        G._alloc_sparse(simatrixLen=maxconn, rmatrix=False)
+        G._alloc_csr([ len(graph[nodeLabel[n]]) for n in xrange(G.N) ])
 
         # Default weighting
+        G.simatrixDefault = 0
         G.srmatrixDefault = noedgeweight*weightmultiplier #defaultweight
-        # Default diagonal weighting
-        if selfweight is not None:
-            raise ValueError("selfweight not implemented yet.")
-            for i in range(G.N):
-                G.imatrix[i, i] = selfweight*weightmultiplier
         # All explicit weighting from the graph
         simatrix = G.simatrix
         simatrixId = G.simatrixId
-        simatryiN = G.simatriN
-        for n0 in xrange(len(G._nodeLabel)):
+        simatrixIdx = G.simatrixIdx
+        for n0 in xrange(G.N):
             n0label = nodeLabel[n0]
-            for idx, n1 in enumerate(G[n0label]):
-                n1label = nodeLabel[n1]
+            row = simatrixIdx[n0]
+            neighbors = sorted((nodeIndex[n1label], data) for n1label, data
+                               in graph[n0label].iteritems())
+            for j, (n1, data) in enumerate(neighbors):
                 if n0 == n1:
                     raise ValueError("Nodes must not interact with themselves "
                                      "(under current assumptions.)")
-                assert i < maxconn
-                simatrix[n0,idx] = graph[n0label][n1label].get('weight', edgeweight) \
-                                                             * weightmultiplier
-                simatrixId[n0,idx] = n1
-                simatrixN[n0] += 1
-
-            assert simatrixN[n0]-1 == idx
+                simatrix[row+j] = data.get('weight', edgeweight) \
+                                                   * weightmultiplier
+                simatrixId[row+j] = n1
         # Check that the matrix is symmetric (FIXME someday: directed graphs)
         #if not numpy.all(G.imatrix == G.imatrix.T):
         #    print "Note: interactions matrix is not symmetric"
@@ -426,7 +462,7 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         return G
     @classmethod
     def from_coords_and_efunc(cls, coords, efunc, boxsize=None,
-                              refunc=None):
+                              refunc=None, cutoff=None):
         """Create graph structure from coordinates+energy function.
 
         This helper class method is used to create an imatrix from a
@@ -440,7 +476,17 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         If `refunc` is given, this is an efunc to be used to create
         the repulsive matrix.  See __init__ documentation for what
         this means.
+
+        If `cutoff` is given, a sparse-only Graph is made instead:
+        pairs closer than cutoff are found with cell lists
+        (util.cell_list_pairs) and efunc is evaluated only on them.
+        All other pairs get the default interaction efunc(inf) (and
+        refunc(inf)), so cutoff should be where efunc has reached that
+        value.
         """
+        if cutoff is not None:
+            return cls._fromCoordsAndEfuncSparse(coords, efunc, boxsize,
+                                                 refunc, cutoff)
         G = cls(N=coords.shape[0])
         G.coords = coords
         G._makematrix_fromCoordsAndEfunc(coords, efunc, boxsize=boxsize)
@@ -450,6 +496,33 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
                                             matrix="rmatrix")
         return G
 
+    @classmethod
+    def _fromCoordsAndEfuncSparse(cls, coords, efunc, boxsize, refunc,
+                                  cutoff):
+        """Sparse version of from_coords_and_efunc, using cell lists."""
+        rows, cols, dist = util.cell_list_pairs(coords, cutoff,
+                                                boxsize=boxsize)
+        orig_settings = numpy.seterr()
+        numpy.seterr(all="ignore")
+        try:
+            inf = numpy.asarray([numpy.inf])
+            weights = efunc(dist)
+            far = float(efunc(inf)[0])
+            rweights = None
+            if refunc is not None:
+                rweights = refunc(dist)
+                imatrixDefault, default = far, float(refunc(inf)[0])
+            elif far > 0:
+                imatrixDefault, default = 0, far
+            else:
+                imatrixDefault, default = far, 0
+        finally:
+            numpy.seterr(**orig_settings)
+        G = cls.from_pairs(coords.shape[0], rows, cols, weights,
+                           default=default, imatrixDefault=imatrixDefault,
+                           rweights=rweights)
+        G.coords = coords
+        return G
     def _makematrix_fromCoordsAndEfunc(self, coords, efunc, boxsize=None,
                                       matrix="imatrix"):
         orig_settings = numpy.seterr()
@@ -492,9 +565,23 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
 
         return G
     @classmethod
-    def from_sparseiter(cls, nodes, weights, default, maxconn,
+    def from_sparseiter(cls, nodes, weights, default, maxconn=None,
                         imatrixDefault=0,
                         rmatrix=False, rweight=0):
+        """Create a sparse-only Graph from an iterator of interactions.
+
+        nodes: iterable of node labels.
+
+        weights: iterable of (node1, node2, weight) tuples, or
+        (node1, node2, weight, rweight) tuples if rmatrix is true.
+
+        default: the default repulsive weight (srmatrixDefault) of all
+        pairs not given in `weights`.
+
+        maxconn: optional upper limit on the number of interactions
+        of any node.  It is only checked: interactions are stored in
+        packed compressed sparse row form, so rows are never padded.
+        """
 
         nodeIndex = { }
         nodeLabel = { }
@@ -505,23 +592,12 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         #    maxconn = len(nodeIndex)
         nnodes = len(nodeIndex)
 
-        G = cls(N=nnodes, sparse=True)
-        G._nodeIndex = nodeIndex
-        G._nodeLabel = nodeLabel
-
-        G.simatrixDefault = imatrixDefault
-        G.srmatrixDefault = default
-        G._alloc_sparse(simatrixLen=maxconn, rmatrix=rmatrix)
-        G.simatrix[:] = numpy.nan
-        if rmatrix:
-            G.srmatrix[:] = numpy.nan
-
-        simatrixN = G.simatrixN
-        simatrix = G.simatrix
-        simatrixId = G.simatrixId
-        if rmatrix:
-            srmatrix = G.srmatrix
-
+        # Buffer everything in compact arrays, since we can't know
+        # the row lengths until the iterator is exhausted.
+        rows = array.array('l')
+        cols = array.array('l')
+        ws = array.array('d')
+        rws = array.array('d')
         for iterval in weights:
             if rmatrix:
                 node1, node2, weight, rweight = iterval
@@ -531,15 +607,45 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
             #    continue
                 raise ValueError("Nodes must not interact with themselves "
                                  "(under current assumptions.)")
-            i = nodeIndex[node1]
-            j = nodeIndex[node2]
-            idx = simatrixN[i]
-            assert idx < maxconn
-            simatrix[i,idx] = weight
-            simatrixId[i,idx] = j
-            simatrixN[i] += 1
+            rows.append(nodeIndex[node1])
+            cols.append(nodeIndex[node2])
+            ws.append(weight)
             if rmatrix:
-                srmatrix[i, idx] = rweight
+                rws.append(rweight)
+        rows = numpy.frombuffer(rows, dtype=rows.typecode) if rows \
+               else numpy.zeros(0, dtype=int)
+        if maxconn is not None and len(rows):
+            assert numpy.bincount(rows).max() <= maxconn
+
+        G = cls.from_pairs(nnodes, rows, numpy.asarray(cols),
+                           numpy.asarray(ws), default=default,
+                           imatrixDefault=imatrixDefault,
+                           rweights=numpy.asarray(rws) if rmatrix else None)
+        G._nodeIndex = nodeIndex
+        G._nodeLabel = nodeLabel
+        return G
+    @classmethod
+    def from_pairs(cls, N, rows, cols, weights, default, imatrixDefault=0,
+                   rweights=None):
+        """Create a sparse-only Graph from arrays of interactions.
+
+        Node rows[i] interacts with node cols[i] with weight weights[i]
+        (and repulsive weight rweights[i], if given, which makes a
+        srmatrix).  Both directions of each pair must be given.
+        default and imatrixDefault are as in from_sparseiter.
+        """
+        G = cls(N=N, sparse=True)
+        G.simatrixDefault = imatrixDefault
+        G.srmatrixDefault = default
+        rows = numpy.asarray(rows)
+        G._alloc_csr(numpy.bincount(rows, minlength=N),
+                     rmatrix=rweights is not None)
+        # Stable sort, so each row keeps its order.
+        order = numpy.argsort(rows, kind='mergesort')
+        G.simatrix[:] = numpy.asarray(weights)[order]
+        G.simatrixId[:] = numpy.asarray(cols)[order]
+        if rweights is not None:
+            G.srmatrix[:] = numpy.asarray(rweights)[order]
         return G
     def _makeNodeMap(self, nodes):
         self._nodeIndex = nodeIndex= { }
@@ -554,6 +660,10 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
 
 
     def _alloc_sparse(self, simatrixLen, rmatrix=False):
+        """Allocate padded sparse arrays, simatrixLen entries per row.
+
+        Rows are filled by incrementing simatrixN.  See also
+        _alloc_csr."""
         self.hasSparse = 1
         self.simatrixLen = simatrixLen
         self._allocArray('simatrix', shape=(self.N, simatrixLen))
@@ -561,8 +671,34 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
             self._allocArray('srmatrix', shape=(self.N, simatrixLen))
         self._allocArray('simatrixN', shape=self.N)
         self._allocArray('simatrixId', shape=(self.N, simatrixLen))
-        self._allocArray("simatrixIdl", shape=self.N, dtype=ctypes.c_void_p)
-        self._allocArrayPointers(self.simatrixIdl, self.simatrixId)
+        self._allocArray('simatrixIdx', shape=self.N+1)
+        self.simatrixIdx[:] = numpy.arange(self.N+1) * simatrixLen
+    def _alloc_csr(self, rowlengths, rmatrix=False):
+        """Allocate packed compressed sparse row (CSR) interactions.
+
+        rowlengths[n] is the number of stored interactions of node n.
+        Row n is entries simatrixIdx[n]:simatrixIdx[n+1] of the
+        one-dimensional simatrix, simatrixId (and srmatrix) arrays,
+        so memory is O(N+E) no matter how uneven the degrees are."""
+        self.hasSparse = 1
+        self.simatrixLen = 0
+        self._allocArray('simatrixN', shape=self.N)
+        self.simatrixN[:] = rowlengths
+        self._allocArray('simatrixIdx', shape=self.N+1)
+        numpy.cumsum(self.simatrixN, out=self.simatrixIdx[1:])
+        nnz = self.simatrixIdx[self.N]
+        self._allocArray('simatrix', shape=nnz)
+        if isinstance(self.rmatrix, numpy.ndarray) or rmatrix:
+            self._allocArray('srmatrix', shape=nnz)
+        self._allocArray('simatrixId', shape=nnz)
+    def _sparse_row(self, n):
+        """Return (neighbor indexes, weights) of the sparse row of n.
+
+        Works for both padded and CSR sparse arrays."""
+        start = self.simatrixIdx[n]
+        end = start + self.simatrixN[n]
+        return (self.simatrixId.reshape(-1)[start:end],
+                self.simatrix.reshape(-1)[start:end])
 
     def make_sparse(self, default, cutoff=None,
                     imatrixDefault=0, cutoff_op=numpy.less):
@@ -600,31 +736,27 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         #for row in imatrix:
         #    x = numpy.sum(row < minval)
         #    simatrixLen = max(x, simatrixLen)
-        simatrixLen = cutoff_op(imatrix, cutoff).sum(axis=1).max()
+        keep = cutoff_op(imatrix, cutoff)
+        numpy.fill_diagonal(keep, False)
+        # numpy.where returns row-major order, which is already CSR order.
+        rows, cols = numpy.where(keep)
+        del keep
+        rowlengths = numpy.bincount(rows, minlength=self.N)
         if self.verbosity >= 0:
             print "Making graph sparse: %d nodes, %d reduced nodes"%(
-                self.N, simatrixLen)
+                self.N, rowlengths.max() if len(rows) else 0)
             print "  imatrix max/min:", numpy.min(imatrix), numpy.max(imatrix)
-        self._alloc_sparse(simatrixLen=simatrixLen)
-
-        for i,j in zip(*numpy.where(cutoff_op(imatrix, cutoff))):
-            if i == j:
-                continue
-            idx = self.simatrixN[i]
-            #assert idx < self.simatrixLen
-            self.simatrix[i,idx] = imatrix[i, j]
-            self.simatrixId[i,idx] = j
-            self.simatrixN[i] += 1
+        self._alloc_csr(rowlengths)
+        self.simatrix[:] = imatrix[rows, cols]
+        self.simatrixId[:] = cols
     def _check_sparse(self, imatrixDefault):
         #if numpy.max(self.seenList.data[:self.seenList.maxcount]) > 10000:
         #    from fitz import interactnow
         #    assert 0
         #
-        for i, row in enumerate(self.simatrix):
-            for _j, val in enumerate(row[0:self.simatrixN[i]]):
-                j = self.simatrixId[i,_j]
-                if not val == self.imatrix[i, j]:
-                    from fitz import interactnow
+        for i in range(self.N):
+            ids, vals = self._sparse_row(i)
+            for _j, (j, val) in enumerate(zip(ids, vals)):
                 assert val == self.imatrix[i, j], "%d %d %d %d"%(i,j,_j,val)
         # Compare everything in imatrix, make sure it is in simatrix
         # if needed.
@@ -635,16 +767,16 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
                     continue
                 # If it isn't the default, it should be in in the matrices
                 if val != imatrixDefault:
-                    assert j     in self.simatrixId[i,:self.simatrixN[i]], \
+                    assert j     in self._sparse_row(i)[0], \
                            "%d %d %d"%(i,j,val)
                 # And if it is the default, it shouldn't be in.
                 else:
-                    assert j not in self.simatrixId[i,:self.simatrixN[i]], \
+                    assert j not in self._sparse_row(i)[0], \
                            "%d %d %d"%(i,j,val)
         # Is it sorted?
         for i in range(self.N):
-            assert list(sorted(self.simatrixId[i,:self.simatrixN[i]])) == \
-                   list(self.simatrixId[i,:self.simatrixN[i]])
+            ids = self._sparse_row(i)[0]
+            assert list(sorted(ids)) == list(ids)
     def shiftWeights(self, shift):
         raise NotImplementedError
     def enableVT(self, mode="standard", repelValue=1):
@@ -658,7 +790,7 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         if self.hasFull:
             self._allocRmatrix()
         if not isinstance(self.srmatrix, numpy.ndarray):
-            self._allocArray('srmatrix', shape=(self.N, self.simatrixLen))
+            self._allocArray('srmatrix', shape=self.simatrix.shape)
 
         if mode == "standard":
             # ALL pairs of nodes, even though not interacting, get
@@ -703,9 +835,17 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         else:
             raise ValueError("Unknown mode for enableVT: %s", mode)
     def enableModularity(self, mode):
-        """Enable a modularity-based mode."""
+        """Enable a modularity-based mode.
+
+        For full Graphs, the null model k_i*k_j/2m is stored in a full
+        rmatrix.  For sparse Graphs it is implicit: the node weights
+        are set to the degrees and the default repulsion to 1/2m, so
+        the repulsion of node n with community c is
+        gamma*k_n*K_c/2m, where the community degree sums K_c are
+        kept up to date as nodes move (see _enableModularitySparse).
+        """
         if self.hasSparse:
-            raise ValueError("Can't use modularity with sparse matrices.")
+            return self._enableModularitySparse(mode)
         if self.rmatrix is not None:
             self._allocRmatrix()
         self.imatrix[self.imatrix != -1] = 0
@@ -723,6 +863,34 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         expected_degree = numpy.multiply.outer(in_degrees, out_degrees) / float(2*E)
         self.rmatrix[:] = expected_degree
         #expected_degree[from, to]
+    def _enableModularitySparse(self, mode):
+        """Modularity with an implicit null model, in O(N+E) memory.
+
+        Only the edges are stored (with interaction -1, like the full
+        version).  The default interaction of every pair of nodes,
+        including the ones with edges, is the repulsion
+        nodeWeight[n]*nodeWeight[m]*srmatrixDefault = k_n*k_m/2m, and
+        C keeps cmtyWeight[c] = K_c, the degree sum of community c.
+        """
+        if self.hasFull:
+            raise ValueError("Use a sparse-only Graph for sparse modularity.")
+        nodeList = tuple(self._nodeLabel[i] for i in range(self.N))
+        degrees = [ self._graph.degree(n) for n in nodeList ]
+        E = self._graph.number_of_edges()
+        simatrix = self.simatrix.reshape(-1)
+        simatrix[simatrix != -1] = 0
+        if isinstance(self.srmatrix, numpy.ndarray):
+            # Stored repulsions are relative to the default.
+            self.srmatrix[:] = 0
+        self.simatrixDefault = 0
+        self.srmatrixDefault = 1. / (2*E)
+        self.srmatrixDefaultOnlyDefined = 0
+        # Reload the communities to fill in cmtyWeight.
+        cmtystate = self.getcmtystate()
+        self._allocArray('nodeWeight', shape=self.N)
+        self._allocArray('cmtyWeight', shape=self.N)
+        self.nodeWeight[:] = degrees
+        self.setcmtystate(cmtystate)
     def set_const_q(self, q):
         self.const_q = q
 
@@ -774,6 +942,301 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
                 G.imatrix[c1, c2] = E*multiplier
                 G.imatrix[c2, c1] = E*multiplier
         return G
+    def _sparse_flat(self):
+        """Return (rows, cols, flat) of all stored sparse interactions.
+
+        flat are the indexes into the flattened simatrix, simatrixId
+        and srmatrix arrays, for both padded and CSR arrays."""
+        lens = self.simatrixN
+        rows = numpy.repeat(numpy.arange(self.N), lens)
+        offsets = numpy.cumsum(lens) - lens
+        flat = self.simatrixIdx[rows] \
+               + numpy.arange(len(rows)) - numpy.repeat(offsets, lens)
+        cols = self.simatrixId.reshape(-1)[flat]
+        return rows, cols, flat
+    def _coarsen(self):
+        """Return a sparse Graph with one weighted node per community.
+
+        Node c of the new Graph is community c of this one (call
+        .remap() first).  Interactions between communities are summed
+        into the new sparse arrays, with the default interaction
+        subtracted, and nodeWeight[c] is the size of community c (or
+        the total weight of it, if this Graph is itself weighted), so
+        that the default interaction between two supernodes counts
+        once per pair of original nodes.  Then, for any community
+        assignment of the new Graph, its energy differs from the same
+        assignment projected back onto this Graph only by a constant
+        (the internal energy of the supernodes).
+        """
+        assert self.hasSparse
+        assert self.oneToOne
+        q = self.q
+        assert numpy.all(self.cmtyN[:q] > 0), "Communities must be remapped"
+        weighted = 'nodeWeight' in self.__dict__
+        hasR = isinstance(self.srmatrix, numpy.ndarray)
+        if weighted:
+            assert self.srmatrixDefaultOnlyDefined == 0
+
+        rows, cols, flat = self._sparse_flat()
+        values = self.simatrix.reshape(-1)[flat].astype(numpy.float64)
+        if hasR:
+            A = values
+            R = self.srmatrix.reshape(-1)[flat].astype(numpy.float64)
+            if not weighted:
+                R += self.srmatrixDefaultOnlyDefined
+        else:
+            A = numpy.where(values > 0, 0., values)
+            R = numpy.where(values > 0, values, 0.)
+        del values, flat
+
+        c1 = self.cmty[rows].astype(numpy.int64)
+        c2 = self.cmty[cols].astype(numpy.int64)
+        between = c1 != c2
+        keys, inverse = numpy.unique((c1*q + c2)[between],
+                                     return_inverse=True)
+        # (float dtypes: bincount of an empty array is int.)
+        A = numpy.bincount(inverse, weights=A[between],
+                           minlength=len(keys)).astype(numpy.float64)
+        R = numpy.bincount(inverse, weights=R[between],
+                           minlength=len(keys)).astype(numpy.float64)
+        if weighted:
+            weights = self.cmtyWeight[:q].copy()
+        else:
+            D = numpy.bincount(inverse,
+                               minlength=len(keys)).astype(numpy.float64)
+            A -= D * self.simatrixDefault
+            R -= D * self.srmatrixDefault
+            weights = self.cmtyN[:q].astype(numpy.float64)
+
+        G = self.__class__(N=q, randomize=False, sparse=True)
+        G.verbosity = self.verbosity
+        # keys are sorted, so rows and columns are already in CSR order.
+        G._alloc_csr(numpy.bincount(keys//q, minlength=q), rmatrix=True)
+        G.simatrixId[:] = keys % q
+        G.simatrix[:] = A
+        G.srmatrix[:] = R
+        G.simatrixDefault = self.simatrixDefault
+        G.srmatrixDefault = self.srmatrixDefault
+        G.srmatrixDefaultOnlyDefined = 0
+        G._allocArray('nodeWeight', shape=q)
+        G._allocArray('cmtyWeight', shape=q)
+        G.nodeWeight[:] = weights
+        G.cmty[:] = numpy.arange(q)
+        G.cmtyListInit()
+        return G
+    def _attractive_pairs(self, gamma):
+        """Return (rows, cols) of all pairs with attractive coupling.
+
+        A pair is attractive if its coupling at this gamma is negative
+        (both directions are returned, the diagonal is not).  Returns
+        None if the default sparse interaction is attractive, so that
+        all pairs not listed are attractive too."""
+        if self.hasSparse:
+            default = self.simatrixDefault + gamma*self.srmatrixDefault
+            if default < 0:
+                return None
+            rows, cols, flat = self._sparse_flat()
+            values = self.simatrix.reshape(-1)[flat].astype(numpy.float64)
+            if isinstance(self.srmatrix, numpy.ndarray):
+                R = self.srmatrix.reshape(-1)[flat]
+                if 'nodeWeight' not in self.__dict__:
+                    R = R + self.srmatrixDefaultOnlyDefined
+                J = values + gamma*R
+            else:
+                J = numpy.where(values > 0, gamma*values, values)
+            if 'nodeWeight' in self.__dict__:
+                # Stored interactions have the default subtracted.
+                J += self.nodeWeight[rows]*self.nodeWeight[cols]*default
+            attractive = (J < 0) & (rows != cols)
+            return rows[attractive], cols[attractive]
+        if isinstance(self.rmatrix, numpy.ndarray):
+            J = self.imatrix + gamma*self.rmatrix
+        else:
+            J = self.imatrix
+        attractive = J < 0
+        numpy.fill_diagonal(attractive, False)
+        return numpy.nonzero(attractive)
+    def _attractive_blocks(self, gamma):
+        """Return (nblocks, labels) of blocks with no attraction between.
+
+        labels[n] is the block of node n.  Blocks are the connected
+        components of the pairs with a negative (attractive) coupling
+        at this gamma (see ._attractive_pairs()).  All pairs between
+        different blocks have couplings >= 0, so splitting a community
+        along block boundaries never raises the energy, and each block
+        can be minimized on its own.  If the default sparse
+        interaction is attractive, or q is fixed, everything is one
+        block."""
+        import scipy.sparse
+        import scipy.sparse.csgraph
+        N = self.N
+        pairs = None
+        if not self.const_q:
+            pairs = self._attractive_pairs(gamma)
+        if pairs is None:
+            return 1, numpy.zeros(N, dtype=int)
+        rows, cols = pairs
+        A = scipy.sparse.coo_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)),
+            shape=(N, N))
+        return scipy.sparse.csgraph.connected_components(A, directed=False)
+    def _subgraph(self, nodes):
+        """Return a new Graph of only `nodes` and their interactions.
+
+        Node i of the new Graph is nodes[i].  Full and sparse
+        interactions, neighbor lists, defaults and node weights are
+        all carried over,
+        so energies of communities within `nodes` are the same.  The
+        communities are self.cmty restricted to `nodes` (renumbered)."""
+        nodes = numpy.asarray(nodes)
+        n = len(nodes)
+        G = self.__class__(N=n, randomize=False, sparse=not self.hasFull)
+        G.verbosity = self.verbosity
+        newindex = numpy.empty(self.N, dtype=int)
+        newindex.fill(-1)
+        newindex[nodes] = numpy.arange(n)
+        if self.hasFull:
+            G.imatrix[:] = self.imatrix[numpy.ix_(nodes, nodes)]
+            if isinstance(self.rmatrix, numpy.ndarray):
+                G._allocRmatrix()
+                G.rmatrix[:] = self.rmatrix[numpy.ix_(nodes, nodes)]
+        if isinstance(self.linklist, numpy.ndarray):
+            lens = self.linklistN[nodes]
+            starts = self.linklist_idx[nodes]
+            flat = numpy.repeat(starts - (numpy.cumsum(lens) - lens), lens) \
+                   + numpy.arange(lens.sum())
+            rows = numpy.repeat(numpy.arange(n), lens)
+            neighs = newindex[self.linklist[flat]]
+            keep = neighs >= 0
+            G._allocArray('linklist', shape=keep.sum())
+            G._allocArray('linklist_idx', shape=n)
+            G._allocArray('linklistN', shape=n)
+            G.linklist[:] = neighs[keep]
+            G.linklistN[:] = numpy.bincount(rows[keep], minlength=n)
+            G.linklist_idx[:] = numpy.cumsum(G.linklistN) - G.linklistN
+        if self.hasSparse:
+            rows, cols, flat = self._sparse_flat()
+            keep = (newindex[rows] >= 0) & (newindex[cols] >= 0)
+            rows, cols, flat = rows[keep], cols[keep], flat[keep]
+            # Rows are sorted, so stable-sort by the new row index.
+            order = numpy.argsort(newindex[rows], kind='mergesort')
+            rows, cols, flat = rows[order], cols[order], flat[order]
+            hasR = isinstance(self.srmatrix, numpy.ndarray)
+            G._alloc_csr(numpy.bincount(newindex[rows], minlength=n),
+                         rmatrix=hasR)
+            G.simatrixId[:] = newindex[cols]
+            G.simatrix[:] = self.simatrix.reshape(-1)[flat]
+            if hasR:
+                G.srmatrix[:] = self.srmatrix.reshape(-1)[flat]
+            G.simatrixDefault = self.simatrixDefault
+            G.srmatrixDefault = self.srmatrixDefault
+            G.srmatrixDefaultOnlyDefined = self.srmatrixDefaultOnlyDefined
+            if 'nodeWeight' in self.__dict__:
+                G._allocArray('nodeWeight', shape=n)
+                G._allocArray('cmtyWeight', shape=n)
+                G.nodeWeight[:] = self.nodeWeight[nodes]
+        G.cmty[:] = numpy.unique(self.cmty[nodes], return_inverse=True)[1]
+        G.cmtyListInit()
+        return G
+    def _tree_roots(self, gamma, maxsize=1):
+        """Return roots[n]: the node that the dangling tree of n hangs from.
+
+        Trees are found on the graph of attractive pairs (see
+        ._attractive_pairs()) by repeatedly removing nodes with only
+        one remaining neighbor, in one linear pass.  Only trees of at
+        most maxsize nodes are removed (None: no limit), so with the
+        default of 1 only the leaves are.  roots[n] == n for the nodes
+        that are left (the core).  Components which are entirely trees
+        are left alone.  Returns None if there are no attractive pairs
+        to use."""
+        pairs = self._attractive_pairs(gamma)
+        N = self.N
+        if pairs is None:
+            return None
+        import scipy.sparse
+        import scipy.sparse.csgraph
+        rows, cols = pairs
+        order = numpy.argsort(rows, kind='mergesort')
+        neighs = cols[order]
+        degree = numpy.bincount(rows, minlength=N)
+        # Components which are trees have one edge less than nodes.
+        A = scipy.sparse.coo_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)),
+            shape=(N, N))
+        labels = scipy.sparse.csgraph.connected_components(
+            A, directed=False)[1]
+        edges = numpy.bincount(labels[rows], minlength=labels.max()+1) // 2
+        istree = (edges == numpy.bincount(labels) - 1)[labels]
+        ends = numpy.cumsum(degree)
+        starts = ends - degree
+        removed = numpy.zeros(N, dtype=bool)
+        parent = numpy.arange(N)
+        size = numpy.ones(N, dtype=int)
+        removal = [ ]
+        leaves = list(numpy.where((degree == 1) & ~istree)[0])
+        while leaves:
+            n = leaves.pop()
+            if removed[n] or degree[n] != 1:
+                continue
+            if maxsize is not None and size[n] > maxsize:
+                continue
+            for m in neighs[starts[n]:ends[n]]:
+                if not removed[m]:
+                    break
+            removed[n] = True
+            parent[n] = m
+            size[m] += size[n]
+            removal.append(n)
+            degree[m] -= 1
+            if degree[m] == 1:
+                leaves.append(m)
+        roots = numpy.arange(N)
+        for n in reversed(removal):
+            roots[n] = roots[parent[n]]
+        return roots
+    def pruned(self, gamma, maxsize=1):
+        """Return (P, groups): this Graph with dangling trees contracted.
+
+        Every dangling tree of at most maxsize nodes (see
+        ._tree_roots(), the default is only leaves) is contracted into
+        its root, which becomes one weighted node of the sparse Graph
+        P (made by ._coarsen(), so the interactions and default
+        weights are summed exactly).  Node groups[n] of P contains
+        node n.  The communities of P start as those of the roots
+        here.  Minimize P and then use .loadFromPruned(P, groups).
+
+        This is a heuristic: the contracted nodes can only be moved
+        one by one afterwards, so keep maxsize small.  Returns (None,
+        None) if there is nothing to prune."""
+        assert self.oneToOne
+        assert not self.const_q
+        roots = self._tree_roots(gamma, maxsize=maxsize)
+        if roots is None or numpy.all(roots == numpy.arange(self.N)):
+            return None, None
+        if not self.hasSparse:
+            self.make_sparse(default='auto')
+        reps, groups = numpy.unique(roots, return_inverse=True)
+        state = self.getcmtystate()
+        self.cmty[:] = groups
+        self.cmtyListInit()
+        P = self._coarsen()
+        self.setcmtystate(state)
+        P.cmty[:] = numpy.unique(self.cmty[reps], return_inverse=True)[1]
+        P.cmtyListInit()
+        if self.verbosity >= 0:
+            print "Pruned trees: %d nodes -> %d nodes"%(self.N, P.N)
+        return P, groups
+    def loadFromPruned(self, P, groups, gamma=None):
+        """Load communities from a pruned Graph P (see .pruned()).
+
+        Every node gets the community of its root, in one pass.  If
+        gamma is given, this is refined with .greedy(), so that tree
+        nodes which are better off elsewhere can move."""
+        self.cmty[:] = P.cmty[groups]
+        self.cmtyListInit()
+        if gamma is not None:
+            self.greedy(gamma)
+        self.remap(check=False)
     def loadFromSupernodeGraph(self, G):
         """Reload our community assignments from a supernode Graph G.
         """
@@ -934,12 +1397,8 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         cmodels.cmtyListInit(self._struct_p)
     def cmtyListClear(self):
         """Clear all particles from all communities"""
-        #raise NotImplementedError("Update this for hash lists.")
-        #cmodels.hashInit(self._struct_p)
         self.cmty[:] = NO_CMTY
-        self.cmtyN[:] = 0
-        self.Ncmty = 0
-        self.hashClear()
+        cmodels.cmtyListClear(self._struct_p)
     def cmtyListAdd(self, c, n):
         """Add node n to community c."""
         cmodels.cmtyListAdd(self._struct_p, c, n)
@@ -1032,9 +1491,7 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         for n in nodes:
             conn = 0
             connInCmty = 0
-            for i in range(self.simatrixN[n]):
-                n2 = self.simatrixId[n,i]
-                interaction = self.simatrix[n,i]
+            for n2, interaction in zip(*self._sparse_row(n)):
                 if interaction >= 0: continue
                 conn += 1
                 if n2 in nodes:
@@ -1059,10 +1516,6 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
             c = self.cmtys()
         return numpy.mean([self.cmtyConnectivitySingle(c=c_) for c_ in c],
                           axis=0)
-    def hashInit(self):
-        return cmodels.hashInit(self._struct_p)
-    def hashClear(self):
-        return cmodels.hashClear(self._struct_p)
 
 
     #
@@ -1151,25 +1604,23 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         """Average num nodes per community"""
         return sum(self.cmtyN[c] for c in self.cmtys())/float(self.q)
     def modularity(self):
-        nodeList = tuple(self._nodeLabel[i] for i in range(self.N))
-        cmtyList = tuple(self.cmty[i] for i in range(self.N))
-        in_degrees = [ self._graph.degree (n) for n in nodeList ]
-        out_degrees= [ self._graph.degree(n) for n in nodeList ]
+        """Newman modularity of the current (oneToOne) communities.
+
+        Computed from edge and degree sums per community, so it needs
+        O(N+E) time and memory."""
+        nodeIndex = self._nodeIndex
+        cmty = self.cmty
+        degrees = numpy.asarray([ self._graph.degree(self._nodeLabel[i])
+                                  for i in range(self.N) ], dtype=float)
         E = self._graph.number_of_edges()
-
-        expected_degree = numpy.multiply.outer(in_degrees, out_degrees) / float(2*E)
-        #print expected_degree
-        adj_matrix = networkx.to_numpy_matrix(self._graph, nodelist=nodeList, dtype=float)
-        #print adj_matrix
-        same_cmty_mask = numpy.asarray(numpy.equal.outer(cmtyList, cmtyList), dtype=int)
-        #print same_cmty_mask
-
-        #print (adj_matrix - expected_degree) #* same_cmty_mask
-        #print numpy.multiply((adj_matrix - expected_degree), same_cmty_mask)
-        mod = numpy.sum(
-            numpy.multiply((adj_matrix - expected_degree), same_cmty_mask)) \
-            / float(2*E)
-
+        # Adjacency matrix entries within communities (both directions).
+        internal = 0.
+        for a, b, data in self._graph.edges_iter(data=True):
+            a, b = nodeIndex[a], nodeIndex[b]
+            if cmty[a] == cmty[b]:
+                internal += data.get('weight', 1) * (1 if a == b else 2)
+        K = numpy.bincount(cmty, weights=degrees)
+        mod = (internal - numpy.sum(K**2)/float(2*E)) / float(2*E)
         return mod
 
 
@@ -1178,7 +1629,7 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
     # Methods that deal with minimization/optimization
     #
     def trials(self, gamma, trials, initial='random',
-               minimizer='greedy', threads=1, **kwargs):
+               minimizer='greedy', threads=1, processes=None, **kwargs):
         """Minimize system using .minimize() and `trials` trials.
 
         This will minimize `trials` number of times, and set the final
@@ -1198,10 +1649,19 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         self.getcmtystate(), and will be set with self.setcmtystate()
         before each minimization round.
 
+        processes: if given, run the trials in a pool of this many
+        worker processes.  The interaction arrays are moved to shared
+        memory first, so workers do not copy them; each worker returns
+        only its energy and community state, and the best one is
+        selected here.  `minimizer` must be a method name, and kwargs
+        must be picklable.
+
         **kwargs: Keyword arguments passed to minimizer function.
         Minimizer is called as minimize(gamma, **kwargs).
         """
         minimizer_orig = minimizer
+        if not isinstance(minimizer_orig, str):
+            minimizer_orig = minimizer.__name__
         if isinstance(minimizer, str):
             minimizer = getattr(self, minimizer)
         if self.verbosity > 0:
@@ -1213,7 +1673,25 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
             initial = self.getcmtystate()
         nChanges = [ ]
 
-        if threads <= 1:
+        if processes:
+            global _trials_graph
+            self._shareArrays(self._readonly_arrays)
+            args = [(gamma, initial, minimizer_orig, kwargs,
+                     random.randrange(2**31-1)) for i in range(trials)]
+            _trials_graph = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_trials_worker, args)
+            finally:
+                pool.close()
+                pool.join()
+                _trials_graph = None
+            for changes, thisE, cmtystate in results:
+                nChanges.append(changes)
+                if thisE < minE:
+                    minE = thisE
+                    minCmtyState = cmtystate
+        elif threads <= 1:
             for i in range(trials):
                 if self.verbosity >= 1.5:
                     print "Trial start: %d"%i
@@ -1376,6 +1854,170 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
         #self.combine_singletons(2)
         return roundsMoving, roundsCombining, changes
     minimize = greedy
+    def multilevel(self, gamma, maxlevels=25, maxrounds=250):
+        """Minimize by greedy moves on successively coarser graphs.
+
+        This is the Louvain-style method: minimize with .greedy(),
+        collapse each community into one weighted supernode (see
+        ._coarsen()), and minimize the supernode graph the same way,
+        until no more communities merge.  Then the communities are
+        projected back down level by level, refining with .greedy()
+        at each level.  Every level uses the sparse interactions
+        (.make_sparse() is called if needed), and the coarse levels
+        are much smaller, so large graphs converge in a few passes.
+
+        Returns (levels, changes).
+        """
+        if not self.hasSparse:
+            self.make_sparse(default='auto')
+        assert self.oneToOne
+        assert not self.const_q
+        if self.verbosity >= 0:
+            print "beginning multilevel minimization (n=%s, gamma=%s)"%(
+                self.N, gamma)
+        changes = 0
+        levels = [ self ]
+        G = self
+        while True:
+            changes += G.greedy(gamma, maxrounds=maxrounds)[-1]
+            G.remap(check=False)
+            if self.verbosity >= 2:
+                print "  (level %2d) multilevel: nodes, cmtys: %d %d"%(
+                    len(levels)-1, G.N, G.q)
+            if len(levels) > 1 and G.q >= G.N:
+                # Nothing merged at this level, so it can't change the
+                # level below.
+                levels.pop()
+                break
+            if G.q >= G.N or G.q <= 1 or len(levels) >= maxlevels:
+                break
+            G = G._coarsen()
+            G.verbosity = min(self.verbosity, 1) - 1
+            levels.append(G)
+        # Project back down, refining at each level.
+        for fine, coarse in reversed(zip(levels[:-1], levels[1:])):
+            fine.cmty[:] = coarse.cmty[fine.cmty]
+            fine.cmtyListInit()
+            changes += fine.greedy(gamma, maxrounds=maxrounds)[-1]
+            fine.remap(check=False)
+        return len(levels), changes
+    def minimize_blocks(self, gamma, minimizer='greedy', processes=None,
+                        minblock=1000, **kwargs):
+        """Minimize blocks of nodes with no attraction between separately.
+
+        The graph is split into blocks with only non-attractive
+        couplings between them (for example, the connected
+        components, see ._attractive_blocks()).  Blocks of at least
+        `minblock` nodes are minimized on their own, and smaller ones
+        are batched together up to that size.  Each batch is made into
+        its own Graph (._subgraph(), starting from the current
+        communities), minimized with `minimizer` (a method name,
+        called with (gamma, **kwargs)), and the communities are put
+        back here.  No community spans two blocks, so the energy is
+        the sum of the energies of the batches.
+
+        processes: if given, minimize the batches in a pool of this
+        many worker processes (as in .trials()).
+
+        Returns (nbatches, changes), where changes is the sum of what
+        the minimizer returned for each batch.
+        """
+        nblocks, labels = self._attractive_blocks(gamma)
+        if self.verbosity >= 0:
+            print "beginning block minimization (n=%s, blocks=%s)"%(
+                self.N, nblocks)
+        if nblocks == 1:
+            return 1, getattr(self, minimizer)(gamma, **kwargs)
+        # Group blocks into batches: big blocks alone, small ones
+        # together in order of size.
+        order = numpy.argsort(labels, kind='mergesort')
+        sizes = numpy.bincount(labels, minlength=nblocks)
+        blocknodes = numpy.split(order, numpy.cumsum(sizes)[:-1])
+        batches = [ ]
+        current = [ ]
+        currentsize = 0
+        for b in numpy.argsort(sizes, kind='mergesort'):
+            if sizes[b] >= minblock:
+                batches.append(blocknodes[b])
+                continue
+            current.append(blocknodes[b])
+            currentsize += sizes[b]
+            if currentsize >= minblock:
+                batches.append(numpy.concatenate(current))
+                current, currentsize = [ ], 0
+        if current:
+            batches.append(numpy.concatenate(current))
+
+        if processes:
+            global _blocks_graph
+            self._shareArrays(self._readonly_arrays)
+            args = [(nodes, gamma, minimizer, kwargs,
+                     random.randrange(2**31-1)) for nodes in batches]
+            _blocks_graph = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_blocks_worker, args)
+            finally:
+                pool.close()
+                pool.join()
+                _blocks_graph = None
+        else:
+            results = [ self._minimize_block(nodes, gamma, minimizer,
+                                             kwargs)
+                        for nodes in batches ]
+
+        # Put the communities back, numbering each batch's
+        # communities after the previous batch's.
+        changes = [ c for c, state in results if c is not None ]
+        states = [ state for c, state in results ]
+        cmty = numpy.empty(self.N, dtype=self.cmty.dtype)
+        offset = 0
+        for nodes, state in zip(batches, states):
+            c = state['cmty']
+            cmty[nodes] = numpy.where(c >= 0, c + offset, c)
+            state['offset'] = offset
+            offset += len(nodes)
+        if all(state['oneToOne'] for state in states):
+            self.cmty[:] = cmty
+            self.cmtyListInit()
+        else:
+            cmtys, members = [ ], [ ]
+            for nodes, state in zip(batches, states):
+                if state['oneToOne']:
+                    cmtys.append(state['cmty'] + state['offset'])
+                    members.append(nodes)
+                else:
+                    offsets = state['cmtyOffsets']
+                    cmtys.append(numpy.repeat(numpy.arange(len(offsets)-1),
+                                              numpy.diff(offsets))
+                                 + state['offset'])
+                    members.append(nodes[state['cmtyMembers']])
+            cmtys = numpy.concatenate(cmtys)
+            members = numpy.concatenate(members)
+            order = numpy.argsort(cmtys, kind='mergesort')
+            offsets = numpy.zeros(self.N+1, dtype=ctypes.c_int)
+            numpy.cumsum(numpy.bincount(cmtys, minlength=self.N),
+                         out=offsets[1:])
+            self.setcmtystate(dict(
+                version=1, oneToOne=0, cmty=cmty,
+                hasPrimaryCmty=int(all(state['hasPrimaryCmty']
+                                       for state in states)),
+                cmtyOffsets=offsets, cmtyMembers=members[order]))
+        self.remap(check=False)
+        if changes:
+            changes = numpy.sum([numpy.asarray(c, dtype=float)
+                                 for c in changes], axis=0)
+        else:
+            changes = None
+        return len(batches), changes
+    def _minimize_block(self, nodes, gamma, minimizer, kwargs):
+        """Minimize the subgraph of `nodes`, for .minimize_blocks().
+
+        Returns (changes, cmtystate of the subgraph)."""
+        G = self._subgraph(nodes)
+        G.verbosity = min(self.verbosity, 1) - 1
+        changes = getattr(G, minimizer)(gamma, **kwargs)
+        return changes, G.getcmtystate()
     def _greedy(self, gamma):
         return cmodels.greedy(self._struct_p, gamma)
     def ovGreedy(self, gamma, maxrounds=250):
@@ -1902,6 +2544,39 @@ class Graph(anneal._GraphAnneal, cmodels._cobj, object):
 
 
 
+# Graph being minimized by Graph.trials(processes=...).  It is set
+# before the worker pool is forked, so workers inherit it (and its
+# shared interaction arrays) instead of receiving a pickled copy.
+_trials_graph = None
+def _trials_worker(args):
+    """Run one trial of Graph.trials in a worker process.
+
+    Returns (changes, energy, cmtystate)."""
+    gamma, initial, minimizer, kwargs, seed = args
+    cmodels.C.init_gen_rand(seed)
+    random.seed(seed)
+    numpy.random.seed(seed)
+    G = _trials_graph.copy()
+    if initial == 'random':
+        G.cmtyCreate() # randomizes it
+    else:
+        G.setcmtystate(initial)
+    changes = getattr(G, minimizer)(gamma, **kwargs)
+    return changes, G.energy(gamma), G.getcmtystate()
+
+
+# Graph being minimized by Graph.minimize_blocks(processes=...), set
+# before forking like _trials_graph.
+_blocks_graph = None
+def _blocks_worker(args):
+    """Minimize one batch of Graph.minimize_blocks in a worker process.
+
+    Returns (changes, cmtystate)."""
+    nodes, gamma, minimizer, kwargs, seed = args
+    cmodels.C.init_gen_rand(seed)
+    random.seed(seed)
+    numpy.random.seed(seed)
+    return _blocks_graph._minimize_block(nodes, gamma, minimizer, kwargs)
 
 
 if __name__ == "__main__":
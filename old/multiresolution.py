@@ -1,12 +1,17 @@
 # Richard Darst, September 2011
 
+import copy
 import gzip
 from math import log, exp, floor, ceil
+import multiprocessing
 import numpy
 import cPickle as pickle
+import Queue
+import random
 import sys
 import threading
 import time
+import traceback
 import types
 
 import logging
@@ -14,13 +19,20 @@ logger = logging.getLogger('pcd.mr')
 
 from .. import util
 from ..util import LogInterval
+from ..sqlite import SQLiteDict
+from .util import replica_information
 from fitz.mathutil import Averager
 
+import cmodels
 import F1
 
 class NoResultsError(Exception):
     pass
 
+# Returned by MRRunner._getGamma_refine when no gamma can be chosen
+# until some running gamma is finished.
+_WAIT = object()
+
 def recursive_dict_update(d, dnew):
     for k,v in dnew.iteritems():
         if k in d and isinstance(d[k],dict) and isinstance(v,dict):
@@ -71,6 +83,24 @@ class MultiResolution(object):
     .enable() -> enable various optional analyzer functions.
     - 'F1': F1 analyzer.  Set self.G0 to a Graph instance with
     - 'mi_0': mutual information compariasons with respect to a known graph.
+
+    warmstart: if true, each replica at a new gamma starts from its
+    own minimized state at the nearest (in log(gamma)) gamma already
+    done by this runner, instead of from the original replica.
+    warmstart_perturb is the fraction of nodes then moved to random
+    communities.  For the 'trials' minimizer, initial='current' is
+    used so that the state is not re-randomized.  The gamma started
+    from is recorded in the 'warmstart' column (0 for cold starts),
+    and the minimizer's round counts in the nChanges columns.
+
+    checkpoint: filename of a SQLiteDict.  Each gamma (its GammaData,
+    including the replica states) is written there as soon as it is
+    added.  The states are always stored there, even if savestate is
+    false.  Gammas already in the file are loaded on creation, and
+    MRRunner.do skips them (matching gammas to a relative tolerance
+    of 1e-9), so an interrupted run can be resumed by creating the
+    MultiResolution again with the same checkpoint.  With warmstart,
+    the skipped gammas' states are used as warm starts again.
     """
     nhistbins = 50
     pairStyle = 'all'
@@ -84,6 +114,8 @@ class MultiResolution(object):
                  output=None, savefigargs=None,plotargs=None,
                  savestate=True,
                  analyzers=[],
+                 warmstart=False, warmstart_perturb=0.0,
+                 checkpoint=None,
                  ):
         self.fieldnames = [ 'gamma', ]
         self._data = { }
@@ -97,17 +129,53 @@ class MultiResolution(object):
         self.savefigargs = savefigargs
         self.plotargs = plotargs
         self.savestate = savestate
+        self.warmstart = warmstart
+        self.warmstart_perturb = warmstart_perturb
         self._lock = threading.Lock()
         self.calcMethods = self.__class__.calcMethods
         for analyzer in analyzers:
             self.enable(analyzer)
+        self.checkpoint = checkpoint
+        self._checkpointLocal = threading.local()
+        self._resumed = { }
+        if checkpoint is not None:
+            self.loadCheckpoint()
     def __getstate__(self):
         state = self.__dict__.copy()
         del state['_lock']
+        state.pop('_checkpointLocal', None)
         return state
     def __setstate__(self, state):
         self.__dict__ = state
         self._lock = threading.Lock()
+        self._checkpointLocal = threading.local()
+
+    def _checkpointDB(self):
+        """Return the checkpoint SQLiteDict (one connection per thread)."""
+        db = getattr(self._checkpointLocal, 'db', None)
+        if db is None:
+            db = self._checkpointLocal.db = SQLiteDict(self.checkpoint)
+        return db
+    def loadCheckpoint(self):
+        """Load all gammas from self.checkpoint into self._data.
+
+        The loaded gammas are remembered in self._resumed (as keys,
+        with their replica states as values if warmstart is on), so
+        that MRRunner.do does not run them again.  The states are
+        kept in self._data only if savestate is on."""
+        db = self._checkpointDB()
+        with self._lock:
+            for name in db.get('fieldnames', ()):
+                if name not in self.fieldnames:
+                    self.fieldnames.append(name)
+            for key, gammaData in db.iteritems():
+                if not (isinstance(key, tuple) and key[0] == 'gamma'):
+                    continue
+                state = getattr(gammaData, 'state', None)
+                if not self.savestate:
+                    gammaData.__dict__.pop('state', None)
+                self._data[key[1]] = gammaData
+                self._resumed[key[1]] = state if self.warmstart else None
 
     def runner(self):
         return MRRunner(self)
@@ -143,13 +211,14 @@ class MultiResolution(object):
         is smaller that data, and can be saved to redo the analysis
         later.
         """
-        # Store number of nodes
-        if not hasattr(self, 'N'):
-            self.N = data['Gs'][0].N
-        #assert all(self.N == G.N for G in data['Gs'])
-        if not all(self.N == G.N for G in data['Gs']):
-            raise Warning("Graph has a different number of nodes: "
-                          "%s previous vs %s now."%(self.N, data['Gs'][0]))
+        rows = self.calc(gamma, data)
+        self.addrows(gamma, rows, state)
+    def calc(self, gamma, data):
+        """Run all calcMethods on minimized replicas.
+
+        Returns the list of (name, value) rows, without storing them
+        (see .addrows())."""
+        self.checkN([G.N for G in data['Gs']])
 
 
         pairIndexes = [ ]
@@ -191,17 +260,42 @@ class MultiResolution(object):
             else:
                 ret = func(self, data=data, settings=self)
 
-            self._addValues(gamma, ret, gammaData=gammaData)
+            # Later calcMethods can see these in data['_gammaDict'].
+            ret = list(ret)
+            for name, val in ret:
+                gammaData.add(name, val)
             returns.extend(ret)
-        # Instead of the line below, we add things as-it-is-made
-        # above, and then once, at the end, save the state.
-        #self._addValues(gamma, returns, state=state)
+        return returns
+    def checkN(self, Ns):
+        """Store the number of nodes, checking that it does not change.
+
+        Ns is the list of the number of nodes of each replica."""
+        if not hasattr(self, 'N'):
+            self.N = Ns[0]
+        #assert all(self.N == N for N in Ns)
+        if not all(self.N == N for N in Ns):
+            raise Warning("Graph has a different number of nodes: "
+                          "%s previous vs %s now."%(self.N, Ns))
+    def addrows(self, gamma, rows, state):
+        """Store the (name, value) rows and state of one gamma."""
+        gammaData = GammaData(gamma=gamma)
+        self._addValues(gamma, rows, gammaData=gammaData)
         self._data[gamma] = gammaData
         #if not self.savestate:
         #    state = None
         if self.savestate:
             gammaData.setstate(state)
         #self._addValues(gamma, [], state=state)
+        if getattr(self, 'checkpoint', None) is not None:
+            # The checkpoint always has the states, for resuming.
+            saved = gammaData
+            if not self.savestate and state is not None:
+                saved = copy.copy(gammaData)
+                saved.setstate(state)
+            with self._lock:
+                db = self._checkpointDB()
+                db['fieldnames'] = self.fieldnames
+                db[('gamma', gamma)] = saved
 
     def _addValues(self, gamma, namevals, gammaData, state=None, ):
         """Add a list of (name,value) pairs to the corresponding gamma data"""
@@ -247,9 +341,11 @@ class MultiResolution(object):
         # minimization.
         if hasattr(Gs[0], 'nChanges'):
             nChanges = numpy.mean([G.nChanges for G in Gs], axis=0)
-            for i, value in enumerate(nChanges):
+            for i, value in enumerate(numpy.atleast_1d(nChanges)):
                 name = "nChanges%d"%i
                 returns.append((name, value))
+        if getattr(settings, 'warmstart', False):
+            returns.append(('warmstart', data.get('warmstart_gamma') or 0))
         return returns
     calcMethods.append(calc_changes)
     def calc_multualInformation(self, data, settings):
@@ -258,25 +354,20 @@ class MultiResolution(object):
         def _entropy(G):
             if G.oneToOne: return G.entropy
             else: return 1
-        Is = [ util.mutual_information(Gs[i],Gs[j])
-               for i,j in pairIndexes ]
-        VI = numpy.mean([_entropy(Gs[i]) + _entropy(Gs[j]) - 2*mi
+        overlap = not getattr(settings, 'no_N', False)
+        Is, Nmis = replica_information(Gs, pairIndexes, overlap=overlap)
+        Hs = [ _entropy(G) for G in Gs ]
+        VI = numpy.mean([Hs[i] + Hs[j] - 2*mi
                          for ((i,j), mi) in zip(pairIndexes, Is)])
-        In = numpy.mean([2*mi / (_entropy(Gs[i]) + _entropy(Gs[j]))
+        In = numpy.mean([2*mi / (Hs[i] + Hs[j])
                          for ((i,j), mi) in zip(pairIndexes, Is)
                          if Gs[i].q!=1 or Gs[j].q!=1])
         returns = [('I',  numpy.mean(Is)),
                    ('VI', VI),
                    ('In', In),
                    ]
-
-        # Avoid calculating N when n_mean is <= 5.  This is because it
-        # takes too long due to the hard recursive and pair-to-pair
-        # calculations it requires.
-        if Gs[0].n_mean() > 5 and not getattr(settings, 'no_N', False):
-            Nmi = numpy.mean(
-                [ util.mutual_information_overlap(Gs[i], Gs[j])
-                  for i,j in data['pairIndexes'] ])
+        if overlap:
+            Nmi = numpy.mean(Nmis)
         else:
             Nmi = float('nan')
         returns.append(('N',  Nmi))
@@ -290,7 +381,10 @@ class MultiResolution(object):
         def _entropy(G):
             if G.oneToOne: return G.entropy
             else: return 1
-        Is = [ util.mutual_information(G0, G) for G in Gs ]
+        pairIndexes = [ (0, i+1) for i in range(len(Gs)) ]
+        overlap = not getattr(settings, 'no_N', False)
+        Is, Nmis = replica_information([G0]+list(Gs), pairIndexes,
+                                       overlap=overlap)
 
         VI = numpy.mean([_entropy(G0) + _entropy(G) - 2*mi
                          for (G, mi) in zip(Gs, Is)])
@@ -301,12 +395,8 @@ class MultiResolution(object):
                    ('VI_0', VI),
                    ('In_0', In),
                    ]
-        # Avoid calculating N when n_mean is <= 5.  This is because it
-        # takes too long due to the hard recursive and pair-to-pair
-        # calculations it requires.
-        if Gs[0].n_mean() > 5 and not getattr(settings, 'no_N', False):
-            Nmi = numpy.mean(
-                [ util.mutual_information_overlap(G0, G) for G in Gs ])
+        if overlap:
+            Nmi = numpy.mean(Nmis)
         else:
             Nmi = float('nan')
         returns.append(('N_0',  Nmi))
@@ -314,9 +404,8 @@ class MultiResolution(object):
         # do overlap stuff, if needed.
         if 'ovGs' in data:
             ovGs = data['ovGs']
-            Nmi = numpy.mean(
-                [ util.mutual_information_overlap(G0, G) for G in ovGs ])
-            returns.append(('ov_N_0', Nmi))
+            _, Nmis = replica_information([G0]+list(ovGs), pairIndexes)
+            returns.append(('ov_N_0', numpy.mean(Nmis)))
 
         return returns
 
@@ -326,13 +415,9 @@ class MultiResolution(object):
         overlapGs = data.get('ovGs', None)
         if overlapGs is None:
             return [ ]
-        # Avoid calculating N when n_mean is <= 5.  This is because it
-        # takes too long due to the hard recursive and pair-to-pair
-        # calculations it requires (same as above).
-        if Gs[0].n_mean() > 5 and not getattr(settings, 'no_N', False):
-            NmiO = numpy.mean(
-                [ util.mutual_information_overlap(overlapGs[i], overlapGs[j])
-                  for i,j in data['pairIndexes'] ])
+        if not getattr(settings, 'no_N', False):
+            _, Nmis = replica_information(overlapGs, data['pairIndexes'])
+            NmiO = numpy.mean(Nmis)
         else:
             NmiO = float('nan')
         n_mean_ov = sum(G.n_mean() for G in overlapGs)/float(len(overlapGs))
@@ -786,6 +871,7 @@ class MultiResolution(object):
         this is larger and thus is not saved)."""
         data = { }
         data['gamma'] = state['gamma']
+        data['warmstart_gamma'] = state.get('warmstart_gamma')
         Gs_copy = [ G.copy() for G in Gs ]
         [ G_copy.setcmtystate(s) for G_copy, s in zip(Gs_copy, state['Gs']) ]
         data['Gs'] = Gs_copy
@@ -884,6 +970,28 @@ class MRRunner(object):
         """
         if callback is None:
             callback = self._callback
+        data, state = self._minimize_gamma(gamma)
+        # Do the information theory VI, MI, In, etc, stuff on our
+        # minimized replicas.
+        logger.info("Thread %s initializing MRD g=%f"%(
+                                              self.thread_id(), gamma))
+        self.MR.add(gamma=gamma, data=data, state=state)
+
+        logger.debug("Thread %s initializing MRD g=%f: done"%(
+                                              self.thread_id(), gamma))
+        self._finish_gamma(gamma, data, state, callback)
+    def _minimize_gamma(self, gamma, warm=None, savestate=None):
+        """Minimize all replicas at one gamma.
+
+        warm: (gamma, replica states) to start from if warm starting,
+        default is the nearest finished gamma (see _getWarmStates).
+        savestate: include the community states in the returned state
+        dict, default self.MR.savestate.
+
+        Returns (data, state)."""
+        if savestate is None:
+            savestate = (self.MR.savestate
+                         or getattr(self.MR, 'checkpoint', None) is not None)
         logger.info("Thread %s MR-minimizing g=%f"%(self.thread_id(), gamma))
 
         data = { }
@@ -892,22 +1000,41 @@ class MRRunner(object):
         data['gamma'] = gamma
         state['gamma'] = gamma
         # Minimize the main systems
+        minimizerargs = self.MR.minimizerargs
+        warmGamma, warmStates = None, None
+        if getattr(self.MR, 'warmstart', False):
+            if warm is None:
+                warm = self._getWarmStates(gamma)
+            warmGamma, warmStates = warm
+            if warmGamma is not None and self.MR.minimizer == 'trials':
+                minimizerargs = dict(minimizerargs, initial='current')
+        data['warmstart_gamma'] = state['warmstart_gamma'] = warmGamma
         minGs = [ ]
-        for G in self._Gs:
+        for i, G in enumerate(self._Gs):
             if self._lock:  self._lock.acquire()
             G = G.copy()
             if self._lock:  self._lock.release()
-            getattr(G, self.MR.minimizer)(gamma, **self.MR.minimizerargs)
+            if warmStates is not None:
+                G.setcmtystate(warmStates[i])
+                self._perturb(G, getattr(self.MR, 'warmstart_perturb', 0))
+            changes = getattr(G, self.MR.minimizer)(gamma, **minimizerargs)
+            # trials() sets this itself, record it for other minimizers.
+            if self.MR.minimizer != 'trials' and changes is not None:
+                G.nChanges = changes
             minGs.append(G)
+        if getattr(self.MR, 'warmstart', False):
+            if self._lock:  self._lock.acquire()
+            self._warmStates[gamma] = [ G.getcmtystate() for G in minGs ]
+            if self._lock:  self._lock.release()
         data['Gs'] = minGs
-        if self.MR.savestate:
+        if savestate:
             state['Gs'] = [ G.getcmtystate() for G in minGs ]
 
         # Get the total minimum system:
         Gmin_index, Gmin = min(enumerate(minGs),
                                key=lambda x: x[1].energy(gamma))
         data['Gmin'] = Gmin
-        if self.MR.savestate:
+        if savestate:
             state['Gmin'] = Gmin.getcmtystate()
             state['Gmin_index'] = Gmin_index
 
@@ -921,27 +1048,22 @@ class MRRunner(object):
                          minimizer=overlapMinimizer, **self.MR.ovMinimizerArgs)
                 overlapGs.append(G)
             data['ovGs'] = overlapGs
-            if self.MR.savestate:
+            if savestate:
                 state['ovGs'] = [ G.getcmtystate() for G in overlapGs ]
 
             # Get the total minimum system:
             Gmin_index, Gmin = min(enumerate(overlapGs),
                                    key=lambda x: x[1].energy(gamma))
             data['ovGmin'] = Gmin
-            if self.MR.savestate:
+            if savestate:
                 state['ovGmin'] = Gmin.getcmtystate()
                 state['ovGmin_index'] = Gmin_index
 
         logger.info("Thread %s MR-minimizing g=%f: done"%(
                                                       self.thread_id(), gamma))
-        # Do the information theory VI, MI, In, etc, stuff on our
-        # minimized replicas.
-        logger.info("Thread %s initializing MRD g=%f"%(
-                                              self.thread_id(), gamma))
-        self.MR.add(gamma=gamma, data=data, state=state)
-
-        logger.debug("Thread %s initializing MRD g=%f: done"%(
-                                              self.thread_id(), gamma))
+        return data, state
+    def _finish_gamma(self, gamma, data, state, callback):
+        """Write output, figures and call callback after a gamma."""
         # Save output to a file.
         if self.MR.output is not None and self.lockAcquire(blocking=False):
             logger.debug("Thread %s write"%self.thread_id())
@@ -968,6 +1090,28 @@ class MRRunner(object):
             logger.debug("Thread %s callback"%self.thread_id())
             callback(gamma=gamma, data=data, state=state,
                      MR=self.MR, MRR=self)
+    def _getWarmStates(self, gamma):
+        """Return (gamma, replica states) of the nearest finished gamma.
+
+        Distance is measured in log(gamma).  Returns (None, None) if
+        no gamma has been finished yet."""
+        if self._lock:  self._lock.acquire()
+        try:
+            if not self._warmStates:
+                return None, None
+            nearest = min(self._warmStates,
+                          key=lambda g: abs(log(g) - log(gamma)))
+            return nearest, self._warmStates[nearest]
+        finally:
+            if self._lock:  self._lock.release()
+    def _perturb(self, G, fraction):
+        """Move a random `fraction` of the nodes to random communities."""
+        if not fraction or not G.oneToOne:
+            return
+        n = int(round(fraction * G.N))
+        nodes = numpy.random.permutation(G.N)[:n]
+        G.cmty[nodes] = numpy.random.randint(G.N, size=n)
+        G.cmtyListInit()
     def _thread(self):
         """Thread worker - do gammas until all are exhausted.
 
@@ -983,7 +1127,10 @@ class MRRunner(object):
                 return
             logger.info("Thread %s begin gamma=%f"%(
                 self.thread_id(), gamma))
-            self.do_gamma(gamma)
+            try:
+                self.do_gamma(gamma)
+            finally:
+                self._gammaDone(gamma)
             logger.info("Thread %s end gamma=%f"%(
                 self.thread_id(), gamma))
         logger.info("Thread terminated: %s", self.thread_id())
@@ -1017,18 +1164,73 @@ class MRRunner(object):
                          self.thread_id(), name)
             return getattr(self, '_'+name).release()
     def _getGamma(self):
+        """Return the next gamma to run, or None if all are done.
+
+        While refining, a gamma may only be chosen after gammas which
+        are still running are finished.  Then, if self._gammalock is
+        a threading.Condition (do_mt), this waits until _gammaDone is
+        called.  Otherwise, _WAIT is returned (do_mp then asks again
+        after its next result)."""
         self.lockAcquire(name='gammalock', blocking=True)
         if not hasattr(self, '_seenGammas'):
             self._seenIndexes = set()
             self._seenGammas = set()
-        if isinstance(self._gammas, (list, tuple)):
-            gamma = self._getGamma_list()
-        else:
-            gamma = self._getGamma_dict()
-        self._seenGammas.add(gamma)
+            self._runningGammas = set()
+        while True:
+            if isinstance(self._gammas, (list, tuple)):
+                gamma = self._getGamma_list()
+            elif self._gammas.get('refine'):
+                gamma = self._getGamma_refine()
+            else:
+                gamma = self._getGamma_dict()
+            if gamma is _WAIT:
+                if not self._runningGammas:
+                    gamma = None    # Can not happen, but never hang.
+                elif hasattr(getattr(self, '_gammalock', None), 'wait'):
+                    self._gammalock.wait()
+                    continue
+                break
+            if gamma is not None:
+                gamma = self._matchSkipGamma(gamma)
+            self._seenGammas.add(gamma)
+            if gamma is None or gamma not in self._skipGammas:
+                break
+            # Already done in a previous (checkpointed) run.
+            self._skipGammas.discard(gamma)
+            self._resumeGamma(gamma)
+        if gamma is not None and gamma is not _WAIT:
+            self._runningGammas.add(gamma)
         self.lockRelease(name='gammalock')
         #from fitz import interactnow
         return gamma
+    def _gammaDone(self, gamma):
+        """Mark a gamma from _getGamma as finished (or failed)."""
+        self.lockAcquire(name='gammalock', blocking=True)
+        self._runningGammas.discard(gamma)
+        if hasattr(getattr(self, '_gammalock', None), 'notify_all'):
+            self._gammalock.notify_all()
+        self.lockRelease(name='gammalock')
+
+    def _matchSkipGamma(self, gamma):
+        """Return the gamma in self._skipGammas equal to gamma, if any.
+
+        Gammas are equal to a relative tolerance of 1e-9, since
+        computed gammas (for example refined ones) may not be exactly
+        the same as in the checkpoint.  Otherwise return gamma."""
+        for g in self._skipGammas:
+            if abs(g - gamma) <= 1e-9 * max(abs(g), abs(gamma)):
+                return g
+        return gamma
+    def _resumeGamma(self, gamma):
+        """Use the saved data of a gamma skipped by _getGamma."""
+        if not getattr(self.MR, 'warmstart', False):
+            return
+        state = self.MR._resumed.get(gamma)
+        if state is None or 'Gs' not in state:
+            return
+        if self._lock:  self._lock.acquire()
+        self._warmStates[gamma] = state['Gs']
+        if self._lock:  self._lock.release()
 
     def _getGamma_list(self):
         """Return next gamma, if self._gammas is a list"""
@@ -1047,6 +1249,7 @@ class MRRunner(object):
             if args.get('high') == 'auto':  args.pop('high')
             if args.get('low')  == 'auto':  args.pop('low')
             if args.get('start'):           args.pop('start')
+            args.pop('refine', None)
             self._logGammas = LogInterval(**args)
         logGammas = self._logGammas
 
@@ -1095,7 +1298,12 @@ class MRRunner(object):
             # improve sometime.
             if min(self._seenIndexes) <= self._logGammas.index(.000001):
                 return None
-            doneGammas = sorted(self._seenGammas)
+            # Gammas still running in other threads/processes have
+            # no data yet.
+            doneGammas = sorted(g for g in self._seenGammas
+                                if g in self.MR._data)
+            if not doneGammas:
+                return next_i_low
             qs = [ self.MR._data[g].data['q'].mean
                    for g in doneGammas]
             n_means = [ self.MR._data[g].data['n_mean'].mean
@@ -1154,17 +1362,135 @@ class MRRunner(object):
                 return next_i
             return trylow()
 
+    def _getGamma_refine(self):
+        """Return next gamma, if self._gammas is a dict with 'refine'.
+
+        First the coarse LogInterval of the dict is done exactly as
+        with _getGamma_dict.  Then the interval between neighboring
+        finished gammas with the highest score (_refineScore, times
+        its width) is bisected in log(gamma).  `refine` is either True
+        or a dict of:
+
+        resolution: do not make intervals finer than this many gammas
+        per `interval` (default 8*density).
+        maxtime: stop starting new gammas this many seconds after the
+        first one.
+        maxgammas: stop after this many gammas in total.
+        tol: stop once the highest score is not above this (default 0,
+        so only completely flat regions are left alone).
+        measures: columns used for the score (default ('q', 'q_std',
+        'VI', 'In'), where present).
+        """
+        if not hasattr(self, '_refineStart'):
+            self._refineStart = time.time()
+            self._refining = False
+        if not self._refining:
+            gamma = self._getGamma_dict()
+            if gamma is not None:
+                return gamma
+            self._refining = True
+        opts = self._gammas['refine']
+        if not isinstance(opts, dict):
+            opts = { }
+        maxtime = opts.get('maxtime')
+        if maxtime is not None and time.time()-self._refineStart > maxtime:
+            return None
+        gammas = sorted(g for g in self._seenGammas if g is not None)
+        maxgammas = opts.get('maxgammas')
+        if maxgammas is not None and len(gammas) >= maxgammas:
+            return None
+        resolution = opts.get('resolution')
+        if resolution is None:
+            resolution = 8 * self._logGammas.density
+        minwidth = 2 * self._logGammas.density / float(resolution)
+        tol = opts.get('tol', 0)
+
+        best, bestScore = None, tol
+        waiting = False
+        for g1, g2 in zip(gammas[:-1], gammas[1:]):
+            # Gammas still running in other threads/processes have no
+            # data yet.
+            if g1 not in self.MR._data or g2 not in self.MR._data:
+                waiting = True
+                continue
+            width = self._logGammas.index(g2) - self._logGammas.index(g1)
+            if width < minwidth * (1 - 1e-6):
+                continue
+            score = width * self._refineScore(g1, g2, opts.get('measures'))
+            if score > bestScore:
+                best, bestScore = (g1, g2), score
+        if best is None:
+            if waiting:
+                return _WAIT
+            return None
+        return exp(.5 * (log(best[0]) + log(best[1])))
+
+    def _refineScore(self, g1, g2, measures=None):
+        """How much the interval between finished gammas g1, g2 needs refining.
+
+        The sum of the relative change of q, the relative spread of q
+        between replicas (q_std/q), VI normalized by log2(nodes), and
+        1-In, each for whichever of these columns exist.  The last
+        three are averaged over both ends."""
+        if measures is None:
+            measures = ('q', 'q_std', 'VI', 'In')
+        d1 = self.MR._data[g1].data
+        d2 = self.MR._data[g2].data
+        def value(d, name):
+            if name not in d:
+                return None
+            v = d[name].mean
+            if v is None or v != v:   # nan
+                return None
+            return v
+        score = 0.
+        for name in measures:
+            v1, v2 = value(d1, name), value(d2, name)
+            if v1 is None or v2 is None:
+                continue
+            if name == 'q':
+                score += abs(log(max(v1, 1)) - log(max(v2, 1)))
+            elif name == 'q_std':
+                q1, q2 = value(d1, 'q') or 1, value(d2, 'q') or 1
+                score += .5 * (v1/max(q1, 1) + v2/max(q2, 1))
+            elif name == 'VI':
+                N = max(value(d1, 'nodes') or 2, 2)
+                score += .5 * (v1 + v2) / log(N, 2)
+            elif name == 'In':
+                score += 1 - .5 * (v1 + v2)
+            else:
+                score += abs(v2 - v1)
+        return score
+
     def do(self, Gs, gammas=None,
            threads=1, callback=None,
-           extradata={}):
-        """Do multi-resolution analysis on replicas Gs with `trials` each."""
+           extradata={}, processes=None):
+        """Do multi-resolution analysis on replicas Gs with `trials` each.
+
+        gammas: a list of gammas, or a dict of LogInterval arguments
+        (low, high, density, ...; low and high may be 'auto').  If the
+        dict has refine=True (or a dict of options), the log interval
+        is only a coarse first sweep, after which gammas are added
+        where the results change most (see _getGamma_refine).
+
+        threads: run gammas in this many threads (see do_mt).
+
+        processes: run gammas in a pool of this many processes (see
+        do_mp)."""
         # If multiple threads requested, do that version instead:
         #if gammas is None and logGammaArgs is not None:
         #    gammas = LogInterval(**logGammaArgs).values()
         #if gammas is None:
         #    raise ValueError("Either gammas or logGammaArgs must be given.")
+        if isinstance(gammas, list):
+            gammas = list(gammas)   # _getGamma_list pops from it
         self._gammas = gammas
         self.extradata = extradata
+        # Gammas loaded from a checkpoint are not run again.
+        self._skipGammas = set(getattr(self.MR, '_resumed', ()))
+        if processes:
+            return self.do_mp(Gs, gammas, processes=processes,
+                              callback=callback)
         if threads > 1:
             return self.do_mt(Gs, gammas, threads=threads,
                               callback=callback)
@@ -1172,15 +1498,17 @@ class MRRunner(object):
         # Non threaded version:
         self._callback = callback
         self._Gs = Gs
+        self._warmStates = { }
         self.replicas = len(Gs)
         while True:
             gamma = self._getGamma()
             if gamma is None:
                 break
             self.do_gamma(gamma)
+            self._gammaDone(gamma)
             if self._output:
                 self.write(self._output)
-        del self._Gs
+        del self._Gs, self._warmStates
         del self._callback # unmasks the class object's _callback=None
         del self.extradata
 
@@ -1189,12 +1517,13 @@ class MRRunner(object):
 
         Multi-threaded version."""
         self._Gs = Gs
+        self._warmStates = { }
         self._callback = callback
         self.replicas = len(Gs)
 
         import threading
         self._lock = threading.Lock()
-        self._gammalock = threading.Lock()
+        self._gammalock = threading.Condition()
         self._writelock = threading.Lock()
 
         # Start the threads
@@ -1210,9 +1539,98 @@ class MRRunner(object):
             t.join()
 
         #self._queue.join()
-        del (self._Gs, self._gammalock, self._lock, self._writelock, )
+        del (self._Gs, self._gammalock, self._lock, self._writelock,
+             self._warmStates)
+        del self._callback # unmasks class object's _callback=None
+
+    def do_mp(self, Gs, gammas, processes=2, callback=None):
+        """Do multi-resolution analysis on replicas Gs with `trials` each.
+
+        Multi-process version.  The interaction arrays of Gs are moved
+        to shared memory and the worker processes are forked, so they
+        get the graphs once.  Gammas are still chosen by _getGamma in
+        this process.  Workers minimize and run the calcMethods, and
+        return the (name, value) rows, which are merged into self.MR
+        here, and the community states only if something here needs
+        them (MR.savestate, warm starts, figures or the callback).
+        Output, figures and the callback are also done here (data for
+        figures and callback is re-created from the states)."""
+        global _mr_runner
+        self._Gs = Gs
+        self._warmStates = { }
+        self._callback = callback
+        self.replicas = len(Gs)
+        self._lock = threading.Lock()
+        for G in Gs:
+            G._shareArrays(G._readonly_arrays)
+        warmstart = getattr(self.MR, 'warmstart', False)
+        savestate = (self.MR.savestate or warmstart or callback is not None
+                     or self.MR.savefigargs is not None
+                     or getattr(self.MR, 'checkpoint', None) is not None)
+
+        _mr_runner = self
+        pool = multiprocessing.Pool(processes)
+        done = Queue.Queue()
+        running = 0
+        try:
+            while True:
+                # Keep every process busy.
+                while running < processes:
+                    gamma = self._getGamma()
+                    if gamma is None or gamma is _WAIT:
+                        break
+                    warm = None
+                    if warmstart:
+                        warm = self._getWarmStates(gamma)
+                    pool.apply_async(_mr_worker,
+                                     ((gamma, warm, savestate,
+                                       random.randrange(2**31-1)), ),
+                                     callback=done.put)
+                    running += 1
+                if running == 0:
+                    break
+                gamma, rows, state, Ns, error = done.get()
+                running -= 1
+                self._gammaDone(gamma)
+                if error is not None:
+                    raise RuntimeError("Error at gamma=%s in worker:\n%s"%(
+                        gamma, error))
+                with self._lock:
+                    # Only the workers ran MR.calc.
+                    self.MR.checkN(Ns)
+                    self.MR.addrows(gamma, rows, state)
+                    if warmstart:
+                        self._warmStates[gamma] = state['Gs']
+                data = None
+                if self.MR.savefigargs is not None or callback:
+                    data = dict(self.extradata)
+                    data.update(self.MR.getData(state, Gs))
+                self._finish_gamma(gamma, data, state, callback)
+        finally:
+            pool.terminate()
+            pool.join()
+            _mr_runner = None
+        del self._Gs, self._warmStates, self._lock
         del self._callback # unmasks class object's _callback=None
 
+def _mr_worker(args):
+    """Minimize and analyze one gamma of MRRunner.do_mp.
+
+    Returns (gamma, rows, state, Ns, error), where Ns are the
+    numbers of nodes of the replicas."""
+    gamma, warm, savestate, seed = args
+    try:
+        cmodels.C.init_gen_rand(seed)
+        random.seed(seed)
+        numpy.random.seed(seed)
+        runner = _mr_runner
+        data, state = runner._minimize_gamma(gamma, warm=warm,
+                                             savestate=savestate)
+        rows = runner.MR.calc(gamma, data)
+        return gamma, rows, state, [G.N for G in data['Gs']], None
+    except Exception:
+        return gamma, None, None, None, traceback.format_exc()
+
 
 
 def write_table(fname, MRs, values, Vname='V', headerlines=[]):
@@ -1,4 +1,5 @@
 from math import log
+import numpy
 
 from pcd.util import Averager
 import cmodels
@@ -132,3 +133,106 @@ def mutual_information_overlap(G0, G1, weighted=False):
     return N
 N = mutual_information_overlap
 
+
+
+#
+# All pairs of replicas at once
+#
+def _h_array(p):
+    """h(p) of an array, elementwise."""
+    p = numpy.asarray(p, dtype=float)
+    out = numpy.zeros(p.shape)
+    mask = (p > 0) & (p < 1)
+    out[mask] = -p[mask] * numpy.log2(p[mask])
+    return out
+def _replica_memberships(G):
+    """Return (M, sizes) of a replica.
+
+    M is a sparse (N x K) 0/1 matrix of node membership in the K
+    non-empty communities of G, and sizes their number of nodes."""
+    import scipy.sparse
+    if G.oneToOne:
+        nodes = numpy.arange(G.N)
+        cmtys = G.cmty[:G.N]
+    else:
+        state = G.getcmtystate()
+        offsets = state['cmtyOffsets']
+        nodes = state['cmtyMembers']
+        cmtys = numpy.repeat(numpy.arange(len(offsets)-1),
+                             numpy.diff(offsets))
+    # Renumber to the non-empty communities only.
+    labels, cmtys = numpy.unique(cmtys, return_inverse=True)
+    M = scipy.sparse.csc_matrix(
+        (numpy.ones(len(nodes), dtype=float), (nodes, cmtys)),
+        shape=(G.N, len(labels)))
+    sizes = numpy.bincount(cmtys, minlength=len(labels)).astype(float)
+    return M, sizes
+def _HX_Ynorm_bulk(N, nX, nY, iX, iY, n11):
+    """HX_Ynorm given community sizes and the non-zero intersections.
+
+    nX, nY: sizes of the communities of X and Y.  iX, iY, n11: the
+    community pairs with non-zero intersection, and its size.
+
+    The same as HX_Ynorm_c (unweighted).  H2(cX, cY) is only finite if
+    h(p11)+h(p00) > h(p10)+h(p01).  For disjoint communities that
+    requires nX+nY > N/2 (h is subadditive, and h(1-p) <= h(p) for p <=
+    1/2), so only those pairs with no intersection are considered."""
+    N = float(N)
+    KX, KY = len(nX), len(nY)
+    nzkeys = iX * KY + iY
+    # Pairs with nX+nY >= N/2: for each cX, a suffix of Y sorted by size.
+    orderY = numpy.argsort(nY, kind='mergesort')
+    start = numpy.searchsorted(nY[orderY], N/2. - nX, side='left')
+    counts = KY - start
+    cX_big = numpy.repeat(numpy.arange(KX), counts)
+    pos = numpy.arange(counts.sum()) - numpy.repeat(
+        numpy.cumsum(counts) - counts, counts) + numpy.repeat(start, counts)
+    keys = numpy.union1d(nzkeys, cX_big * KY + orderY[pos])
+    # Intersection sizes of these pairs (0 if not in nzkeys).
+    n = numpy.zeros(len(keys))
+    n[numpy.searchsorted(keys, nzkeys)] = n11
+    cX, cY = keys // KY, keys % KY
+    a, b = nX[cX], nY[cY]
+    hP11 = _h_array(n / N)
+    hP10 = _h_array((a - n) / N)
+    hP01 = _h_array((b - n) / N)
+    hP00 = _h_array((N - a - b + n) / N)
+    H2 = hP11 + hP00 + hP01 + hP10 - _h_array(b / N) - _h_array((N-b) / N)
+    H2[hP11 + hP00 <= hP01 + hP10] = numpy.inf
+    HX_Y = numpy.empty(KX)
+    HX_Y.fill(numpy.inf)
+    numpy.minimum.at(HX_Y, cX, H2)
+    HX = _h_array(nX / N) + _h_array((N - nX) / N)
+    HX_Y = numpy.where(numpy.isinf(HX_Y), HX, HX_Y)
+    ratio = numpy.zeros(KX)
+    ratio[HX != 0] = HX_Y[HX != 0] / HX[HX != 0]
+    return ratio.mean()
+def replica_information(Gs, pairIndexes, overlap=True):
+    """Mutual informations of many pairs of replicas at once.
+
+    The community memberships of every replica are made into a sparse
+    node x community matrix once, and the confusion table of each pair
+    (i, j) in pairIndexes is one sparse product of these.  Returns
+    (I, N): arrays with the mutual information (as
+    mutual_information) and, if overlap is true, the LF overlap
+    mutual information (as mutual_information_overlap) of each pair.
+    N is None if not overlap.
+    """
+    Ms = { }
+    for i, j in pairIndexes:
+        for r in (i, j):
+            if r not in Ms:
+                Ms[r] = _replica_memberships(Gs[r])
+    I = numpy.zeros(len(pairIndexes))
+    NMI = numpy.zeros(len(pairIndexes)) if overlap else None
+    for k, (i, j) in enumerate(pairIndexes):
+        assert Gs[i].N == Gs[j].N
+        N = float(Gs[i].N)
+        (Mi, ni), (Mj, nj) = Ms[i], Ms[j]
+        T = (Mi.T * Mj).tocoo()
+        iX, iY, n11 = T.row, T.col, T.data
+        I[k] = numpy.sum(n11/N * numpy.log2(n11*N / (ni[iX]*nj[iY])))
+        if overlap:
+            NMI[k] = 1 - .5 * (_HX_Ynorm_bulk(N, ni, nj, iX, iY, n11)
+                               + _HX_Ynorm_bulk(N, nj, ni, iY, iX, n11))
+    return I, NMI
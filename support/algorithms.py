@@ -1508,11 +1508,13 @@ class _PCD_single(CDMethod):
     initial = None # initial state for each minimization attempt.  Default is 'random'.
                    # Same as Graph.trials(initial=)
     _map_nodes_to_int = False
+    sparse = False  # Use a sparse-only Graph.
+    prune_trees = False  # Contract dangling leaves before minimizing.
     def _initG(self, G):  # for subclassing
         pass
     def run(self):
         from pcd.old.models import Graph
-        G = Graph.fromNetworkX(self.g)
+        G = Graph.fromNetworkX(self.g, sparse=self.sparse)
         G.verbosity = self.verbosity
         if self.const_q:
             G.const_q = self.const_q
@@ -1525,11 +1527,25 @@ class _PCD_single(CDMethod):
             initial = initial.to_pcd_cmtystate(G)
         if initial is None:
             initial = 'random'
-        G.trials(gamma=self.gamma, trials=self.trials,
-                 minimizer=self.minimizer, #kwargs are args to minimizer
-                 initial=initial,
-                 **kwargs
-                 )
+        P = None
+        if self.prune_trees:
+            # Minimize only the core, with each dangling leaf
+            # contracted into its neighbor, then put the leaves back.
+            if initial != 'random':
+                G.setcmtystate(initial)
+                initial = 'current'
+            P, groups = G.pruned(self.gamma)
+        if P is not None:
+            P.trials(gamma=self.gamma, trials=self.trials,
+                     minimizer=self.minimizer, initial=initial,
+                     **kwargs)
+            G.loadFromPruned(P, groups, gamma=self.gamma)
+        else:
+            G.trials(gamma=self.gamma, trials=self.trials,
+                     minimizer=self.minimizer, #kwargs are args to minimizer
+                     initial=initial,
+                     **kwargs
+                     )
         self.G = G
         self.cmtys = pcd.cmty.Communities.from_pcd(G)
         self.results = [ self.cmtys ]
@@ -1572,6 +1588,7 @@ class APMAnneal(_PCD_SA, _PCD_single):
 # PCD modularity methods
 class _PCDmod(object):
     gamma = 1  # required for modularity
+    sparse = True  # implicit null model, O(N+E) memory
     def _initG(self, G):
         G.enableModularity(mode=None)
     def _finalize(self, G):
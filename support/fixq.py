@@ -66,7 +66,8 @@ class FixQ(pcd.support.algorithms.CDMethod):
             raise ValueError("All %s results return fewer than q communities."%self.parent_method.name())
         cmtys = results[-1]
 
-        G = Graph.fromNetworkX(g)
+        # Modularity uses an implicit null model on a sparse Graph.
+        G = Graph.fromNetworkX(g, sparse=(self.Emode == 'mod'))
         cmtys.load_pcd(G)
         #from fitz import interactnow
         if self.Emode == 'mod':
@@ -6,6 +6,7 @@ import numpy
 import os
 
 import pcd
+import pcd.util
 
 def e_r6_i(d,sigma,epsilon=1):
     energy = -epsilon*(sigma/d)**6
@@ -59,8 +60,26 @@ def get_imatrix(coords,sigmas, atomtypes, boxsize=None):
     numpy.seterr(**orig_settings)
     return imatrix
 
-
-def load_bss2d(fname='2dss32_n240_T0.5_1.gro'):
+def get_graph(coords, sigmas, atomtypes, boxsize=None, cutoff=None):
+    """Sparse Graph of e_r6_i interactions, using cell lists.
+
+    Only pairs closer than `cutoff` are evaluated, and all others get
+    the e_r6_i value at infinity (+500).  After rounding, this is
+    exact for cutoff >= 3.6*sigmas.max().  If cutoff is None, use
+    get_imatrix and a full Graph.
+    """
+    if cutoff is None:
+        imatrix = get_imatrix(coords, sigmas, atomtypes, boxsize=boxsize)
+        return pcd.Graph.from_imatrix(imatrix)
+    rows, cols, dist = pcd.util.cell_list_pairs(coords, cutoff,
+                                                boxsize=boxsize)
+    sigma = sigmas[numpy.asarray(atomtypes)[rows], cols]
+    e = e_r6_i(dist, sigma)
+    far = e_r6_i(numpy.inf, 1)
+    return pcd.Graph.from_pairs(len(coords), rows, cols, e, default=far)
+
+
+def load_bss2d(fname='2dss32_n240_T0.5_1.gro', cutoff=None):
     if '/' not in fname:
         testsdir = os.path.dirname(__file__)
         datadir = (os.path.join(testsdir,'./../data'))
@@ -77,16 +96,15 @@ def load_bss2d(fname='2dss32_n240_T0.5_1.gro'):
     sigmas=numpy.array((sigma1,sigma2))
     radii=numpy.concatenate(( numpy.ones(ntypea),1.4*numpy.ones(ntypeb) ))
 
-    imatrix=get_imatrix(coords,sigmas,atomtypes,boxsize=L)
-
-    G = pcd.Graph.from_imatrix(imatrix)
+    G = get_graph(coords, sigmas, atomtypes, boxsize=L, cutoff=cutoff)
     G.coords = coords
     G.boxsize = L
     G.radii = radii
     return G
 
 
-def load_pysim(fname="2dss_n23040_T0.40.atomdump", openargs={}):
+def load_pysim(fname="2dss_n23040_T0.40.atomdump", openargs={},
+               cutoff=None):
     if '/' not in fname:
         testsdir = os.path.dirname(__file__)
         datadir = (os.path.join(testsdir,'./../data'))
@@ -115,11 +133,9 @@ def load_pysim(fname="2dss_n23040_T0.40.atomdump", openargs={}):
     assert (sigmas != 0).all()
     assert (radii  != 0).all()
 
-    imatrix = get_imatrix(coords, sigmas, boxsize=boxsize,
-                          atomtypes=atomtypes-1) # reindex atomtypes, -1
-
-
-    G = pcd.Graph.from_imatrix(imatrix)
+    G = get_graph(coords, sigmas, boxsize=boxsize,
+                  atomtypes=atomtypes-1, # reindex atomtypes, -1
+                  cutoff=cutoff)
     G.coords = coords
     G.boxsize = boxsize
     G.radii = radii
@@ -1,10 +1,14 @@
 # Richard Darst, October 2013
 
+import cPickle
 import os
 from os.path import join, dirname
+import shutil
+import tempfile
 import unittest
 
 import networkx
+import numpy
 import pcd
 import cmty
 
@@ -62,6 +66,120 @@ def test_iter():
     assert cmtys.label == 'test-communities2'
 
 
+def test_file_index():
+    tmpdir = tempfile.mkdtemp(prefix='pcd-test-')
+    try:
+        fname = join(tmpdir, 'cmtys.txt')
+        cmty.Communities(cmtynodes).write_clusters(fname)
+        cmtys_ref = cmty.CommunityFile(fname, converter=int, index=False)
+        items = list(cmtys_ref.iteritems())
+        cmtys = cmty.CommunityFile(fname, converter=int, index=True)
+        assert len(cmtys) == 3
+        assert cmtys.N == 10
+        assert cmtys._N is None   # counted by the index
+        assert os.path.exists(fname+'.idx')
+        memberships = sum(len(nodes) for nodes in cmtynodes.values())
+        for chunksize in (4, 2**24):
+            index = cmty._CommunityFileIndex.build(fname, ints=True,
+                                                   chunksize=chunksize)
+            assert index.N == 10
+            assert index.memberships == memberships
+        # Other node names are not counted in the index.
+        index = cmty._CommunityFileIndex.build(fname)
+        assert index.N == -1 and index.memberships == memberships
+        cmtys_str = cmty.CommunityFile(fname, index=True)
+        cmtys_str.build_index(write=False)
+        assert cmtys_str.N == 10
+        # A new object uses the index on disk.
+        cmtys = cmty.CommunityFile(fname, converter=int)
+        assert isinstance(cmtys._get_index().offsets, numpy.memmap)
+        assert list(cmtys.iteritems()) == items
+        assert list(cmtys.iteritems(1, 3)) == items[1:3]
+        for cname, nodes in items:
+            assert cmtys[cname] == nodes == cmtynodes[cname]
+        assert sum((list(cmtys.iteritems(start, stop))
+                    for start, stop in cmtys.chunk_ranges(2)), []) == items
+        # Changing the file makes the index stale.
+        open(fname, 'a').write('\n')
+        os.utime(fname, (0, 0))
+        assert cmty.CommunityFile(fname)._get_index() is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_file_int():
+    # The numpy parser for integer nodes agrees with the line parser.
+    tmpdir = tempfile.mkdtemp(prefix='pcd-test-')
+    try:
+        fname = join(tmpdir, 'cmtys.txt')
+        f = open(fname, 'w')
+        f.write('# community names: a b c\n1 2 3\n\n 4\t5 5 \r\n'
+                '# comment\n10 7')
+        f.close()
+        cmtys = cmty.CommunityFile(fname, converter=int)
+        cmtys_lines = cmty.CommunityFile(fname, converter=lambda x: int(x))
+        assert list(cmtys.iteritems()) == list(cmtys_lines.iteritems())
+        assert [(c, list(a)) for c, a in cmtys.iterarrays(chunksize=4)] \
+               == [('a', [1, 2, 3]), ('b', [4, 5, 5]), ('c', [10, 7])]
+        cmtys_c = cmtys.to_full(cls=cmty.CompactCommunities)
+        assert isinstance(cmtys_c, cmty.CompactCommunities)
+        assert cmtys_c.to_dict() == cmtys_lines.to_dict()
+        cmty._test_interface(cmtys_c)
+        # Malformed tokens raise, also at the end of a chunk.
+        for last in ('4.0', '0x10', '2x', '-', '99999999999999999999'):
+            f = open(fname, 'w')
+            f.write('1 2\n3 %s'%last)
+            f.close()
+            cmtys = cmty.CommunityFile(fname, converter=int)
+            assert_raises(ValueError, list, cmtys.iterarrays())
+            assert_raises(ValueError, list, cmtys.iterarrays(chunksize=4))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_binary():
+    # Binary files round-trip, through from_binary and CommunityFile.
+    tmpdir = tempfile.mkdtemp(prefix='pcd-test-')
+    try:
+        fname = join(tmpdir, 'cmtys.bin')
+        for cmtys in (cmty.Communities(cmtynodes),
+                      cmty.Communities({0:set('abc'), 1:set(['de', 7])},
+                                       nodes=set(['a','b','c','de',7,'z'])),
+                      cmty.CompactCommunities.from_membershiplist(
+                          [2, 2, 1, 0, 0, 0]),
+                      ):
+            cmtys.label = 'test label'
+            cmtys.write_binary(fname)
+            cmtys_b = cmty.CompactCommunities.from_binary(fname)
+            cmty._test_interface(cmtys_b)
+            assert cmtys_b.to_dict() == cmtys.to_dict()
+            assert cmtys_b.nodes == cmtys.nodes
+            assert cmtys_b.label == 'test label'
+            cmtys_d = cmty.Communities.from_binary(fname)
+            assert cmtys_d.to_dict() == cmtys.to_dict()
+            assert cmtys_d.nodes == cmtys.nodes
+            cmtys_f = cmty.CommunityFile(fname)
+            assert cmtys_f.label == 'test label'
+            assert len(cmtys_f) == len(cmtys)
+            assert cmtys_f.to_dict() == cmtys.to_dict()
+            assert cmtys_f.to_full().nodes == cmtys.nodes
+            assert list(cmtys_f.iteritems(1, 2)) \
+                   == list(cmtys_b.iteritems())[1:2]
+        assert isinstance(cmtys_b._indices, numpy.memmap)
+        assert [(c, list(a)) for c, a in cmtys_f.iterarrays()] \
+               == [(0, [3, 4, 5]), (1, [2]), (2, [0, 1])]
+        # Identity labels: N is read from the header, with the
+        # universe of nodes beyond the largest member.
+        cmtys = cmty.CompactCommunities([0, 2, 3], [1, 2, 5],
+                                        universe=True, nids=10)
+        cmtys.write_binary(fname)
+        cmtys_b = cmty.CompactCommunities.from_binary(fname)
+        assert cmtys_b._labels is None and cmtys_b._nids == 10
+        assert cmtys_b.N == 10 and cmtys_b.nodes == set(range(10))
+        assert cmtys_b.to_dict() == {0:set((1, 2)), 1:set((5,))}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def test_filter():
     # Test some filters
     cmtys = cmty.Communities(cmtynodes)
@@ -107,6 +225,81 @@ def test_union():
     #print list(cU.iteritems())
     cmty._test_interface(cU)
 
+def test_compact():
+    # Array-based communities behave like the dict-based ones.
+    cmtys = cmty.Communities(cmtynodes)
+    cmtys_c = cmty.CompactCommunities.from_dict(cmtynodes)
+    cmty._test_interface(cmtys_c)
+    assert cmtys_c.to_dict() == cmtys.to_dict()
+    assert dict(cmtys_c.nodecmtys()) == cmtys.nodecmtys()
+    assert cmtys_c.cmtysizes() == cmtys.cmtysizes()
+    assert cmtys_c['b'] == set((3, 4, 5, 6))
+    assert cmtys_c.overlap() == 1.1
+    assert not cmtys_c.is_non_overlapping()
+    try:
+        cmtys_c.nodecmtys_onetoone()
+        raise AssertionError("OverlapError not raised")
+    except cmty.OverlapError:
+        pass
+
+    # Node universe and non-integer nodes.
+    cmtys_c = cmty.CompactCommunities.from_dict({0:set('abc'), 5:set('de')},
+                                                nodes=set('abcdefg'))
+    cmty._test_interface(cmtys_c)
+    assert cmtys_c.N == 7
+    assert cmtys_c.nodes_spanned() == set('abcde')
+    assert dict(cmtys_c.nodecmtys_onetoone()) == \
+           dict(a=0, b=0, c=0, d=5, e=5)
+
+    # Membership lists.
+    lst = [2, 2, 1, 1, 0, 'x']
+    cmtys_c = cmty.CompactCommunities.from_membershiplist(lst)
+    assert cmtys_c.to_dict() == \
+           cmty.Communities.from_membershiplist(lst).to_dict()
+    assert cmtys_c.is_partition()
+    # The number of node ids is found only once.
+    assert cmtys_c.nodecmtys_onetoone()[4] == 0
+    assert cmtys_c._nids == 6
+
+
+def test_cache():
+    # Derived indexes are cached, and invalidated by changes, also
+    # through views.
+    cmtys = cmty.Communities(dict(cmtynodes))
+    nodecmtys = cmtys.nodecmtys()
+    assert cmtys.nodecmtys() is nodecmtys
+    cmtys_filter = cmty.CmtyLimitNodes(cmtys, set((0, 3, 10)))
+    cmtys_union = cmty.CommunityUnion((cmtys, cmtys_filter), dup_ok=True)
+    assert cmtys_filter.nodes_spanned() == set((0, 3))
+    assert cmtys_union.cmtysizes_sum() == 14
+    cmtys['d'] = set((10, 11))
+    assert cmtys.nodecmtys() is not nodecmtys
+    assert cmtys.nodecmtys()[10] == set('d')
+    assert cmtys.N == 12
+    assert cmtys_filter.nodes_spanned() == set((0, 3, 10))
+    assert len(cmtys_union.nodes_spanned()) == 12
+    # Copies have their own cache.
+    cmtys2 = cmtys.copy()
+    del cmtys2['d']
+    assert cmtys2.N == 10
+    assert cmtys.N == 12
+    # new=True mappings are always new.
+    assert cmtys.cmtyintmap() is cmtys.cmtyintmap()
+    assert cmtys.cmtyintmap(new=True) is not cmtys.cmtyintmap(new=True)
+    assert cmtys.nodeintmap(new=True) is not cmtys.nodeintmap(new=True)
+    # Caches are not pickled.
+    cmtys_c = cmty.CompactCommunities.from_iter(cmtys.iteritems())
+    for c in (cmtys, cmtys_c):
+        size = len(cPickle.dumps(c, -1))
+        c.nodecmtys()[10]
+        c.cmtysizes()
+        c.cmtyintmap()
+        c2 = cPickle.loads(cPickle.dumps(c, -1))
+        assert len(cPickle.dumps(c, -1)) == size
+        assert c2.nodecmtys()[10] == set('d')
+        assert c2.to_dict() == c.to_dict()
+
+
 def test_cmty_graph():
     # Test cmty_graph:
     g = networkx.complete_graph(7)
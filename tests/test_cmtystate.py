@@ -0,0 +1,70 @@
+import cPickle as pickle
+
+import numpy
+
+import pcd.cmty
+import pcd.graphs
+from pcd.old.models import Graph
+
+def cmtysets(G):
+    return dict((c, frozenset(G.cmtyContents(c))) for c in G.cmtys())
+
+def v0state(G):
+    """State in the old (version 0) dict-of-tuples format."""
+    return dict(version=0, oneToOne=G.oneToOne,
+                hasPrimaryCmty=G.hasPrimaryCmty,
+                cmtyContents=dict((c, tuple(G.cmtyContents(c)))
+                                  for c in G.cmtys()),
+                cmtyList=tuple(G.cmty))
+
+
+def test_cmtystate():
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g, sparse=True)
+    G.verbosity = -1
+    G.minimize(.5)
+    G2 = Graph.fromNetworkX(g, sparse=True)
+
+    for overlap in (False, True):
+        if overlap:
+            G.ovGreedy(.5)
+            assert not G.oneToOne
+        state = G.getcmtystate()
+        assert isinstance(state['cmty'], numpy.ndarray)
+        for s in (state, pickle.loads(pickle.dumps(state, -1)), v0state(G)):
+            G2.cmtyCreate()
+            G2.setcmtystate(s)
+            G2.check()
+            assert G2.oneToOne == G.oneToOne
+            assert G2.q == G.q
+            assert cmtysets(G2) == cmtysets(G)
+            assert (G2.cmty == G.cmty).all()
+            assert G2.energy(.5) == G.energy(.5)
+
+    # Loading from Communities objects goes through the same path.
+    cmtys = pcd.cmty.Communities.from_pcd(G)
+    G3 = cmtys.to_pcd()
+    assert G3.q == G.q
+    assert not G3.oneToOne
+
+
+def test_replica_information():
+    # The bulk pairwise comparison matches the one-pair functions.
+    from pcd.old.util import replica_information, \
+         mutual_information_python, mutual_information_overlap_python
+    g = pcd.graphs.karate_club()
+    Gs = [ ]
+    for gamma in (.05, .5, 5, 50):
+        G = Graph.fromNetworkX(g)
+        G.verbosity = -1
+        G.greedy(gamma)
+        Gs.append(G)
+    G = Gs[1].copy()
+    G.ovGreedy(.2)
+    Gs.append(G)
+    pairs = [ (i, j) for i in range(len(Gs)) for j in range(len(Gs)) ]
+    I, N = replica_information(Gs, pairs)
+    for (i, j), I_, N_ in zip(pairs, I, N):
+        assert abs(I_ - mutual_information_python(Gs[i], Gs[j])) < 1e-6
+        assert abs(N_ - mutual_information_overlap_python(Gs[i], Gs[j])) \
+               < 1e-9
@@ -0,0 +1,63 @@
+import random
+
+import numpy
+
+from pcd.old.imgseg import ImgSeg, _blockmean
+
+def image(Ly=14, Lx=16, seed=7):
+    rng = numpy.random.RandomState(seed)
+    img = rng.uniform(size=(Ly, Lx))
+    img[:, :Lx//2] += 1
+    return img / img.max()
+
+
+def test_arrayweights():
+    # The vectorized weights are the same as the per-pair ones.
+    for mode in ('intensity', 'frequency'):
+        for dist in (None, 'exp-rweights'):
+            I = ImgSeg(image(), width=2, corrlength=3, mode=mode, dist=dist)
+            nodeIndex = dict((c, i) for i, c in enumerate(I.iterCoords()))
+            expected = { }
+            for row in I.iterweights():
+                a, b = nodeIndex[row[0]], nodeIndex[row[1]]
+                expected[a, b] = row[2:]
+            mean_conn = I.mean_conn.copy()
+
+            rows, cols, weights, rweights = I.arrayweights()
+            assert (rweights is not None) == (dist == 'exp-rweights')
+            pairs = zip(rows, cols)
+            assert len(set(pairs)) == len(pairs) == len(expected)
+            for i, (a, b) in enumerate(pairs):
+                w = expected[a, b]
+                assert numpy.allclose(weights[i], w[0], rtol=1e-5, atol=1e-6)
+                if rweights is not None:
+                    assert numpy.allclose(rweights[i], w[1])
+            assert numpy.allclose(I.mean_conn, mean_conn, rtol=1e-5, atol=1e-6)
+
+
+class ContrastImgSeg(ImgSeg):
+    """Pixels of different intensity repel, so regions separate."""
+    def outer_intensityavg(self, a1, a2):
+        return _blockmean(numpy.abs(a1-a2)) - .5
+
+def test_segment_tiled():
+    # Three noisy vertical stripes, cut by tile seams in both
+    # directions.
+    rng = numpy.random.RandomState(1)
+    img = numpy.zeros((24, 36))
+    img[:, 12:24] = .6
+    img += rng.uniform(0, .4, size=img.shape)
+    I = ContrastImgSeg(img, width=0, corrlength=2, mode='intensity')
+    results = [ ]
+    for processes in (None, 2):
+        random.seed(5)
+        labels = I.segment_tiled(1., tilesize=10, trials=2,
+                                 processes=processes)
+        stripes = [ numpy.unique(labels[:, x0:x0+12])
+                    for x0 in (0, 12, 24) ]
+        # Each stripe is one community across the seams.
+        assert [ len(l) for l in stripes ] == [1, 1, 1]
+        assert stripes[0] != stripes[1] != stripes[2]
+        results.append(labels)
+    # Tiles are seeded the same way in worker processes.
+    assert numpy.all(results[0] == results[1])
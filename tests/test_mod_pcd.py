@@ -47,3 +47,64 @@ def test():
 
     #g = pcd.graphs.dolphins()
     #test_mod(g)
+
+def test_sparse_mod():
+    # Implicit null model on a sparse Graph gives the same energies
+    # as the full rmatrix.
+    import numpy
+    from pcd.old.models import Graph
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g)
+    G.enableModularity(None)
+    S = Graph.fromNetworkX(g, sparse=True)
+    S.enableModularity(None)
+    G.verbosity = S.verbosity = -1
+    assert not isinstance(S.rmatrix, numpy.ndarray)
+    # The full matrices are float32, so the energies (sums over about
+    # N**2 pairs) only agree to within a tolerance scaled by the number
+    # of edges.
+    tol = 1e-6 * g.number_of_edges()
+    rng = numpy.random.RandomState(13)
+    for gamma in (.5, 1.0):
+        G.cmty[:] = rng.randint(4, size=G.N)
+        G.cmtyListInit()
+        S.setcmtystate(G.getcmtystate())
+        assert abs(G.energy(gamma) - S.energy(gamma)) < tol
+        assert abs(G.energy_cmty_cmty(gamma, 0, 1)
+                   - S.energy_cmty_cmty(gamma, 0, 1)) < tol
+    S.trials(1.0, 5)
+    S.check()
+    assert numpy.all(S.cmtyWeight[:S.Ncmty] ==
+                     numpy.bincount(S.cmty, weights=S.nodeWeight))
+    cmtys = pcd.cmty.Communities.from_pcd(S)
+    assert approxeq(cmtys.Q(g), S.modularity())
+    assert approxeq(cmtys.Q(g), -S.energy(1.0)/g.number_of_edges()
+                    - numpy.sum(S.nodeWeight**2)/(2*g.number_of_edges())**2)
+
+def test_sparse_mod_overlap():
+    # Overlap minimizers work with the weighted nodes of sparse
+    # modularity, and the xor energy they combine with is that of the
+    # full rmatrix.
+    import itertools
+    import numpy
+    from pcd.old import cmodels
+    from pcd.old.models import Graph
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g)
+    G.enableModularity(None)
+    S = Graph.fromNetworkX(g, sparse=True)
+    S.enableModularity(None)
+    G.verbosity = S.verbosity = -1
+    S.trials(1.0, 2)
+    S.ovgreedy(1.0)
+    S.check()
+    G.setcmtystate(S.getcmtystate())
+    assert approxeq(G.energy(1.0), S.energy(1.0))
+    M = G.imatrix + G.rmatrix
+    for c1, c2 in itertools.permutations(S.cmtys(), 2):
+        a, b = set(S.cmtyContents(c1)), set(S.cmtyContents(c2))
+        E = sum(M[n1, n2] for n1 in a-b for n2 in b-a)
+        assert approxeq(E, cmodels.energy_cmty_cmty_xor_sparse(
+            S._struct_p, 1.0, c1, c2))
+    S.ovfree(1.0)
+    S.check()
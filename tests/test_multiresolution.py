@@ -0,0 +1,159 @@
+from os.path import join
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+
+import pcd.graphs
+from pcd.util import LogInterval
+from pcd.old.models import Graph
+from pcd.old.multiresolution import MultiResolution
+
+class SlowGraph(Graph):
+    """Graph with a slow minimizer, so that threads overlap."""
+    log = [ ]
+    def slow_greedy(self, gamma, **kwargs):
+        self.log.append((gamma, threading.current_thread().name))
+        time.sleep(.01 * numpy.random.randint(1, 4))
+        return self.greedy(gamma)
+
+def replicas(n=3, cls=Graph):
+    G = cls.fromNetworkX(pcd.graphs.karate_club(), sparse=True)
+    G.verbosity = -1
+    return [ G.copy() for _ in range(n) ]
+
+def new_MR(**kwargs):
+    return MultiResolution(overlap=False,
+                           minimizerargs=dict(minimizer='greedy', trials=2),
+                           **kwargs)
+
+
+def test_refine_maxgammas():
+    # Refinement goes on until maxgammas, and threads which have to
+    # wait for the ends of an interval to finish do not quit.
+    coarse = dict(low=.1, high=10, density=2)
+    for threads in (1, 3):
+        SlowGraph.log = [ ]
+        MR = new_MR()
+        MR.minimizer = 'slow_greedy'
+        MR.run(replicas(cls=SlowGraph), gammas=dict(coarse,
+                                                    refine=dict(maxgammas=15)),
+               threads=threads)
+        assert len(MR._data) == 15
+        coarse_gammas = set(LogInterval(**coarse).values())
+        refine_threads = set(name for gamma, name in SlowGraph.log
+                             if gamma not in coarse_gammas)
+        assert len(refine_threads) == threads
+
+
+def test_processes():
+    # A process pool gives the same results as threads (up to the
+    # randomness of the minimizer), and keeps states only if asked.
+    gammas = [.001, .01, .1, 1, 10, 100]
+    tables = [ ]
+    for kwargs in (dict(threads=2), dict(processes=2)):
+        for savestate in (False, True):
+            MR = new_MR(savestate=savestate)
+            MR.run(replicas(), gammas=gammas, **kwargs)
+            assert sorted(MR._data) == gammas
+            for gamma in gammas:
+                state = getattr(MR._data[gamma], 'state', None)
+                if savestate:
+                    assert len(state['Gs']) == 3
+                else:
+                    assert state is None
+        tables.append((set(MR.fieldnames), MR.table()))
+    (names1, t1), (names2, t2) = tables
+    assert names1 == names2
+    assert numpy.all(t1['q'][:2] == 1) and numpy.all(t2['q'][:2] == 1)
+    assert numpy.allclose(t1['q'], t2['q'], rtol=.25)
+    assert numpy.allclose(t1['nodes'], t2['nodes'])
+
+
+def test_checkpoint_resume():
+    # A resumed run skips the gammas in the checkpoint, reproduces
+    # their rows, and warm starts from their states, even though
+    # savestate is off.
+    tmpdir = tempfile.mkdtemp(prefix='pcd-test-')
+    try:
+        fname = join(tmpdir, 'checkpoint.sqlite')
+        kwargs = dict(checkpoint=fname, savestate=False, warmstart=True)
+        MR = new_MR(**kwargs)
+        MR.minimizer = 'slow_greedy'
+        MR.run(replicas(cls=SlowGraph), gammas=[.1, 1])
+        table1 = MR.table()
+        assert getattr(MR._data[1], 'state', None) is None
+
+        SlowGraph.log = [ ]
+        MR = new_MR(**kwargs)
+        MR.minimizer = 'slow_greedy'
+        assert sorted(MR._data) == [.1, 1]
+        assert getattr(MR._data[1], 'state', None) is None
+        assert len(MR._resumed[1]['Gs']) == 3
+        # Gammas only need to be equal up to rounding.
+        MR.run(replicas(cls=SlowGraph), gammas=[.1*(1+1e-12), 1, 10])
+        assert set(gamma for gamma, name in SlowGraph.log) == set([10])
+        assert sorted(MR._data) == [.1, 1, 10]
+        table2 = MR.table()
+        for name in table1:
+            assert numpy.allclose(table1[name], table2[name][:2],
+                                  equal_nan=True)
+        assert table2['warmstart'][2] == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_warmstart():
+    # Warm starts begin from the nearest finished gamma's states.
+    gammas = [1., 1.0001]
+    MR = MultiResolution(overlap=False, minimizer='greedy', minimizerargs={},
+                         warmstart=True)
+    Gs = replicas()
+    MR.run(Gs, gammas=gammas)
+    warm = dict((g, MR._data[g].data['warmstart'].mean) for g in gammas)
+    cold = [ g for g in gammas if warm[g] == 0 ]
+    assert len(cold) == 1
+    g_cold, = cold
+    g_warm, = [ g for g in gammas if g != g_cold ]
+    assert warm[g_warm] == g_cold
+    # Greedy never raises the energy of the state it starts from.
+    G = Gs[0].copy()
+    for i in range(len(Gs)):
+        G.setcmtystate(MR._data[g_cold].state['Gs'][i])
+        E_start = G.energy(g_warm)
+        G.setcmtystate(MR._data[g_warm].state['Gs'][i])
+        assert G.energy(g_warm) <= E_start + 1e-6
+
+    runner = MR.runner()
+    runner._lock = None
+    runner._warmStates = { }
+    assert runner._getWarmStates(1.) == (None, None)
+    runner._warmStates = {.5: 'a', 3.: 'b'}
+    assert runner._getWarmStates(1.) == (.5, 'a')
+    assert runner._getWarmStates(2.) == (3., 'b')
+    # Perturbation moves only the given fraction of nodes.
+    G = Gs[0].copy()
+    G.greedy(1.)
+    cmty = G.cmty.copy()
+    runner._perturb(G, 0.)
+    assert numpy.all(G.cmty == cmty)
+    runner._perturb(G, .25)
+    G.check()
+    assert 0 < numpy.sum(G.cmty != cmty) <= round(.25 * G.N)
+
+
+def test_calc_gammadict():
+    # calcMethods see the values of the earlier ones, and the node
+    # count is stored by the parent even when workers run calc.
+    def calc_q_again(MR, data, settings):
+        return [('q_again', data['_gammaDict']['q'])]
+    gammas = [.1, 1, 10]
+    for kwargs in (dict(threads=2), dict(processes=2)):
+        MR = new_MR()
+        MR.calcMethods = MR.calcMethods + [calc_q_again]
+        MR.run(replicas(), gammas=gammas, **kwargs)
+        assert MR.N == 34
+        table = MR.table()
+        assert numpy.all(table['q_again'] == table['q'])
@@ -0,0 +1,336 @@
+import random
+
+import numpy
+
+import pcd.graphs
+from pcd.old.models import Graph
+
+def approxeq(a, b, tol=1e-6):
+    return abs(a-b) <= tol*max(1., abs(a), abs(b))
+
+
+def test_csr_matches_full():
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g)
+    S = Graph.fromNetworkX(g, sparse=True)
+    G.verbosity = S.verbosity = -1
+
+    # The sparse Graph is packed CSR: no dense matrix, no padding.
+    assert not S.hasFull
+    assert S.simatrix.shape == (2*g.number_of_edges(), )
+    assert S.simatrixIdx[-1] == len(S.simatrix)
+
+    for gamma in (.1, 1.0, 3.0):
+        G.cmtyCreate()
+        S.setcmtystate(G.getcmtystate())
+        assert approxeq(G.energy(gamma), S.energy(gamma))
+        G.greedy(gamma)
+        S.setcmtystate(G.getcmtystate())
+        assert approxeq(G.energy(gamma), S.energy(gamma))
+        for c1 in G.cmtys():
+            for c2 in G.cmtys():
+                assert approxeq(G.energy_cmty_cmty(gamma, c1, c2),
+                                S.energy_cmty_cmty(gamma, c1, c2))
+
+    S.trials(1.0, 3)
+    S.anneal(1.0, maxrounds=10)
+    S.check()
+
+
+def test_trials_processes():
+    g = pcd.graphs.karate_club()
+    for sparse in (False, True):
+        G = Graph.fromNetworkX(g, sparse=sparse)
+        G.verbosity = -1
+        G.trials(1.0, 4, processes=2)
+        G.check()
+        # Interaction arrays are now in shared memory, and still valid.
+        G.trials(1.0, 4, minimizer='anneal', processes=2, maxrounds=10)
+        G.check()
+        assert G.q > 1
+        S = Graph.fromNetworkX(g, sparse=sparse)
+        S.setcmtystate(G.getcmtystate())
+        assert approxeq(S.energy(1.0), G.energy(1.0))
+
+
+def test_combine_fixed_point():
+    # After a merge pass, no pair of communities can be merged to
+    # lower the energy.
+    g = pcd.graphs.karate_club()
+    for sparse in (False, True):
+        for gamma in (.05, .5):
+            G = Graph.fromNetworkX(g, sparse=sparse)
+            G.verbosity = -1
+            G.greedy(gamma)
+            E0 = G.energy(gamma)
+            G.combine(gamma)
+            G.check()
+            assert G.energy(gamma) <= E0 + 1e-6
+            cmtys = list(G.cmtys())
+            for c1 in cmtys:
+                for c2 in cmtys:
+                    if c1 < c2:
+                        assert G.energy_cmty_cmty(gamma, c1, c2) \
+                             + G.energy_cmty_cmty(gamma, c2, c1) >= -1e-6
+
+
+def test_coarsen_energy():
+    # The energy of a supernode Graph differs from the projected
+    # energy of the original Graph by a constant, at every level.
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g, sparse=True)
+    G.verbosity = -1
+    P = Graph.fromNetworkX(g, sparse=True)
+    P.verbosity = -1
+    gamma = .5
+    G.greedy(gamma)
+    G.remap()
+    C = G._coarsen()
+    C.check()
+    assert C.N == G.q
+    assert C.nodeWeight.sum() == G.N
+    C.cmty[:] = numpy.arange(C.N) % 3
+    C.cmtyListInit()
+    C.remap()
+    C2 = C._coarsen()
+    C2.check()
+    level1 = G.cmty.copy()
+    level2 = C.cmty[G.cmty]
+    for L, cmtymap in ((C, lambda: C.cmty[level1]),
+                       (C2, lambda: C2.cmty[level2])):
+        diffs = [ ]
+        for i in range(3):
+            L.cmtyCreate()
+            L.cmty[:] = numpy.random.randint(min(2, L.N), size=L.N)
+            L.cmtyListInit()
+            L.check()
+            P.cmty[:] = cmtymap()
+            P.cmtyListInit()
+            diffs.append(P.energy(gamma) - L.energy(gamma))
+        assert approxeq(min(diffs), max(diffs))
+
+
+def test_multilevel():
+    g = pcd.graphs.karate_club()
+    for sparse in (False, True):
+        G = Graph.fromNetworkX(g, sparse=sparse)
+        G.verbosity = -1
+        G.trials(.5, 3, minimizer='multilevel')
+        G.check()
+        assert G.q > 1
+        E = G.energy(.5)
+        G.greedy(.5)
+        assert G.energy(.5) <= E + 1e-6
+
+
+def test_anneal_pt():
+    g = pcd.graphs.karate_club()
+    for sparse in (False, True):
+        for processes in (None, 2):
+            G = Graph.fromNetworkX(g, sparse=sparse)
+            G.verbosity = -1
+            G.anneal_pt(1.0, replicas=4, maxrounds=20, processes=processes)
+            G.check()
+            assert G.move_info.shape == (4, 12)
+            assert G.swap_info.shape == (3, 2)
+            # Every replica made one sweep per round at some beta.
+            assert G.move_info[:, 0::3].sum() > 0
+            assert numpy.all(G.swap_info[:, 1] <= G.swap_info[:, 0])
+            S = Graph.fromNetworkX(g, sparse=sparse)
+            S.setcmtystate(G.getcmtystate())
+            assert approxeq(S.energy(1.0), G.energy(1.0))
+
+
+def test_copy():
+    g = pcd.graphs.karate_club()
+    for sparse in (False, True):
+        G = Graph.fromNetworkX(g, sparse=sparse)
+        G.verbosity = -1
+        G.greedy(.5)
+        E = G.energy(.5)
+        C = G.copy()
+        C.check()
+        assert approxeq(C.energy(.5), E)
+        # Interactions are shared, communities are not.
+        if sparse:
+            assert C.simatrix.ctypes.data == G.simatrix.ctypes.data
+        else:
+            assert C.imatrix.ctypes.data == G.imatrix.ctypes.data
+        assert C.cmty.ctypes.data != G.cmty.ctypes.data
+        C.cmtyCreate()
+        C.greedy(.05)
+        C.check()
+        G.check()
+        assert approxeq(G.energy(.5), E)
+        # Copies of copies, with overlaps.
+        G.ovGreedy(.5)
+        C = G.copy().copy()
+        C.check()
+        assert not C.oneToOne
+        assert approxeq(C.energy(.5), G.energy(.5))
+
+
+def test_minimize_blocks():
+    import networkx
+    k = pcd.graphs.karate_club()
+    g = networkx.disjoint_union_all([k]*3 + [networkx.path_graph(3)]*5)
+    comp = numpy.zeros(len(g), dtype=int)
+    for i, nodes in enumerate(networkx.connected_components(g)):
+        comp[list(nodes)] = i
+    for sparse in (False, True):
+        for processes in (None, 2):
+            G = Graph.fromNetworkX(g, sparse=sparse)
+            G.verbosity = -1
+            nblocks, labels = G._attractive_blocks(1.0)
+            assert nblocks == 8
+            G.minimize_blocks(1.0, minimizer='trials', trials=2,
+                              minblock=20, processes=processes)
+            G.check()
+            # No community spans two components.
+            for c in G.cmtys():
+                assert len(set(comp[G.cmtyContents(c)])) == 1
+            E = G.energy(1.0)
+            Es = [ ]
+            for i in range(8):
+                S = G._subgraph(numpy.where(comp == i)[0])
+                Es.append(S.energy(1.0))
+            assert approxeq(E, sum(Es))
+    # With an attractive default, everything is one block.
+    G = Graph.fromNetworkX(g, sparse=True)
+    G.srmatrixDefault = -1
+    assert G._attractive_blocks(1.0)[0] == 1
+
+
+def test_pruned():
+    import networkx
+    g = networkx.Graph(pcd.graphs.karate_club())
+    # Hang some trees off the karate club.
+    g.add_edges_from([(0, 34), (34, 35), (34, 36), (5, 37), (37, 38)])
+    for sparse in (False, True):
+        G = Graph.fromNetworkX(g, sparse=sparse)
+        G.verbosity = -1
+        roots = G._tree_roots(.5, maxsize=None)
+        assert list(roots[34:]) == [0, 0, 0, 5, 5]
+        # By default, only leaves are contracted.
+        roots = G._tree_roots(.5)
+        assert list(roots[34:]) == [34, 34, 34, 37, 37]
+        P, groups = G.pruned(.5)
+        P.check()
+        assert P.N == 35   # node 11 of the karate club is a leaf, too.
+        assert P.nodeWeight.sum() == G.N
+        # The energies differ by a constant.
+        diffs = [ ]
+        for i in range(3):
+            P.cmty[:] = numpy.random.randint(3, size=P.N)
+            P.cmtyListInit()
+            G.cmty[:] = P.cmty[groups]
+            G.cmtyListInit()
+            diffs.append(G.energy(.5) - P.energy(.5))
+        assert approxeq(min(diffs), max(diffs))
+        P.greedy(.5)
+        G.loadFromPruned(P, groups, gamma=.5)
+        G.check()
+        assert G.q > 1
+    # Components which are trees are not contracted.
+    for sparse in (False, True):
+        G = Graph.fromNetworkX(networkx.path_graph(10), sparse=sparse)
+        G.verbosity = -1
+        assert list(G._tree_roots(1.0, maxsize=None)) == range(10)
+        assert G.pruned(1.0) == (None, None)
+        # Contracting everything into one node still works.
+        G.cmty[:] = 0
+        G.cmtyListInit()
+        C = G.copy()
+        if not sparse:
+            C.make_sparse(default='auto')
+        C = C._coarsen()
+        C.check()
+        assert C.N == 1 and C.nodeWeight[0] == 10
+
+
+def test_coords_cutoff():
+    # Cell-list graphs have the same energies as full ones, if efunc
+    # is at its infinite-distance value beyond the cutoff.
+    L = 10.
+    coords = numpy.random.uniform(0, L, size=(200, 2))
+    efunc = lambda d: numpy.where(d < 1.5, -1., 1.)
+    refunc = lambda d: numpy.where(d < 1.5, 0., 1.)
+    for r in (None, refunc):
+        G = Graph.from_coords_and_efunc(coords, efunc, boxsize=L, refunc=r)
+        S = Graph.from_coords_and_efunc(coords, efunc, boxsize=L, refunc=r,
+                                        cutoff=2.)
+        G.verbosity = S.verbosity = -1
+        assert not S.hasFull
+        for gamma in (.1, 1.):
+            G.cmty[:] = numpy.random.randint(10, size=G.N)
+            G.cmtyListInit()
+            S.setcmtystate(G.getcmtystate())
+            assert approxeq(G.energy(gamma), S.energy(gamma))
+        S.greedy(1.)
+        S.check()
+
+
+def test_greedy_sparse_deltas():
+    # The greedy energy deltas of a sparse Graph are those of the
+    # full one, so its sweeps only lower the energy and end in a
+    # state where the full greedy finds nothing to move.
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g)
+    S = Graph.fromNetworkX(g, sparse=True)
+    G.verbosity = S.verbosity = -1
+    numpy.random.seed(3)
+    for gamma in (.1, .5, 1.0, 3.0):
+        S.cmtyCreate()
+        changes = None
+        while changes != 0:
+            G.setcmtystate(S.getcmtystate())
+            for n in range(S.N):
+                for c in S.cmtys():
+                    assert approxeq(G.energy_cmty_n(gamma, c, n),
+                                    S.energy_cmty_n(gamma, c, n))
+            E0 = G.energy(gamma)
+            S._gen_random_order()
+            changes = S._greedy(gamma)
+            G.setcmtystate(S.getcmtystate())
+            assert approxeq(G.energy(gamma), S.energy(gamma))
+            if changes:
+                assert G.energy(gamma) < E0
+            else:
+                assert approxeq(G.energy(gamma), E0)
+        G._gen_random_order()
+        assert G._greedy(gamma) == 0
+
+
+def test_cmtylist_overlaps():
+    # Community lists stay consistent across many overlapping adds
+    # and removes, for full and sparse Graphs alike.
+    g = pcd.graphs.karate_club()
+    G = Graph.fromNetworkX(g)
+    S = Graph.fromNetworkX(g, sparse=True)
+    G.verbosity = S.verbosity = -1
+    G.cmtyCreate()
+    G.greedy(1.0)
+    S.setcmtystate(G.getcmtystate())
+    G.oneToOne = S.oneToOne = 0
+    cmtys = dict((c, set(G.cmtyContents(c))) for c in G.cmtys())
+    rng = random.Random(4)
+    for i in range(2000):
+        n = rng.randrange(G.N)
+        c = rng.choice(sorted(cmtys))
+        if n not in cmtys[c]:
+            G.cmtyListAddOverlap(c, n)
+            S.cmtyListAddOverlap(c, n)
+            cmtys[c].add(n)
+        elif sum(n in x for x in cmtys.values()) > 1:
+            G.cmtyListRemoveOverlap(c, n)
+            S.cmtyListRemoveOverlap(c, n)
+            cmtys[c].discard(n)
+        if i % 100 == 0:
+            assert G.check() == 0 and S.check() == 0
+            assert approxeq(G.energy(1.0), S.energy(1.0))
+    for X in (G, S):
+        for c, nodes in cmtys.iteritems():
+            assert set(X.cmtyContents(c)) == nodes
+            assert X.cmtyN[c] == len(nodes)
+            for n in range(X.N):
+                assert bool(X.cmtyContains(c, n)) == (n in nodes)
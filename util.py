@@ -390,13 +390,80 @@ def mean_position2(coords, boxsize):
     return coords.mean(axis=0)
 #def uniform_image(coords, boxsize):
 
+def cell_list_pairs(coords, cutoff, boxsize=None):
+    """All pairs of points closer than cutoff, found with cell lists.
+
+    coords is an (N, d) array.  If boxsize is given (a number or a
+    length-d array), the box [0, boxsize) is periodic and distances
+    are minimum-image distances.  Points are binned into cells at
+    least `cutoff` wide, and only neighboring cells are compared, so
+    the cost is O(N) at constant density instead of O(N**2).
+
+    Returns (i, j, dist) arrays, with both (i,j) and (j,i) for every
+    pair (i != j), sorted by i then j.
+    """
+    coords = numpy.asarray(coords, dtype=float)
+    N, d = coords.shape
+    if boxsize is not None:
+        boxsize = numpy.ones(d) * boxsize
+        coords = coords % boxsize
+        lengths = boxsize
+        origin = numpy.zeros(d)
+    else:
+        origin = coords.min(axis=0) if N else numpy.zeros(d)
+        lengths = (coords.max(axis=0) - origin + 1e-9) if N else numpy.ones(d)
+    ncells = numpy.maximum(numpy.floor(lengths/cutoff), 1).astype(int)
+    cellsize = lengths / ncells
+    cellcoord = numpy.minimum(((coords-origin)/cellsize).astype(int),
+                              ncells-1)
+    strides = numpy.cumprod(numpy.concatenate(([1], ncells[:0:-1])))[::-1]
+    cell = numpy.dot(cellcoord, strides)
+    order = numpy.argsort(cell, kind='mergesort')
+    counts = numpy.bincount(cell, minlength=numpy.prod(ncells))
+    starts = numpy.cumsum(counts) - counts
+
+    # Neighbor cell offsets.  With periodic boundaries and fewer than
+    # three cells in a direction, several offsets are the same cell.
+    offsets = numpy.array(numpy.meshgrid(*[(-1, 0, 1)]*d, indexing='ij')
+                          ).reshape(d, -1).T
+    if boxsize is not None:
+        offsets = offsets % ncells
+        offsets = numpy.asarray(sorted(set(map(tuple, offsets))), dtype=int)
+
+    I, J = [ ], [ ]
+    for offset in offsets:
+        nb = cellcoord + offset
+        if boxsize is not None:
+            nb %= ncells
+            valid = numpy.ones(N, dtype=bool)
+        else:
+            valid = numpy.all((nb >= 0) & (nb < ncells), axis=1)
+        i = numpy.where(valid)[0]
+        nbcell = numpy.dot(nb[i], strides)
+        n = counts[nbcell]
+        i = numpy.repeat(i, n)
+        pos = numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n)-n, n)
+        j = order[numpy.repeat(starts[nbcell], n) + pos]
+        I.append(i)
+        J.append(j)
+    i = numpy.concatenate(I)
+    j = numpy.concatenate(J)
+    delta = coords[i] - coords[j]
+    if boxsize is not None:
+        delta = wrap_dists(delta, boxsize)
+    dist = numpy.sqrt((delta**2).sum(axis=1))
+    keep = (dist < cutoff) & (i != j)
+    i, j, dist = i[keep], j[keep], dist[keep]
+    order = numpy.lexsort((j, i))
+    return i[order], j[order], dist[order]
+
 def check_sparse_symmetric(G):
-    for i, row in enumerate(G.simatrixId):
-        for idx, j in enumerate(row):
-            weight = G.simatrix[i, idx]
-            assert i in G.simatraxId[j, :G.simatrixN[j]]
-            invindex = numpy.where(G.simatraxId[j, :G.simatrixN[j]]==i)[0][0]
-            difference = G.simatrix[j]
+    for i in range(G.N):
+        for j, weight in zip(*G._sparse_row(i)):
+            ids, weights = G._sparse_row(j)
+            assert i in ids
+            invindex = numpy.where(ids==i)[0][0]
+            assert weights[invindex] == weight
 
 def leval(s):
     try:                              return ast.literal_eval(s)